@@ -68,5 +68,10 @@ setup(
             "zope.testrunner",
         ],
     ),
+    entry_points=dict(
+        console_scripts=[
+            'zc-queue-worker = zc.queue.worker:main',
+        ],
+    ),
     zip_safe=False
 )
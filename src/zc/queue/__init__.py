@@ -1,4 +1,23 @@
+from zc.queue._consumer import Consumer
+from zc.queue._dedup import DedupQueue
+from zc.queue._fanin import FanIn
+from zc.queue._lease import LeasingQueue
+from zc.queue._log import Log
+from zc.queue._queue import APPEND_ONLY
+from zc.queue._queue import AT_LEAST_ONCE
+from zc.queue._queue import STRICT
+from zc.queue._queue import ArrayBucketQueue
+from zc.queue._queue import ArrayQueue
+from zc.queue._queue import Collector
 from zc.queue._queue import CompositePersistentQueue
 from zc.queue._queue import CompositeQueue
+from zc.queue._queue import ConflictPolicy
+from zc.queue._queue import OffsetQueue
 from zc.queue._queue import PersistentQueue
+from zc.queue._queue import PriorityQueue
 from zc.queue._queue import Queue
+from zc.queue._queue import ScheduledQueue
+from zc.queue._queue import ShardedQueue
+from zc.queue._queue import getCollector
+from zc.queue._queue import registerPolicy
+from zc.queue._queue import setCollector
@@ -0,0 +1,263 @@
+##############################################################################
+#
+# Copyright (c) 2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Queue Consumers
+"""
+import asyncio
+import inspect
+import queue
+import threading
+import time
+
+from ZODB.mvccadapter import MVCCAdapter
+from ZODB.POSException import ConflictError
+
+
+_lock = threading.Lock()
+
+
+# The methods of ZODB's MVCCAdapter that the notifier wraps, with their
+# parameters.  `_invalidate_finish`, which tells of the commits of this
+# process, is private: if a ZODB release changes any of them, consumers
+# only poll.
+_HOOKS = {
+    'invalidate': ('transaction_id', 'oids'),
+    '_invalidate_finish': ('tid', 'oids', 'committing_instance'),
+    'invalidateCache': (),
+}
+
+
+def _hookable(adapter):
+    # whether the adapter has the methods of _HOOKS, as we know them
+    for name, params in _HOOKS.items():
+        method = getattr(adapter, name, None)
+        if method is None:
+            return False
+        try:
+            signature = inspect.signature(method)
+        except (TypeError, ValueError):
+            return False
+        if tuple(signature.parameters) != params:
+            return False
+    return True
+
+
+class _Notifier:
+    """Tell subscribers about the oids that each commit to a database changes.
+
+    While it has subscribers, the notifier wraps the invalidation methods of
+    the database's MVCC adapter, so that subscribers hear of a commit, local
+    or from another process, only after every connection can see it.  The
+    adapter's own methods are put back when the last subscriber leaves.
+    """
+
+    def __init__(self, adapter):
+        self._adapter = adapter
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._wrappers = None
+        self._previous = None
+
+    def _install(self):
+        adapter = self._adapter
+        invalidate = adapter.invalidate
+        invalidate_finish = adapter._invalidate_finish
+        invalidate_cache = adapter.invalidateCache
+
+        def wrapped_invalidate(transaction_id, oids):
+            invalidate(transaction_id, oids)
+            self.notify(oids)
+
+        def wrapped_invalidate_finish(tid, oids, committing_instance):
+            invalidate_finish(tid, oids, committing_instance)
+            self.notify(oids)
+
+        def wrapped_invalidate_cache():
+            invalidate_cache()
+            self.notify(None)
+
+        self._wrappers = {
+            'invalidate': wrapped_invalidate,
+            '_invalidate_finish': wrapped_invalidate_finish,
+            'invalidateCache': wrapped_invalidate_cache,
+        }
+        self._previous = {name: adapter.__dict__.get(name)
+                          for name in self._wrappers}
+        for name, wrapper in self._wrappers.items():
+            setattr(adapter, name, wrapper)
+
+    def _uninstall(self):
+        # put back what we wrapped, unless something wrapped us since
+        adapter = self._adapter
+        if any(adapter.__dict__.get(name) is not wrapper
+               for name, wrapper in self._wrappers.items()):
+            return
+        for name, previous in self._previous.items():
+            if previous is None:
+                delattr(adapter, name)
+            else:
+                setattr(adapter, name, previous)
+        self._previous = None
+
+    def subscribe(self, callback):
+        with self._lock:
+            if self._previous is None:
+                self._install()
+            self._subscribers.add(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.discard(callback)
+                if not self._subscribers:
+                    self._uninstall()
+
+    def notify(self, oids):
+        # oids is None when anything may have changed
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            callback(oids)
+
+
+def _notifier(db):
+    # Return the notifier of a database, or None for storages that do their
+    # own MVCC (such as RelStorage) and so have no adapter to listen to, and
+    # for adapters that do not have the methods we know.
+    adapter = getattr(db, '_mvcc_storage', None)
+    if not isinstance(adapter, MVCCAdapter):
+        return None
+    with _lock:
+        notifier = adapter.__dict__.get('_zc_queue_notifier')
+        if notifier is None:
+            if not _hookable(adapter):
+                return None
+            notifier = adapter._zc_queue_notifier = _Notifier(adapter)
+    return notifier
+
+
+class Consumer:
+    """Take items off a queue, waiting for them while the queue is empty.
+
+    The consumer owns the transactions of the connection the queue was
+    loaded from: each item is pulled and committed in a transaction of its
+    own, retrying on conflict errors, so the connection should be dedicated
+    to the consumer.
+
+    While the queue is empty, the consumer sleeps until a commit changes
+    the queue object.  Storages that do their own MVCC do not report their
+    commits, nor do ZODB releases whose MVCC adapter we do not know, so
+    there the consumer only polls, every `pollInterval` seconds.  It polls
+    that often anyway, as a safety net.
+    """
+
+    def __init__(self, queue, pollInterval=5.0):
+        self.queue = queue
+        self.pollInterval = pollInterval
+        jar = queue._p_jar
+        if jar is None or queue._p_oid is None:
+            raise ValueError('queue must be stored in a database')
+        self.transaction_manager = jar.transaction_manager
+        self._oid = queue._p_oid
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._events = set()
+        self._notifier = _notifier(jar.db())
+        if self._notifier is not None:
+            self._notifier.subscribe(self._invalidated)
+
+    def close(self):
+        if self._notifier is not None:
+            self._notifier.unsubscribe(self._invalidated)
+            self._notifier = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _invalidated(self, oids):
+        if oids is not None and self._oid not in oids:
+            return
+        with self._condition:
+            self._generation += 1
+            self._condition.notify_all()
+            events = list(self._events)
+        for loop, event in events:
+            loop.call_soon_threadsafe(event.set)
+
+    def _pull(self):
+        # Return (True, item) after pulling and committing an item, or
+        # (False, None) if the queue is empty.
+        tm = self.transaction_manager
+        while True:
+            tm.abort()  # start from the latest state
+            try:
+                item = self.queue.pull()
+            except IndexError:
+                tm.abort()
+                return False, None
+            try:
+                tm.commit()
+            except ConflictError:
+                # most likely another consumer took the same item
+                continue
+            return True, item
+
+    def get(self, timeout=None):
+        """Pull and commit the first item of the queue, and return it.
+
+        Wait up to `timeout` seconds, or forever if it is None, for an item
+        to be put in an empty queue.  Raise `queue.Empty` on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._condition:
+                generation = self._generation
+            found, item = self._pull()
+            if found:
+                return item
+            wait = self.pollInterval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise queue.Empty
+                wait = min(wait, remaining)
+            with self._condition:
+                if self._generation == generation:
+                    self._condition.wait(wait)
+
+    def __aiter__(self):
+        return self._items()
+
+    async def _items(self):
+        # pull and commit items forever, sleeping while the queue is empty
+        event = asyncio.Event()
+        entry = (asyncio.get_running_loop(), event)
+        with self._condition:
+            self._events.add(entry)
+        try:
+            while True:
+                event.clear()
+                found, item = self._pull()
+                if found:
+                    yield item
+                    continue
+                try:
+                    await asyncio.wait_for(event.wait(), self.pollInterval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._condition:
+                self._events.discard(entry)
@@ -0,0 +1,117 @@
+##############################################################################
+#
+# Copyright (c) 2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Deduplicating Queue
+"""
+import time
+
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+
+from zc.queue._queue import BucketQueue
+from zc.queue._queue import CompositeQueue
+from zc.queue._queue import _indexKey
+
+
+class DedupQueue(CompositeQueue):
+    """A CompositeQueue whose puts ignore items it has seen recently.
+
+    Putting an item is a no-op while an equal item is in the queue, and for
+    `ttl` seconds after an equal item was pulled or removed, so producers
+    that retry can put the same job again without it being done twice.
+    Like an indexed CompositeQueue, it holds ints, strings, bytes and
+    persistent objects, and its index finds the queued items.
+
+    The pulled items are kept in a seen-set of two generations, each an
+    OOBTree from the key of an item to the time it was pulled, with a
+    BTrees.Length counting its keys.  A new generation is started when the
+    current one is `ttl` seconds old, or holds half of `maxSeen` keys, and
+    the generation before it is dropped whole, so that the seen-set never
+    needs to be scanned for expired items.  A put looks its item up in the
+    index and in each generation.  Concurrent puts and pulls of different
+    items merge, and concurrent puts of an equal new item conflict, after
+    which the retried put finds it queued.
+    """
+
+    ttl = 3600.0
+    maxSeen = None
+
+    _stateNames = CompositeQueue._stateNames + ('_seen', 'ttl', 'maxSeen')
+
+    def __init__(self, compositeSize=15, subfactory=BucketQueue,
+                 autoCompact=None, spread=None, ttl=3600.0, maxSeen=None):
+        super().__init__(
+            compositeSize, subfactory, autoCompact, spread, indexed=True)
+        self.ttl = ttl
+        self.maxSeen = maxSeen
+        self._seen = ()
+
+    def _seenSince(self, key, since):
+        for start, tree, length in self._seen:
+            when = tree.get(key)
+            if when is not None and when > since:
+                return True
+        return False
+
+    def _fresh(self, items):
+        # the items that are neither queued nor recently pulled, once each
+        since = time.time() - self.ttl
+        res = []
+        keys = set()
+        for item in items:
+            key = _indexKey(item)
+            if key is not None:  # a new persistent object is always fresh
+                if (key in keys or key in self._index or
+                        self._seenSince(key, since)):
+                    continue
+                keys.add(key)
+            res.append(item)
+        return res
+
+    def seen(self, item):
+        """Return True if putting `item` now would be a no-op."""
+        return not self._fresh([item])
+
+    def put(self, item):
+        if self._fresh([item]):
+            super().put(item)
+
+    def put_many(self, items):
+        super().put_many(self._fresh(items))
+
+    def put_first(self, item):
+        if self._fresh([item]):
+            super().put_first(item)
+
+    def _generation(self, now):
+        # return the tree and the length of the current generation of the
+        # seen-set, starting a new one if it is due
+        seen = self._seen
+        if seen:
+            start, tree, length = seen[-1]
+            if now - start < self.ttl and (
+                    self.maxSeen is None or length() * 2 < self.maxSeen):
+                return tree, length
+        generation = (now, OOBTree(), Length())
+        self._seen = seen[-1:] + (generation,)
+        return generation[1:]
+
+    def _unindex(self, items):
+        super()._unindex(items)
+        now = time.time()
+        tree, length = self._generation(now)
+        for item in items:
+            key = _indexKey(item)
+            if key not in tree:
+                length.change(1)
+            tree[key] = now
@@ -0,0 +1,212 @@
+##############################################################################
+#
+# Copyright (c) 2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Fan-in of Many Queues
+"""
+import weakref
+
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+
+from zc.queue._queue import CompositeQueue
+from zc.queue._queue import _conflict
+from zc.queue._queue import _resolve
+
+
+# The round-robin position of each FanIn, by connection and then by oid.
+# Volatile attributes would not do: every put or pull through a FanIn
+# changes it, so each commit of another connection invalidates the FanIn,
+# which drops them, and the round-robin would start over at every pull.
+_positions = weakref.WeakKeyDictionary()
+
+
+def resolveFanInConflict(oldstate, committedstate, newstate):
+    """Resolve a conflict in the state of a FanIn.
+
+    The item counts in `_counts` are merged as counters: a queue's merged
+    count is its committed count plus the change made by the new
+    transaction, and queues whose count reaches zero are dropped.  Anything
+    else that changed, such as a registration, conflicts.
+    """
+    states = (oldstate, committedstate, newstate)
+    old, committed, new = [state.pop('_counts') for state in states]
+    if committedstate != newstate:
+        raise _conflict('changed-keys')
+    merged = {}
+    for name in set(old) | set(committed) | set(new):
+        count = (committed.get(name, 0) + new.get(name, 0) -
+                 old.get(name, 0))
+        if count < 0:
+            # both pulled the last items of the queue
+            raise _conflict('both-removed')
+        if count:
+            merged[name] = count
+    newstate['_counts'] = merged
+    return newstate
+
+
+class FanIn(Persistent):
+    """A consumer's view of many named queues, such as one per tenant.
+
+    Producers put items on a named queue through the FanIn, and consumers
+    `pull` from whichever queue comes next by weighted round-robin.  The
+    FanIn keeps the number of items of each non-empty queue in its own
+    state, so choosing a queue loads no queue at all, and a pull loads only
+    the queue it takes from.  Puts and pulls on different queues change the
+    counts concurrently, and merge.
+
+    Each connection keeps its own round-robin position, so consumers write
+    nothing to the database to take turns, and consumers in different
+    connections start at different queues.  Items put on a queue directly,
+    rather than through the FanIn, are not counted until `sync`.
+    """
+
+    def __init__(self):
+        self._queues = OOBTree()
+        self._weights = {}
+        self._counts = {}
+
+    def register(self, name, queue=None, weight=1):
+        """Add a queue under `name`, and return it.
+
+        A new CompositeQueue is made if `queue` is None.  A queue with
+        `weight` n gets n turns for each turn of a queue of weight 1.
+        Raise KeyError if the name is taken.
+        """
+        if name in self._weights:
+            raise KeyError(name)
+        if queue is None:
+            queue = CompositeQueue()
+        self._queues[name] = queue
+        weights = dict(self._weights)
+        weights[name] = weight
+        self._weights = weights
+        self._count(name, len(queue))
+        return queue
+
+    def unregister(self, name):
+        """Remove the queue registered under `name`, with its items, and
+        return it."""
+        queue = self._queues.pop(name)
+        weights = dict(self._weights)
+        del weights[name]
+        self._weights = weights
+        self._count(name, -self._counts.get(name, 0))
+        return queue
+
+    def queue(self, name):
+        """Return the queue registered under `name`."""
+        return self._queues[name]
+
+    def names(self):
+        """Return the names of the registered queues."""
+        return sorted(self._weights)
+
+    def counts(self):
+        """Return a dict of the names of the non-empty queues and the
+        numbers of their items."""
+        return dict(self._counts)
+
+    def _count(self, name, delta):
+        if not delta:
+            return
+        counts = dict(self._counts)
+        count = counts.get(name, 0) + delta
+        if count:
+            counts[name] = count
+        else:
+            counts.pop(name, None)
+        self._counts = counts
+
+    def sync(self, name):
+        """Count the items of a queue again, after it changed other than
+        through the FanIn."""
+        self._count(
+            name, len(self._queues[name]) - self._counts.get(name, 0))
+
+    def put(self, name, item):
+        self._queues[name].put(item)
+        self._count(name, 1)
+
+    def put_many(self, name, items):
+        items = tuple(items)
+        self._queues[name].put_many(items)
+        self._count(name, len(items))
+
+    def _affinity(self):
+        # where a connection starts its round-robin, so that consumers with
+        # a connection each start at a different queue
+        return hash(self._p_jar)
+
+    def _position(self):
+        # this connection's round-robin position, kept in _positions
+        owner = self if self._p_jar is None else self._p_jar
+        return _positions.setdefault(owner, {}).setdefault(self._p_oid, {})
+
+    def _select(self):
+        # smooth weighted round-robin over the non-empty queues
+        names = sorted(self._counts)
+        if not names:
+            raise IndexError(0)
+        start = self._affinity() % len(names)
+        current = self._position()
+        for name in list(current):
+            if name not in self._counts:
+                del current[name]
+        total = 0
+        best = None
+        for name in names[start:] + names[:start]:
+            weight = self._weights[name]
+            total += weight
+            current[name] = current.get(name, 0) + weight
+            if best is None or current[name] > current[best]:
+                best = name
+        current[best] -= total
+        return best
+
+    def pull(self):
+        """Remove and return a tuple of the name of the next queue in turn
+        and its first item.
+
+        Raise IndexError if all queues are empty.
+        """
+        while True:
+            name = self._select()
+            queue = self._queues[name]
+            if queue:
+                item = queue.pull()
+                self._count(name, -1)
+                return name, item
+            # the queue was emptied other than through the FanIn
+            self.sync(name)
+
+    def pull_many(self, n):
+        """Pull up to `n` items, as `pull` does, and return a list of
+        (name, item) tuples."""
+        res = []
+        while len(res) < n:
+            try:
+                res.append(self.pull())
+            except IndexError:
+                break
+        return res
+
+    def __len__(self):
+        return sum(self._counts.values())
+
+    def __bool__(self):
+        return bool(self._counts)
+
+    def _p_resolveConflict(self, oldstate, committedstate, newstate):
+        return _resolve(
+            'fanin', resolveFanInConflict, oldstate, committedstate, newstate)
@@ -0,0 +1,162 @@
+##############################################################################
+#
+# Copyright (c) 2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Leasing Queue
+"""
+import math
+import time
+import uuid
+
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
+
+from zc.queue._queue import BucketQueue
+from zc.queue._queue import CompositeQueue
+
+
+class LeasingQueue(CompositeQueue):
+    """A CompositeQueue that lends items out instead of handing them over.
+
+    `lease` pulls the first item and records a lease on it, which expires
+    after a timeout.  The worker then does its work outside of any
+    transaction and finishes with `ack`, or gives the item back with
+    `nack`.  Items of leases that expire, say because the worker crashed,
+    are put back on the queue by `reclaim`, which `lease` calls once the
+    leases of an `expiryGranularity` slot have all expired.
+
+    Leases are kept in an OOBTree mapping a random token to the expiry time
+    and the item, so that leases taken and ended in concurrent transactions
+    usually merge.  (BTrees cannot merge the removal of the first key of a
+    bucket, so keys ordered by time would make most acknowledgements
+    conflict with concurrent leases.)
+
+    The tokens are also indexed by their expiry time, rounded up to a
+    multiple of `expiryGranularity`, in `_expiries`, so that finding the
+    expired leases does not load the others.  Only `reclaim` removes
+    entries from the index: the entries of leases that ended, or that were
+    renewed, are skipped by the next `reclaim` of their slot.
+    """
+
+    # The length of the expiry slots, in seconds.
+    expiryGranularity = 1.0
+
+    # Instances created before `_expiries` existed have it set to None
+    # until their next reclaim.
+    _expiries = None
+
+    _stateNames = CompositeQueue._stateNames + ('_leases', '_expiries')
+
+    def __init__(self, compositeSize=15, subfactory=BucketQueue,
+                 autoCompact=None, spread=None, indexed=False):
+        super().__init__(
+            compositeSize, subfactory, autoCompact, spread, indexed)
+        self._leases = OOBTree()
+        self._expiries = OOBTree()
+
+    def _slotOf(self, expires):
+        # the end of the expiry slot of a lease
+        granularity = self.expiryGranularity
+        return math.ceil(expires / granularity) * granularity
+
+    def _indexLease(self, token, expires):
+        # index the lease of `token` in its expiry slot.  Each connection
+        # adds slots of its own, so that concurrent leases merge.
+        key = (self._slotOf(expires), self._affinity())
+        tokens = self._expiries.get(key)
+        if tokens is None:
+            tokens = self._expiries[key] = OOTreeSet()
+        tokens.insert(token)
+
+    def lease(self, timeout):
+        """Pull the first item and lease it for `timeout` seconds.
+
+        Return a tuple of the item and the token of its lease.  Raise
+        IndexError if the queue is empty.
+        """
+        expiries = self._expiries
+        if expiries is None or (
+                expiries and expiries.minKey()[0] < time.time()):
+            self.reclaim()
+        item = self.pull()
+        token = uuid.uuid4().hex
+        expires = time.time() + timeout
+        self._leases[token] = (expires, item)
+        self._indexLease(token, expires)
+        return item, token
+
+    def ack(self, token):
+        """Finish the work on a leased item, ending its lease.
+
+        Raise KeyError if the item is not leased with that token any more,
+        because its lease expired and the item was reclaimed, or was
+        already acknowledged.
+        """
+        del self._leases[token]
+
+    def nack(self, token):
+        """Give a leased item back, putting it on the queue again.
+
+        Raise KeyError as `ack` does.
+        """
+        expires, item = self._leases.pop(token)
+        self.put(item)
+
+    def renew(self, token, timeout):
+        """Extend a lease to `timeout` seconds from now.
+
+        Raise KeyError as `ack` does.
+        """
+        expires, item = self._leases[token]
+        expires = time.time() + timeout
+        self._leases[token] = (expires, item)
+        self._indexLease(token, expires)
+
+    def reclaim(self):
+        """Put the items of expired leases back on the queue.
+
+        Return how many were put back.
+        """
+        now = time.time()
+        if self._expiries is None:
+            # legacy instance
+            self._expiries = OOBTree()
+            for token, (expires, item) in self._leases.items():
+                self._indexLease(token, expires)
+        expired = []
+        for key in list(self._expiries.keys(
+                max=(self._slotOf(now), math.inf))):
+            tokens = self._expiries[key]
+            kept = []
+            for token in tokens:
+                expires, item = self._leases.get(token, (None, None))
+                if expires is None or self._slotOf(expires) != key[0]:
+                    continue  # ended, or renewed into another slot
+                if expires < now:
+                    expired.append((token, item))
+                else:
+                    kept.append(token)
+            if not kept:
+                del self._expiries[key]
+            elif len(kept) != len(tokens):
+                # the slot of `now`, whose other leases are still good
+                self._expiries[key] = OOTreeSet(kept)
+        for token, item in expired:
+            del self._leases[token]
+        self.put_many(item for token, item in expired)
+        return len(expired)
+
+    def leases(self):
+        """Return an iterator of (token, expiry time, item) tuples of the
+        current leases."""
+        return ((token, expires, item)
+                for token, (expires, item) in self._leases.items())
@@ -0,0 +1,166 @@
+##############################################################################
+#
+# Copyright (c) 2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Append-only Log with Consumer Groups
+"""
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+
+from zc.queue._queue import BucketQueue
+from zc.queue._queue import CompositeQueue
+
+
+class Log(Persistent):
+    """An append-only log read by many consumer groups.
+
+    Every item put on the log is delivered to every subscribed group, and
+    the consumers of a group read and acknowledge the items in order, at
+    their own pace.  An item is written once, however many groups there
+    are: each group only keeps a cursor, the position of the first item it
+    has not acknowledged.
+
+    Items are numbered from 0 in the order they were put, and keep their
+    positions when older items are collected.  The items are kept in a
+    CompositeQueue, so a put writes the last bucket and the lengths on its
+    parent, and a read loads only the buckets that hold the items read.
+    The cursors are kept in an OOBTree, so that acknowledgements of
+    different groups, and puts, merge.  Concurrent acknowledgements of the
+    same group conflict, so each item is acknowledged once per group.
+
+    `collect` drops the buckets that every group has read past, without
+    loading them.  Run it from time to time in a transaction of its own.
+    """
+
+    def __init__(self, compositeSize=15, subfactory=BucketQueue):
+        self._items = CompositeQueue(compositeSize, subfactory)
+        # the position of the first item kept in _items
+        self._base = 0
+        self._cursors = OOBTree()
+
+    def start(self):
+        """Return the position of the first item kept."""
+        return self._base
+
+    def end(self):
+        """Return the position that the next item put will have."""
+        return self._base + len(self._items)
+
+    def put(self, item):
+        self._items.put(item)
+
+    def put_many(self, items):
+        self._items.put_many(items)
+
+    def subscribe(self, group, position=None):
+        """Add a consumer group, whose first item is at `position`.
+
+        By default the group starts at `end()`, and only gets the items put
+        from now on; pass `start()` to get all the items kept.  Raise
+        ValueError for a position outside of those, and KeyError if the
+        group is subscribed already.
+        """
+        if group in self._cursors:
+            raise KeyError(group)
+        if position is None:
+            position = self.end()
+        elif not self.start() <= position <= self.end():
+            raise ValueError(position)
+        self._cursors[group] = position
+
+    def unsubscribe(self, group):
+        """Remove a consumer group, so that it holds back no collection."""
+        del self._cursors[group]
+
+    def groups(self):
+        """Return the names of the subscribed groups."""
+        return list(self._cursors.keys())
+
+    def position(self, group):
+        """Return the position of the first item that `group` has not
+        acknowledged.
+
+        Items that were collected before a group got to them are skipped,
+        which can only happen to a group that subscribed concurrently with
+        a `collect`.
+        """
+        return max(self._cursors[group], self._base)
+
+    def pending(self, group):
+        """Return the number of items that `group` has not acknowledged."""
+        return self.end() - self.position(group)
+
+    def read(self, group, n=1):
+        """Return a list of the next `n` items of `group`, or fewer if there
+        are fewer, without acknowledging them."""
+        start = self.position(group) - self._base
+        return self._items[start:start + n]
+
+    def ack(self, group, n=1):
+        """Acknowledge the next `n` items of `group`.
+
+        Raise ValueError if the group has fewer items pending.
+        """
+        position = self.position(group)
+        if not 0 <= n <= self.end() - position:
+            raise ValueError(n)
+        if n:
+            self._cursors[group] = position + n
+
+    def pull(self, group):
+        """Read and acknowledge the next item of `group`.
+
+        Raise IndexError if there is none.
+        """
+        items = self.pull_many(group, 1)
+        if not items:
+            raise IndexError(0)
+        return items[0]
+
+    def pull_many(self, group, n):
+        """Read and acknowledge up to `n` items of `group`, and return a list
+        of them."""
+        items = self.read(group, n)
+        self.ack(group, len(items))
+        return items
+
+    def collect(self):
+        """Drop the buckets of items that every group has acknowledged, and
+        return the number of items dropped.
+
+        Without groups every bucket can go.  The last bucket, which takes
+        the puts, is always kept.
+        """
+        if self._cursors:
+            done = min(self._cursors.values()) - self._base
+        else:
+            done = len(self._items)
+        lengths = self._items._bucketLengths()
+        count = 0
+        total = 0
+        while count < len(lengths) - 1 and total + lengths[count] <= done:
+            total += lengths[count]
+            count += 1
+        if not count:
+            return 0
+        dropped = self._items._drop(count)
+        self._base += dropped
+        return dropped
+
+    def __len__(self):
+        return len(self._items)
+
+    def __bool__(self):
+        return bool(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
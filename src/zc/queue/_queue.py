@@ -13,6 +13,18 @@
 ##############################################################################
 """Queue Implementations
 """
+import array
+import bisect
+import itertools
+import math
+import threading
+import time
+import types
+import zlib
+
+import transaction
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
 from persistent import Persistent
 from ZODB.ConflictResolution import PersistentReference
 from ZODB.POSException import ConflictError
@@ -21,11 +33,122 @@ from zope import interface
 from zc.queue import interfaces
 
 
+# The queues store their state in a compact form: a tuple of the format
+# version and the values of the class's `_stateNames`, in order, with None
+# for an attribute that is not set or that has its class's value, and
+# without trailing Nones.  Any other attributes follow in a dict, after all
+# the values.  States stored as the instance dict by earlier versions load
+# as before; conflict resolution works on dicts of either.
+STATE_VERSION = 1
+
+
+def _default(cls, name):
+    # the class's value of a state attribute, None for a slot
+    value = getattr(cls, name, None)
+    if isinstance(value, types.MemberDescriptorType):
+        return None
+    return value
+
+
+def _unpackState(cls, state):
+    # Return the instance dict of a compact or legacy state, without the
+    # attributes that have their class's value.
+    if isinstance(state, dict):
+        state = dict(state)
+        for name in cls._stateNames:
+            default = _default(cls, name)
+            if default is not None and state.get(name) == default:
+                del state[name]
+        return state
+    if state[0] != STATE_VERSION:
+        raise ValueError('unknown queue state version %r' % (state[0],))
+    names = cls._stateNames
+    values = state[1:]
+    res = dict(values[len(names)]) if len(values) > len(names) else {}
+    for name, value in zip(names, values):
+        if value is not None:
+            res[name] = value
+    return res
+
+
+def _packState(cls, state):
+    # Return the compact state of an instance dict.
+    state = dict(state)
+    values = []
+    for name in cls._stateNames:
+        value = state.pop(name, None)
+        default = _default(cls, name)
+        if default is not None and value == default:
+            value = None
+        values.append(value)
+    if state:
+        values.append(state)
+    while values and values[-1] is None:
+        values.pop()
+    return (STATE_VERSION,) + tuple(values)
+
+
+class _CompactState(Persistent):
+    """Store the state in the compact form, see STATE_VERSION."""
+
+    __slots__ = ()
+
+    # the attributes stored by position
+    _stateNames = ()
+
+    # the attributes of the state that are slots
+    _slotNames = ()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        if isinstance(state, tuple):
+            instance, slots = state
+            state = dict(instance or (), **slots)
+        return _packState(type(self), self._dumpState(state))
+
+    def __setstate__(self, state):
+        state = self._loadState(_unpackState(type(self), state))
+        slots = {name: state.pop(name)
+                 for name in self._slotNames if name in state}
+        super().__setstate__((state or None, slots))
+
+    def _dumpState(self, state):
+        # adjust the instance dict before it is stored
+        return state
+
+    def _loadState(self, state):
+        # adjust the stored dict before it is loaded
+        return state
+
+    def _retire(self):
+        # make the conflict resolution refuse any concurrent change, as
+        # zc.queue.migrate.convert needs once the queue is replaced
+        self._retired = True
+
+    def _resolveState(self, kind, resolver, oldstate, committedstate,
+                      newstate, *args):
+        cls = type(self)
+        states = [_unpackState(cls, state)
+                  for state in (oldstate, committedstate, newstate)]
+        return _packState(cls, _resolve(kind, resolver, *states, *args))
+
+
 @interface.implementer(interfaces.IQueue)
-class Queue(Persistent):
+class Queue(_CompactState):
+
+    # Queues and their buckets are kept in slots rather than in an instance
+    # dict, to keep the ones in the object cache small.  Subclasses that do
+    # not declare slots get an instance dict.
+    __slots__ = ('_data', '_policy', '_retired')
+    _stateNames = ('_data', '_policy')
+    _slotNames = ('_data', '_policy', '_retired')
 
-    def __init__(self):
+    def __init__(self, conflictPolicy=None):
         self._data = ()
+        policy = _policyName(conflictPolicy)
+        if policy is not None:
+            # the name of the ConflictPolicy, unset for STRICT
+            self._policy = policy
 
     def pull(self, index=0):
         if index < 0:
@@ -40,6 +163,37 @@ class Queue(Persistent):
     def put(self, item):
         self._data += (item,)
 
+    def put_many(self, items):
+        items = tuple(items)
+        if items:
+            self._data += items
+
+    def pull_last(self):
+        res = self._data[-1]
+        self._data = self._data[:-1]
+        return res
+
+    def put_first(self, item):
+        self._data = (item,) + self._data
+
+    def pull_many(self, n):
+        res = self._data[:max(n, 0)]
+        if res:
+            self._data = self._data[len(res):]
+        return list(res)
+
+    def peek(self, n):
+        return iter(self[:max(n, 0)])
+
+    def remove(self, item):
+        self.pull(self.index(item))
+
+    def index(self, item):
+        return self._data.index(item)
+
+    def __contains__(self, item):
+        return item in self._data
+
     def __len__(self):
         return len(self._data)
 
@@ -49,24 +203,211 @@ class Queue(Persistent):
     def __getitem__(self, index):
         return self._data[index]  # works with passing a slice too
 
-    def __nonzero__(self):
+    def __bool__(self):
         return bool(self._data)
 
     def _p_resolveConflict(self, oldstate, committedstate, newstate):
-        return resolveQueueConflict(
-            oldstate, committedstate, newstate)
+        return self._resolveState(
+            'queue', resolveQueueConflict, oldstate, committedstate, newstate)
 
 
 class BucketQueue(Queue):
 
+    __slots__ = ()
+
     def _p_resolveConflict(self, oldstate, committedstate, newstate):
-        return resolveQueueConflict(
-            oldstate, committedstate, newstate, True)
+        return self._resolveState(
+            'bucket', resolveQueueConflict, oldstate, committedstate,
+            newstate, True)
 
 
 PersistentQueue = BucketQueue  # for legacy instances, be conservative
 
 
+class ArrayQueue(Queue):
+    """A Queue of integers, stored in an `array.array`.
+
+    The stored state holds the integers in their machine representation,
+    using the narrowest of 1, 2, 4 or 8 bytes that fits all of them, instead
+    of pickling each one.  Loading the state creates one array rather than an
+    object per item, which keeps the object cache small, and conflict
+    resolution compares slices of the arrays instead of building sets.
+    Items are changed in place, rather than copied into a new tuple.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, conflictPolicy=None):
+        super().__init__(conflictPolicy)
+        self._data = array.array('q')
+
+    def pull(self, index=0):
+        res = self._data[index]
+        del self._data[index]
+        self._p_changed = True
+        return res
+
+    def put(self, item):
+        self._data.append(item)
+        self._p_changed = True
+
+    def put_many(self, items):
+        data = self._data
+        count = len(data)
+        data.extend(items)
+        if len(data) != count:
+            self._p_changed = True
+
+    def pull_many(self, n):
+        n = max(n, 0)
+        res = self._data[:n].tolist()
+        if res:
+            del self._data[:n]
+            self._p_changed = True
+        return res
+
+    def pull_last(self):
+        res = self._data.pop()
+        self._p_changed = True
+        return res
+
+    def put_first(self, item):
+        self._data.insert(0, item)
+        self._p_changed = True
+
+    def _dumpState(self, state):
+        state['_data'] = _narrowArray(state['_data'])
+        return state
+
+    def _loadState(self, state):
+        state['_data'] = array.array('q', state['_data'])
+        return state
+
+    def _p_resolveConflict(self, oldstate, committedstate, newstate):
+        return self._resolveState(
+            'array', resolveArrayConflict, oldstate, committedstate,
+            newstate)
+
+
+class ArrayBucketQueue(ArrayQueue):
+    """An ArrayQueue to use as the subfactory of a CompositeQueue."""
+
+    __slots__ = ()
+
+    def _p_resolveConflict(self, oldstate, committedstate, newstate):
+        return self._resolveState(
+            'arraybucket', resolveArrayConflict, oldstate, committedstate,
+            newstate, True)
+
+
+class OffsetQueue(Queue):
+    """A `Queue` whose default pulls do not rebuild the stored tuple.
+
+    Pulling from the front only advances a consumed-head offset.  The
+    consumed items are cut off the stored tuple once they make up at least
+    half of it and number at least `compactThreshold`, so draining a queue
+    of n items copies O(n) items in total rather than O(n**2).
+
+    Consumed items stay referenced by the stored tuple until it is
+    compacted.  Pulls from any other position compact immediately.
+    """
+
+    compactThreshold = 64
+
+    _stateNames = ('_data', '_head', '_policy')
+    _head = 0
+
+    def __init__(self, conflictPolicy=None):
+        super().__init__(conflictPolicy)
+        self._head = 0
+
+    def pull(self, index=0):
+        data = self._data
+        head = self._head
+        len_self = len(data) - head
+        if index < 0:
+            index += len_self
+            if index < 0:
+                raise IndexError(index - len_self)
+        elif index >= len_self:
+            raise IndexError(index)
+        pos = head + index
+        res = data[pos]
+        if index:
+            self._data = data[head:pos] + data[pos + 1:]
+            self._head = 0
+        else:
+            self._consume(1)
+        return res
+
+    def pull_many(self, n):
+        head = self._head
+        res = self._data[head:head + max(n, 0)]
+        if res:
+            self._consume(len(res))
+        return list(res)
+
+    def pull_last(self):
+        if not self:
+            raise IndexError(-1)
+        data = self._data
+        res = data[-1]
+        if len(data) - 1 == self._head:
+            self._data = ()
+            self._head = 0
+        else:
+            self._data = data[:-1]
+        return res
+
+    def put_first(self, item):
+        self._data = (item,) + self._data[self._head:]
+        self._head = 0
+
+    def _consume(self, count):
+        # advance the head past `count` items, compacting when worthwhile
+        data = self._data
+        pos = self._head + count
+        if pos == len(data):
+            self._data = ()
+            pos = 0
+        elif pos >= self.compactThreshold and pos * 2 >= len(data):
+            self._data = data[pos:]
+            pos = 0
+        self._head = pos
+
+    def index(self, item):
+        return self._data.index(item, self._head) - self._head
+
+    def __contains__(self, item):
+        try:
+            self.index(item)
+        except ValueError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._data) - self._head
+
+    def __iter__(self):
+        data = self._data
+        for ix in range(self._head, len(data)):
+            yield data[ix]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._data[self._head:][index]
+        if index < 0:
+            index += len(self)
+            if index < 0:
+                raise IndexError(index)
+        elif index >= len(self):
+            raise IndexError(index)
+        return self._data[self._head + index]
+
+    def __bool__(self):
+        return len(self._data) > self._head
+
+
 class PersistentReferenceProxy:
     """PersistentReferenceProxy
 
@@ -75,6 +416,9 @@ class PersistentReferenceProxy:
     So we make workaround here to utilize `__cmp__` method of
     `PersistentReference`.
 
+    References that compare equal have the same oid, so we hash on that.  A
+    reference without an oid falls back to a constant hash, which is slow in
+    sets but still correct.
     """
 
     def __init__(self, pr):
@@ -82,7 +426,10 @@ class PersistentReferenceProxy:
         self.pr = pr
 
     def __hash__(self):
-        return 1
+        oid = self.pr.oid
+        if oid is None:
+            return 1
+        return hash(oid)
 
     def __eq__(self, other):
         try:
@@ -94,72 +441,516 @@ class PersistentReferenceProxy:
         return self.pr.__repr__()
 
 
-def resolveQueueConflict(oldstate, committedstate, newstate, bucket=False):
-    # we only know how to merge _data.  If anything else is different,
-    # puke.
-    if set(committedstate.keys()) != set(newstate.keys()):
-        raise ConflictError  # can't resolve
+def _wrap(x):
+    return (
+        PersistentReferenceProxy(x)
+        if isinstance(x, PersistentReference)
+        else x)
+
+
+# state keys that resolveQueueConflict merges rather than compares.  `_head`
+# is the consumed-head offset of an OffsetQueue.
+_MERGED_KEYS = frozenset(('_data', '_head'))
+
+
+def _queueData(state):
+    # the items a state actually holds, skipping an OffsetQueue's consumed
+    # head.
+    return state['_data'][state.get('_head', 0):]
+
+
+# Conflict resolution can report each of its outcomes to a collector, set
+# with setCollector.  Resolution runs in the commit path of the storage
+# server, so while no collector is set the only cost is one global lookup.
+_collector = None
+
+RESOLVED = 'resolved'
+
+
+def setCollector(collector):
+    """Report conflict resolution outcomes to `collector`, or to nobody if it
+    is None.  Return the previous collector.
+
+    Each resolution calls ``collector.record(kind, outcome, seconds, size)``.
+    `kind` names the resolver: 'queue', 'bucket', 'array', 'arraybucket',
+    'composite', 'priority', 'scheduled' or 'fanin'.
+    `outcome` is RESOLVED or the reason the conflict could not be resolved:
+    'changed-keys', 'bucket-emptied', 'both-removed', 'both-added',
+    'inserted', 'legacy-lengths', 'dropped-bucket' or 'unknown-policy'.
+    `seconds` is the time the resolution took and `size` the number of
+    entries in the new state's `_data`.  The collector may be called from
+    several threads at once.
+    """
+    global _collector
+    previous = _collector
+    _collector = collector
+    return previous
+
+
+def getCollector():
+    return _collector
+
+
+def _conflict(reason):
+    # a ConflictError that tells the collector why we gave up
+    error = ConflictError(reason)
+    error.reason = reason
+    return error
+
+
+class ConflictPolicy:
+    """Which concurrent changes the conflict resolution of a queue merges.
+
+    A queue is given a policy when it is created, and stores its name.  The
+    resolution of `Queue`, `OffsetQueue`, `ArrayQueue` and `CompositeQueue`,
+    and of the buckets of a `CompositeQueue`, relaxes the rules of STRICT
+    as the policy says:
+
+    - `duplicatePuts`: concurrent puts of equal items merge, and the queue
+      holds both, instead of conflicting with 'both-added'.
+    - `duplicatePulls`: concurrent pulls of the same item merge, and both
+      transactions have it, instead of conflicting with 'both-removed'.
+      The buckets of a CompositeQueue still conflict, because their
+      length counters would count the item twice.
+    - `emptiedBuckets`: a bucket that one transaction emptied merges with
+      the changes of the other, instead of conflicting with
+      'bucket-emptied'.  This is safe because a bucket that a
+      CompositeQueue dropped is retired, and still conflicts if it gains
+      items; it helps queues with `spread`, whose empty open buckets are
+      kept.
+
+    Queues name their policy, so a policy must be registered with
+    `registerPolicy` wherever conflicts are resolved, as on a ZEO server.
+    A queue whose policy is not registered there does not resolve
+    conflicts at all.  Whatever the policy, the items put by a transaction
+    keep their order, an item is never lost, and the changes that
+    resolveQueueConflict cannot merge, such as changes to other attributes
+    or puts between the old items, conflict.  The index of an indexed
+    CompositeQueue conflicts on concurrent puts of equal items by itself.
+    """
+
+    def __init__(self, name, duplicatePuts=False, duplicatePulls=False,
+                 emptiedBuckets=False):
+        self.name = name
+        self.duplicatePuts = duplicatePuts
+        self.duplicatePulls = duplicatePulls
+        self.emptiedBuckets = emptiedBuckets
+
+    def __repr__(self):
+        return '<ConflictPolicy %r>' % (self.name,)
+
+
+_policies = {}
+
+
+def registerPolicy(policy):
+    """Make `policy` known by its name, and return it.
+
+    Raise ValueError if another policy has that name.
+    """
+    if _policies.setdefault(policy.name, policy) is not policy:
+        raise ValueError(
+            'a conflict policy named %r exists' % (policy.name,))
+    return policy
+
+
+# Every concurrent change that could lose, duplicate or reorder an item
+# conflicts: each item is pulled by one transaction.  The default.
+STRICT = registerPolicy(ConflictPolicy('strict'))
+
+# For queues whose producers may put the same item twice, such as retried
+# jobs: concurrent puts always merge, even of equal items, which are then
+# both held.  Each item held is still pulled by one transaction.
+APPEND_ONLY = registerPolicy(ConflictPolicy(
+    'append-only', duplicatePuts=True, emptiedBuckets=True))
+
+# For consumers that tolerate seeing an item twice: concurrent puts merge
+# as with APPEND_ONLY, and concurrent pulls of the same item from a Queue
+# merge, handing it to both.  No item is lost.
+AT_LEAST_ONCE = registerPolicy(ConflictPolicy(
+    'at-least-once', duplicatePuts=True, duplicatePulls=True,
+    emptiedBuckets=True))
+
+
+def _policyName(policy):
+    # the name to store for a policy, or its name, None for STRICT
+    name = getattr(policy, 'name', policy)
+    if name is not None and name not in _policies:
+        raise ValueError('unknown conflict policy %r' % (name,))
+    return None if name == STRICT.name else name
+
+
+def _statePolicy(state):
+    # the ConflictPolicy named by a queue's state
+    name = state.get('_policy')
+    if name is None:
+        return STRICT
+    policy = _policies.get(name)
+    if policy is None:
+        raise _conflict('unknown-policy')
+    return policy
+
+
+def _resolve(kind, resolver, oldstate, committedstate, newstate, *args):
+    collector = _collector
+    if collector is None:
+        return resolver(oldstate, committedstate, newstate, *args)
+    size = len(newstate.get('_data', ()))
+    start = time.perf_counter()
+    try:
+        res = resolver(oldstate, committedstate, newstate, *args)
+    except ConflictError as e:
+        collector.record(kind, getattr(e, 'reason', 'unknown'),
+                         time.perf_counter() - start, size)
+        raise
+    collector.record(kind, RESOLVED, time.perf_counter() - start, size)
+    return res
+
+
+class Collector:
+    """An in-process collector of conflict resolution measurements.
+
+    It counts the outcomes of each kind of resolution and keeps histograms
+    of their durations and state sizes, for `snapshot` to report.  Each
+    measurement is also passed on to the `exporters`, callables taking the
+    arguments of `record`, which can forward it to a metrics system.
+    """
+
+    secondsBounds = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+    sizeBounds = (1, 10, 100, 1000, 10000, 100000)
+
+    def __init__(self, exporters=()):
+        self.exporters = list(exporters)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counts = {}
+            self._seconds = {}
+            self._sizes = {}
+
+    def record(self, kind, outcome, seconds, size):
+        with self._lock:
+            key = (kind, outcome)
+            self._counts[key] = self._counts.get(key, 0) + 1
+            histogram = self._seconds.setdefault(
+                kind, [0] * (len(self.secondsBounds) + 1))
+            histogram[bisect.bisect_left(self.secondsBounds, seconds)] += 1
+            histogram = self._sizes.setdefault(
+                kind, [0] * (len(self.sizeBounds) + 1))
+            histogram[bisect.bisect_left(self.sizeBounds, size)] += 1
+        for exporter in self.exporters:
+            exporter(kind, outcome, seconds, size)
+
+    def snapshot(self):
+        """Return the measurements so far, as a dict with
+
+        - 'counts': {(kind, outcome): count}
+        - 'seconds' and 'sizes': {kind: histogram}, where histogram[i]
+          counts the values up to secondsBounds[i] (or sizeBounds[i]) and
+          the last entry the larger ones.
+        """
+        with self._lock:
+            return dict(
+                counts=dict(self._counts),
+                seconds={k: list(v) for k, v in self._seconds.items()},
+                sizes={k: list(v) for k, v in self._sizes.items()})
+
+
+def resolveCompositeConflict(oldstate, committedstate, newstate):
+    """Resolve a conflict in the state of a CompositeQueue.
+
+    The buckets in `_data` are merged by resolveQueueConflict, and the Length
+    counters in `_lengths` follow their buckets.  The counters, like the
+    buckets, resolve their own changes, and so does the item counter in
+    `_length`.  A bucket that one transaction dropped is retired, so that a
+    change to it in the other conflicts.
+    """
+    states = (oldstate, committedstate, newstate)
+    counted = [state.pop('_length', None) for state in states]
+    lengths = [state.pop('_lengths', None) for state in states]
+    if lengths == [None, None, None]:
+        return resolveQueueConflict(oldstate, committedstate, newstate)
+    if (None in lengths or
+            any(isinstance(length, int)
+                for state_lengths in lengths for length in state_lengths) or
+            len({_wrap(length) for length in counted}) != 1):
+        # one transaction converted a legacy instance; we cannot know the
+        # old lengths without loading the buckets.
+        raise _conflict('legacy-lengths')
+    counters = {}
+    for state, state_lengths in zip(states, lengths):
+        counters.update(zip(map(_wrap, state['_data']), state_lengths))
+    res = resolveQueueConflict(oldstate, committedstate, newstate)
+    res['_lengths'] = tuple(counters[_wrap(q)] for q in res['_data'])
+    if counted[1] is not None:
+        res['_length'] = counted[1]
+    return res
+
+
+def _value(length):
+    # the value of a Length counter, or of the int that instances stored
+    # before the counters existed
+    return length if isinstance(length, int) else length()
+
+
+def _checkUnmergedKeys(committedstate, newstate):
+    # we only know how to merge _data (and the _head offset into it).  If
+    # anything else is different, puke.
+    if (set(committedstate.keys()) - _MERGED_KEYS !=
+            set(newstate.keys()) - _MERGED_KEYS):
+        raise _conflict('changed-keys')  # can't resolve
     for key, val in newstate.items():
-        if key != '_data' and val != committedstate[key]:
-            raise ConflictError  # can't resolve
+        if key not in _MERGED_KEYS and val != committedstate[key]:
+            raise _conflict('changed-keys')  # can't resolve
+
+
+def _subsequence(old, seq):
+    # Return the length of the longest prefix of `seq` that is a subsequence
+    # of `old`.
+    ix = 0
+    for value in old:
+        if ix == len(seq):
+            break
+        if value == seq[ix]:
+            ix += 1
+    return ix
+
+
+def _changes(old, seq):
+    # Return (head, kept, tail): `seq` is `head` items put at the start, the
+    # items of `old` at the positions `kept`, and the items after position
+    # `tail`, put at the end.  Equal items are told apart by position, and
+    # pulls are taken to be from the front.
+    candidates = [0]
+    old_set = set(old)
+    head = 0
+    while head < len(seq) and seq[head] not in old_set:
+        head += 1
+    if head:
+        candidates.append(head)  # put_first
+    best = None
+    for head in candidates:
+        tail = head + _subsequence(old, seq[head:])
+        if best is None or tail - head > best[1] - best[0]:
+            best = head, tail
+    head, tail = best
+    # align the kept items with the last of the equal old items that fit
+    kept = []
+    ix = len(old) - 1
+    for value in reversed(seq[head:tail]):
+        while old[ix] != value:
+            ix -= 1
+        kept.append(ix)
+        ix -= 1
+    kept.reverse()
+    return head, kept, tail
+
+
+def _resolveByPosition(policy, oldstate, committedstate, newstate, bucket):
+    # resolveQueueConflict for the policies that hold equal items more than
+    # once, which tells the items apart by their position instead of their
+    # value.
+    old = list(map(_wrap, _queueData(oldstate)))
+    committed_data = _queueData(committedstate)
+    new_data = _queueData(newstate)
+    committed_head, committed_kept, committed_tail = _changes(
+        old, list(map(_wrap, committed_data)))
+    new = list(map(_wrap, new_data))
+    new_head, new_kept, new_tail = _changes(old, new)
+    new_kept = set(new_kept)
+    if bucket or not policy.duplicatePulls:
+        removed = set(range(len(old)))
+        if not removed.difference(committed_kept).isdisjoint(
+                removed.difference(new_kept)):
+            # they both removed (claimed) the same one.  Puke.
+            raise _conflict('both-removed')  # can't resolve
+    if not policy.duplicatePuts:
+        committed_added = set(map(_wrap, committed_data[:committed_head]))
+        committed_added.update(map(_wrap, committed_data[committed_tail:]))
+        if not committed_added.isdisjoint(
+                new[:new_head] + new[new_tail:]):
+            # they both added the same one.  Puke.
+            raise _conflict('both-added')  # can't resolve
+    merged = list(new_data[:new_head])
+    merged.extend(committed_data[:committed_head])
+    merged.extend(
+        raw for raw, ix in zip(
+            committed_data[committed_head:committed_tail], committed_kept)
+        if ix in new_kept)
+    merged.extend(committed_data[committed_tail:])
+    merged.extend(new_data[new_tail:])
+    committedstate['_data'] = tuple(merged)
+    if '_head' in committedstate:
+        committedstate['_head'] = 0
+    return committedstate
+
+
+def resolveQueueConflict(oldstate, committedstate, newstate, bucket=False):
+    _checkUnmergedKeys(committedstate, newstate)
+    policy = _statePolicy(newstate)
     # basically, we are ok with anything--willing to merge--
     # unless committedstate and newstate have one or more of the
     # same deletions or additions in comparison to the oldstate.
 
     # If items in the queue are persistent object, we need to wrap
     # PersistentReference objects. See 'queue.txt'
-    def wrap(x):
-        return (
-            PersistentReferenceProxy(x)
-            if isinstance(x, PersistentReference)
-            else x)
-    old = list(map(wrap, oldstate['_data']))
-    committed = list(map(wrap, committedstate['_data']))
-    new = list(map(wrap, newstate['_data']))
-
-    old_set = set(old)
+    old_set = set(map(_wrap, _queueData(oldstate)))
+    committed_data = _queueData(committedstate)
+    committed = list(map(_wrap, committed_data))
+    new_data = _queueData(newstate)
+    new = list(map(_wrap, new_data))
     committed_set = set(committed)
     new_set = set(new)
 
-    if bucket and bool(old_set) and (bool(committed_set) ^ bool(new_set)):
+    if (bucket and not policy.emptiedBuckets and bool(old_set) and
+            (bool(committed_set) ^ bool(new_set))):
         # This is a bucket, part of a CompositePersistentQueue.  The old set
         # of this bucket had items, and one of the two transactions cleaned
         # it out.  There's a reasonable chance that this bucket will be
         # cleaned out by the parent in one of the two new transactions.
         # We can't know for sure, so we take the conservative route of
         # refusing to be resolvable.
-        raise ConflictError
+        raise _conflict('bucket-emptied')
 
-    committed_added = committed_set - old_set
-    committed_removed = old_set - committed_set
-    new_added = new_set - old_set
-    new_removed = old_set - new_set
+    if policy.duplicatePuts or policy.duplicatePulls:
+        # equal items may be held more than once: sets would lose count
+        return _resolveByPosition(
+            policy, oldstate, committedstate, newstate, bucket)
 
-    if new_removed & committed_removed:
+    new_removed = old_set - new_set
+    if ((bucket or not policy.duplicatePulls) and
+            not new_removed.isdisjoint(old_set - committed_set)):
         # they both removed (claimed) the same one.  Puke.
-        raise ConflictError  # can't resolve
-    elif new_added & committed_added:
+        raise _conflict('both-removed')  # can't resolve
+    # additions are at the start (put_first) or at the end of each
+    # sequence, in order.  If none of the old items are left, they all
+    # count as put at the end.
+    new_added = [ix for ix, v in enumerate(new) if v not in old_set]
+    if not policy.duplicatePuts and not committed_set.isdisjoint(
+            new[ix] for ix in new_added):
         # they both added the same one.  Puke.
-        raise ConflictError  # can't resolve
+        raise _conflict('both-added')  # can't resolve
+    head = 0
+    if len(new_added) < len(new):
+        while head < len(new_added) and new_added[head] == head:
+            head += 1
+    tail = len(new) - (len(new_added) - head)
+    if head < len(new_added) and new_added[head] != tail:
+        # added between the old items: not a queue operation.
+        raise _conflict('inserted')  # can't resolve
     # Now we do the merge.  We'll merge into the committed state and
-    # return it.
-    mod_committed = []
-
-    def unwrap(x):
-        return x.pr if isinstance(x, PersistentReferenceProxy) else x
-    for v in committed:
-        if v not in new_removed:
-            mod_committed.append(unwrap(v))
-    if new_added:
-        ordered_new_added = new[-len(new_added):]
-        assert set(ordered_new_added) == new_added
-        mod_committed.extend(list(map(unwrap, ordered_new_added)))
+    # return it, in one pass over each sequence.
+    mod_committed = list(new_data[:head])
+    mod_committed.extend(
+        raw for raw, v in zip(committed_data, committed)
+        if v not in new_removed)
+    mod_committed.extend(new_data[tail:])
     committedstate['_data'] = tuple(mod_committed)
+    if '_head' in committedstate:
+        # the merged data starts with the first unconsumed item
+        committedstate['_head'] = 0
     return committedstate
 
 
+def _narrowArray(data):
+    # Return the integers of the array `data` in an array of the narrowest
+    # type that holds them.
+    if data:
+        low = min(data)
+        high = max(data)
+        for typecode in ('b', 'h', 'i'):
+            limit = 1 << (array.array(typecode).itemsize * 8 - 1)
+            if -limit <= low and high < limit:
+                return array.array(typecode, data)
+    return data
+
+
+def _arrayChanges(old, data):
+    # Return (removed, added) if the array `data` is the array `old` with
+    # `removed` items pulled from the front and the array `added` put at the
+    # end, or None if it was changed in some other way.
+    if not data:
+        return len(old), data
+    try:
+        removed = old.index(data[0])
+    except ValueError:
+        removed = len(old)
+    kept = len(old) - removed
+    if data[:kept] != old[removed:]:
+        return None
+    if removed and not set(old[:removed]).isdisjoint(data[kept:]):
+        # items put back at the front, or pulled and put again
+        return None
+    return removed, data[kept:]
+
+
+def resolveArrayConflict(oldstate, committedstate, newstate, bucket=False):
+    """Resolve a conflict in the state of an ArrayQueue.
+
+    Transactions that only pulled from the front and put at the end are
+    merged by comparing slices of the arrays.  Other changes are merged by
+    resolveQueueConflict.
+    """
+    _checkUnmergedKeys(committedstate, newstate)
+    # the stored arrays may have different types, see ArrayQueue
+    old, committed, new = [
+        array.array('q', state['_data'])
+        for state in (oldstate, committedstate, newstate)]
+    policy = _statePolicy(newstate)
+    if (bucket and not policy.emptiedBuckets and old and
+            (bool(committed) ^ bool(new))):
+        # see resolveQueueConflict
+        raise _conflict('bucket-emptied')
+    committed_changes = _arrayChanges(old, committed)
+    new_changes = _arrayChanges(old, new)
+    if committed_changes is None or new_changes is None:
+        res = resolveQueueConflict(
+            oldstate, committedstate, newstate, bucket)
+        res['_data'] = _narrowArray(array.array('q', res['_data']))
+        return res
+    committed_removed, committed_added = committed_changes
+    new_removed, new_added = new_changes
+    if committed_removed and new_removed:
+        if bucket or not policy.duplicatePulls:
+            # they both pulled the first one.  Puke.
+            raise _conflict('both-removed')  # can't resolve
+        # the committed data lacks the first items that both pulled
+        new_removed = max(new_removed - committed_removed, 0)
+    if not policy.duplicatePuts and not set(committed_added).isdisjoint(
+            new_added):
+        # they both added the same one.  Puke.
+        raise _conflict('both-added')  # can't resolve
+    # the committed data less what only the new transaction removed is
+    # still a tail of the old data.
+    committedstate['_data'] = _narrowArray(
+        committed[new_removed:] + new_added)
+    return committedstate
+
+
+def _indexKey(item):
+    # Return the key of an item in the index of a CompositeQueue, or None
+    # for a persistent object without an oid.  The keys sort by a checksum
+    # of the item rather than by the item, because BTrees cannot merge the
+    # removal of a bucket's first key: with increasing ids as items, the
+    # pull of the first item would conflict with every concurrent put.  The
+    # second part keeps items of different types from being compared.
+    if isinstance(item, Persistent):
+        oid = item._p_oid
+        return None if oid is None else (zlib.crc32(oid), 2, oid)
+    if isinstance(item, int):
+        return (zlib.crc32(b'%d' % item), 0, item)
+    if isinstance(item, str):
+        return (zlib.crc32(item.encode('utf-8', 'surrogatepass')), 1, item)
+    if isinstance(item, bytes):
+        return (zlib.crc32(item), 3, item)
+    raise TypeError('an indexed queue holds ints, strings, bytes and '
+                    'persistent objects, not %r' % (item,))
+
+
 @interface.implementer(interfaces.IQueue)
-class CompositeQueue(Persistent):
+class CompositeQueue(_CompactState):
     """Appropriate for queues that may become large.
 
     Using this queue has one advantage and two possible disadvantages.
@@ -190,78 +981,1103 @@ class CompositeQueue(Persistent):
     # when two transactions happen sequentially *while* a third
     # transaction happens concurrently to both.
 
-    def __init__(self, compositeSize=15, subfactory=BucketQueue):
+    # The parent keeps a Length counter for each bucket in `_lengths`,
+    # parallel to `_data`, so that positional access and pulls can find
+    # the right bucket by loading small counters rather than the buckets.
+    # The counters are objects of their own, which resolve concurrent
+    # changes by adding them up, so a put or pull only writes its bucket
+    # and its counter: the parent only changes when buckets are added or
+    # dropped.  Instances created before `_lengths` existed have it set to
+    # None until their next put or pull.
+    _lengths = None
+
+    # The parent also counts the items in a Length counter in `_length`, so
+    # that len and bool cost the same however many buckets there are.
+    # Instances created before `_length` existed have it set to None until
+    # their next put or pull.
+    _length = None
+
+    # Opt-in automatic compaction: when set, a put or pull that leaves more
+    # than `autoCompact` times as many buckets as the items need schedules
+    # a `compact` in a separate transaction, after the current one commits.
+    autoCompact = None
+
+    # Opt-in spread placement: when set, the last `spread` buckets are kept
+    # open for puts, even while empty, and each connection puts in one of
+    # them, so that concurrent producers write different buckets.  When a
+    # producer's bucket is full, `spread` new buckets are opened after it.
+    # Items put by one connection stay in order, but items put concurrently
+    # by different connections are interleaved by bucket.
+    spread = None
+
+    # Opt-in item index: an OOBTree from the key of each item (see
+    # _indexKey) to its bucket, so that `remove`, `index` and `in` load a
+    # single bucket.  An indexed queue refuses to hold equal items twice.
+    _index = None
+
+    # the values that most instances have are left out of the stored state
+    compositeSize = 15
+    subfactory = BucketQueue
+
+    # the name of the ConflictPolicy of the queue and its buckets, None for
+    # STRICT
+    _policy = None
+
+    _stateNames = ('_data', '_lengths', '_length', 'compositeSize',
+                   'subfactory', 'spread', 'autoCompact', '_index', '_policy')
+
+    def __init__(self, compositeSize=15, subfactory=BucketQueue,
+                 autoCompact=None, spread=None, indexed=False,
+                 conflictPolicy=None):
         # the compositeSize value is a ballpark.  Because of the merging
         # policy, a composite queue might get as big as 2n under unusual
         # circumstances.  A better name for this might be "splitSize"...
         self.subfactory = subfactory
         self._data = ()
+        self._lengths = ()
+        self._length = Length()
         self.compositeSize = compositeSize
+        if autoCompact is not None:
+            self.autoCompact = autoCompact
+        if spread is not None:
+            self.spread = spread
+        if indexed:
+            self._index = OOBTree()
+        policy = _policyName(conflictPolicy)
+        if policy is not None:
+            self._policy = policy
 
-    def __nonzero__(self):
-        return bool(self._data)
+    def _newBucket(self):
+        q = self.subfactory()
+        if self._policy is not None:
+            q._policy = self._policy
+        return q
 
-    def pull(self, index=0):
-        ct = 0
+    def _lengthAt(self, cix):
+        # the length of a bucket, without loading it
+        lengths = self._lengths
+        if lengths is None:
+            return len(self._data[cix])  # legacy instance
+        return _value(lengths[cix])
+
+    def _bucketLengths(self):
+        return tuple(self._lengthAt(cix) for cix in range(len(self._data)))
+
+    def _counters(self):
+        # the Length counters of the buckets.  Legacy instances are given
+        # theirs, and the item counter, here, before their buckets change.
+        lengths = self._lengths
+        if lengths is None or (lengths and not isinstance(lengths[0], Length)):
+            lengths = self._lengths = tuple(
+                Length(length) for length in self._bucketLengths())
+        if not isinstance(self._length, Length):
+            self._length = Length(sum(length() for length in lengths))
+        return lengths
+
+    def _count(self, cix, delta):
+        # add `delta` to the length of bucket `cix` and to the item count
+        if delta:
+            self._lengths[cix].change(delta)
+            self._length.change(delta)
+
+    def _addBuckets(self, buckets, lengths=None, first=False):
+        # add buckets, with their lengths, at the start or the end
+        counters = tuple(Length(length) for length in
+                         (lengths or (0,) * len(buckets)))
+        if first:
+            self._data = tuple(buckets) + self._data
+            self._lengths = counters + self._counters()
+        else:
+            self._data += tuple(buckets)
+            self._lengths = self._counters() + counters
+
+    def _dropBuckets(self, drop):
+        # drop the buckets at the indexes `drop`.  Each is retired, so that
+        # a concurrent change to it conflicts rather than being lost.
+        counters = self._counters()
+        for cix in drop:
+            self._data[cix]._retire()
+        self._data = tuple(
+            q for cix, q in enumerate(self._data) if cix not in drop)
+        self._lengths = tuple(
+            c for cix, c in enumerate(counters) if cix not in drop)
+
+    def _locate(self, index):
+        # return (bucket index, index within bucket) for a queue index,
+        # walking the bucket lengths from the nearer end
+        count = len(self._data)
         if index < 0:
-            len_self = len(self)
-            rindex = index + len_self  # not efficient, but quick and easy
-            if rindex < 0:
-                raise IndexError(index)
+            rindex = -index - 1
+            for cix in range(count - 1, -1, -1):
+                length = self._lengthAt(cix)
+                if rindex < length:
+                    return cix, length - 1 - rindex
+                rindex -= length
         else:
             rindex = index
-        for cix, q in enumerate(self._data):
-            for ix, item in enumerate(q):
-                if rindex == ct:
-                    q.pull(ix)
-                    # take this opportunity to weed out empty
-                    # composite queues that may have been introduced
-                    # by conflict resolution merges or by this pull.
-                    self._data = tuple(q for q in self._data if q)
-                    return item
-                ct += 1
+            for cix in range(count):
+                length = self._lengthAt(cix)
+                if rindex < length:
+                    return cix, rindex
+                rindex -= length
         raise IndexError(index)
 
+    def _offset(self, cix):
+        # the queue index of the first item of bucket `cix`
+        return sum(self._lengthAt(ix) for ix in range(cix))
+
+    def __bool__(self):
+        return bool(len(self))
+
+    def _openCount(self):
+        # the number of buckets at the end that are kept while empty
+        return self.spread or 0
+
+    def _pulled(self, cix, count):
+        # count `count` items pulled from bucket `cix`, dropping it and the
+        # empty buckets at the front once empty, unless they are open (see
+        # spread)
+        self._count(cix, -count)
+        keep = len(self._data) - self._openCount()
+        drop = set()
+        while len(drop) < keep and not self._lengthAt(len(drop)):
+            drop.add(len(drop))
+        if cix < keep and not self._lengthAt(cix):
+            drop.add(cix)
+        if drop:
+            self._dropBuckets(drop)
+
+    def pull(self, index=0):
+        if index == -1:
+            return self.pull_last()
+        cix, ix = self._locate(index)
+        self._counters()
+        item = self._data[cix].pull(ix)
+        self._unindex([item])
+        self._pulled(cix, 1)
+        self._checkCompaction()
+        return item
+
+    def pull_last(self):
+        cix = len(self._data) - 1
+        while cix >= 0 and not self._lengthAt(cix):
+            cix -= 1  # skip the open buckets, see spread
+        if cix < 0:
+            raise IndexError(-1)
+        self._counters()
+        item = self._data[cix].pull_last()
+        self._unindex([item])
+        self._pulled(cix, 1)
+        self._checkCompaction()
+        return item
+
+    def put_first(self, item):
+        keys = self._newKeys([item])
+        self._counters()
+        if not self._data or self._lengthAt(0) >= self.compositeSize:
+            self._addBuckets([self._newBucket()], first=True)
+        self._data[0].put_first(item)
+        self._reindex(keys, [self._data[0]])
+        self._count(0, 1)
+        self._checkCompaction()
+
+    def _affinity(self):
+        # a connection's own open bucket, see spread
+        return hash(self._p_jar)
+
+    def _openBucket(self):
+        # return the index of this producer's open bucket, opening `spread`
+        # new buckets if there are too few or it is full
+        spread = self.spread
+        slot = self._affinity() % spread
+        cix = len(self._data) - spread + slot
+        if cix < 0 or self._lengthAt(cix) >= self.compositeSize:
+            self._addBuckets([self._newBucket() for ix in range(spread)])
+            cix = len(self._data) - spread + slot
+        return cix
+
+    def _newBuckets(self, items):
+        # return new buckets holding the items, compositeSize to a bucket,
+        # and their lengths
+        size = max(self.compositeSize, 1)
+        data = []
+        lengths = []
+        for ix in range(0, len(items), size):
+            chunk = items[ix:ix + size]
+            q = self._newBucket()
+            q.put_many(chunk)
+            data.append(q)
+            lengths.append(len(chunk))
+        return tuple(data), tuple(lengths)
+
     def put(self, item):
-        if not self._data:
-            self._data = (self.subfactory(),)
-        last = self._data[-1]
-        if len(last) >= self.compositeSize:
-            last = self.subfactory()
-            self._data += (last,)
-        last.put(item)
+        keys = self._newKeys([item])
+        self._counters()
+        if self.spread:
+            cix = self._openBucket()
+        else:
+            if (not self._data or
+                    self._lengthAt(len(self._data) - 1) >=
+                    self.compositeSize):
+                self._addBuckets([self._newBucket()])
+            cix = len(self._data) - 1
+        self._data[cix].put(item)
+        self._reindex(keys, [self._data[cix]])
+        self._count(cix, 1)
+        self._checkCompaction()
+
+    def put_many(self, items):
+        items = tuple(items)
+        if not items:
+            return
+        keys = self._newKeys(items)
+        self._counters()
+        if self.spread:
+            cix = self._openBucket()
+        elif self._data:
+            cix = len(self._data) - 1
+        else:
+            cix = None
+        data = self._data
+        start = 0
+        if cix is not None and self._lengthAt(cix) < self.compositeSize:
+            # top up the producer's bucket first
+            start = min(self.compositeSize - self._lengthAt(cix), len(items))
+            data[cix].put_many(items[:start])
+            self._count(cix, start)
+        new_data, new_lengths = self._newBuckets(items[start:])
+        if new_data and self.spread:
+            # open new buckets after the ones holding the rest of the items
+            new_data += tuple(self._newBucket() for ix in range(self.spread))
+            new_lengths += (0,) * self.spread
+        if new_data:
+            self._addBuckets(new_data, new_lengths)
+            self._length.change(len(items) - start)
+        if keys is not None:
+            buckets = [data[cix]] * start if start else []
+            for q, length in zip(new_data, new_lengths):
+                buckets.extend([q] * length)
+            self._reindex(keys, buckets)
+        self._checkCompaction()
+
+    def pull_many(self, n):
+        self._counters()
+        res = []
+        data = self._data
+        cix = 0
+        while len(res) < n and cix < len(data):
+            if self._lengthAt(cix):
+                items = data[cix].pull_many(n - len(res))
+                res.extend(items)
+                self._count(cix, -len(items))
+            cix += 1
+        if res:
+            self._unindex(res)
+            # drop the buckets that were emptied, save the open ones
+            keep = min(cix, len(data) - self._openCount())
+            drop = set()
+            while len(drop) < keep and not self._lengthAt(len(drop)):
+                drop.add(len(drop))
+            if drop:
+                self._dropBuckets(drop)
+            self._checkCompaction()
+        return res
 
     def __len__(self):
-        res = 0
+        length = self._length
+        if length is None:
+            return sum(self._bucketLengths())  # legacy instance
+        return _value(length)
+
+    def __iter__(self):
+        for q in self._data:
+            yield from q
+
+    def _islice(self, start, stop):
+        # iterate over the items from start to stop, loading only the
+        # buckets that hold them
+        offset = 0
+        for cix, q in enumerate(self._data):
+            if offset >= stop:
+                break
+            length = self._lengthAt(cix)
+            if offset + length > start:
+                yield from q[max(start - offset, 0):stop - offset]
+            offset += length
+
+    def peek(self, n):
+        return self._islice(0, n)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            positions = range(*index.indices(len(self)))
+            if not positions:
+                return []
+            if positions.step == 1:
+                return list(self._islice(positions[0], positions[-1] + 1))
+            if positions.step == -1:
+                items = list(self._islice(positions[-1], positions[0] + 1))
+                items.reverse()
+                return items
+            # a stride may skip whole buckets
+            return [self._data[cix][ix]
+                    for cix, ix in map(self._locate, positions)]
+        cix, ix = self._locate(index)
+        return self._data[cix][ix]
+
+    def _newKeys(self, items):
+        # return the index keys of items about to be put, refusing items
+        # that are already in the queue
+        if self._index is None:
+            return None
+        keys = []
+        for item in items:
+            key = _indexKey(item)
+            if key is None:
+                # a new persistent object, that needs an oid for its key
+                if self._p_jar is None:
+                    raise ValueError(
+                        'an indexed queue must be stored before it takes '
+                        'new persistent objects')
+                self._p_jar.add(item)
+                key = _indexKey(item)
+            keys.append(key)
+        if len(set(keys)) != len(keys) or any(
+                key in self._index for key in keys):
+            raise ValueError('the item is already in the queue')
+        return keys
+
+    def _reindex(self, keys, buckets):
+        if keys is not None:
+            for key, q in zip(keys, buckets):
+                self._index[key] = q
+
+    def _moved(self, items, q):
+        if self._index is not None:
+            self._reindex([_indexKey(item) for item in items],
+                          itertools.repeat(q))
+
+    def _unindex(self, items):
+        if self._index is not None:
+            for item in items:
+                del self._index[_indexKey(item)]
+
+    def _find(self, item):
+        # return (bucket index, index in the bucket) of the first item that
+        # is equal to `item`
+        if self._index is not None:
+            try:
+                key = _indexKey(item)
+            except TypeError:
+                key = None  # the index refuses such items
+            q = None if key is None else self._index.get(key)
+            if q is not None:
+                for cix, other in enumerate(self._data):
+                    if other is q:
+                        return cix, q.index(item)
+        else:
+            for cix, q in enumerate(self._data):
+                if item in q:
+                    return cix, q.index(item)
+        raise ValueError('%r is not in the queue' % (item,))
+
+    def remove(self, item):
+        self.pull(self.index(item))
+
+    def index(self, item):
+        cix, ix = self._find(item)
+        return self._offset(cix) + ix
+
+    def __contains__(self, item):
+        try:
+            self._find(item)
+        except ValueError:
+            return False
+        return True
+
+    def compact(self):
+        """Merge undersized neighboring buckets and split oversized ones.
+
+        Buckets are merged while their items fit in `compositeSize`, and
+        the items of a bucket beyond `compositeSize` are moved, from its
+        head, into new buckets before it.  The last bucket, or the last
+        `spread` buckets, which take the puts, are never merged away.
+
+        A bucket that is emptied by the merge conflicts with any concurrent
+        change to it, so no item can be lost or handed out twice.  Run this
+        in a transaction of its own to keep such conflicts rare.
+        """
+        size = max(self.compositeSize, 1)
+        data = self._data
+        lengths = self._bucketLengths()
+        counters = self._counters()
+        new_data = []
+        new_lengths = []
+        new_counters = []  # the counters of the buckets kept, or None
+        last = len(data) - max(self._openCount(), 1)
+        for cix, (q, length) in enumerate(zip(data, lengths)):
+            if length > size:
+                # fill the new buckets, and leave the remainder in q so the
+                # buckets after it can be merged into it.
+                keep = length % size or size
+                extra = q.pull_many(length - keep)
+                for ix in range(0, len(extra), size):
+                    b = self._newBucket()
+                    b.put_many(extra[ix:ix + size])
+                    self._moved(extra[ix:ix + size], b)
+                    new_data.append(b)
+                    new_lengths.append(size)
+                    new_counters.append(None)
+                length = keep
+            elif cix < last and (
+                    not length or
+                    (new_data and new_lengths[-1] + length <= size)):
+                if length:
+                    items = q.pull_many(length)
+                    new_data[-1].put_many(items)
+                    self._moved(items, new_data[-1])
+                    new_lengths[-1] += length
+                continue
+            new_data.append(q)
+            new_lengths.append(length)
+            new_counters.append(counters[cix])
+        if tuple(new_lengths) != lengths or len(new_data) != len(data):
+            kept = {id(counter): length for counter, length in
+                    zip(new_counters, new_lengths) if counter is not None}
+            for q, counter, length in zip(data, counters, lengths):
+                if id(counter) not in kept:
+                    q._retire()  # merged away
+                elif kept[id(counter)] != length:
+                    counter.change(kept[id(counter)] - length)
+            self._data = tuple(new_data)
+            self._lengths = tuple(
+                Length(length) if counter is None else counter
+                for length, counter in zip(new_lengths, new_counters))
+
+    def _drop(self, count):
+        # drop the first `count` buckets of an unindexed queue whole,
+        # without loading them, and return the number of items they held
+        counters = self._counters()
+        dropped = sum(self._bucketLengths()[:count])
+        self._data = self._data[count:]
+        self._lengths = counters[count:]
+        self._length.change(-dropped)
+        return dropped
+
+    def _checkCompaction(self):
+        # schedule a compaction after the commit if autoCompact asks for it
+        if self.autoCompact is None or self._p_oid is None:
+            return
+        needed = -(-len(self) // max(self.compositeSize, 1))
+        if len(self._data) <= (
+                self.autoCompact * max(needed, 1) + self._openCount()):
+            return
+        txn = self._p_jar.transaction_manager.get()
+        if getattr(self, '_v_compacting', None) is txn:
+            return
+        self._v_compacting = txn
+        txn.addAfterCommitHook(
+            _compactAfterCommit, (self._p_jar.db(), self._p_oid))
+
+    def _retire(self):
+        # a put into a bucket that is not full only changes the bucket
+        self._retired = True
         for q in self._data:
-            res += len(q)
+            q._retire()
+
+    def _p_resolveConflict(self, oldstate, committedstate, newstate):
+        return self._resolveState(
+            'composite', resolveCompositeConflict, oldstate, committedstate,
+            newstate)
+
+
+CompositePersistentQueue = CompositeQueue  # legacy
+
+
+def _compactAfterCommit(status, db, oid):
+    # compact a CompositeQueue in a transaction of its own.  If that
+    # conflicts, give up: a later put or pull will try again.
+    if not status:
+        return
+    tm = transaction.TransactionManager()
+    conn = db.open(transaction_manager=tm)
+    try:
+        conn.get(oid).compact()
+        tm.commit()
+    except ConflictError:
+        tm.abort()
+    finally:
+        conn.close()
+
+
+def resolvePriorityConflict(oldstate, committedstate, newstate):
+    """Resolve a conflict in the state of a PriorityQueue.
+
+    The only change a PriorityQueue makes to its own state is to add a
+    queue for a new priority, so we merge the priorities that the two
+    transactions added, unless they both added the same one.
+    """
+    if set(committedstate.keys()) != set(newstate.keys()):
+        raise _conflict('changed-keys')  # can't resolve
+    for key, val in newstate.items():
+        if key not in ('_priorities', '_data') and val != committedstate[key]:
+            raise _conflict('changed-keys')  # can't resolve
+    old = set(oldstate['_priorities'])
+    merged = dict(zip(committedstate['_priorities'], committedstate['_data']))
+    for priority, q in zip(newstate['_priorities'], newstate['_data']):
+        if priority not in old:
+            if priority in merged:
+                # they both added a queue for the same priority.  Puke.
+                raise _conflict('both-added')  # can't resolve
+            merged[priority] = q
+    priorities = sorted(merged)
+    committedstate['_priorities'] = tuple(priorities)
+    committedstate['_data'] = tuple(merged[p] for p in priorities)
+    return committedstate
+
+
+@interface.implementer(interfaces.IQueue)
+class PriorityQueue(Persistent):
+    """A queue that hands out items by priority, lowest value first.
+
+    Items of the same priority are kept in a CompositeQueue of their own,
+    in order, so putting or pulling an item only touches the queue of its
+    priority.  The PriorityQueue itself only changes when an item is put
+    at a priority it has not seen before; its conflict resolution merges
+    concurrent additions of different priorities.
+
+    The queues of priorities that become empty are kept, so that a pull
+    cannot race with a put at the same priority.  Priorities are meant to
+    be a small set of classes of urgency, not a value per item.
+    """
+
+    def __init__(self, compositeSize=15, subfactory=BucketQueue):
+        self.compositeSize = compositeSize
+        self.subfactory = subfactory
+        self._priorities = ()
+        self._data = ()
+
+    def _queueFor(self, priority):
+        ix = bisect.bisect_left(self._priorities, priority)
+        if ix < len(self._priorities) and self._priorities[ix] == priority:
+            return self._data[ix]
+        q = CompositeQueue(self.compositeSize, self.subfactory)
+        self._priorities = (
+            self._priorities[:ix] + (priority,) + self._priorities[ix:])
+        self._data = self._data[:ix] + (q,) + self._data[ix:]
+        return q
+
+    def put(self, item, priority=0):
+        self._queueFor(priority).put(item)
+
+    def put_many(self, items, priority=0):
+        self._queueFor(priority).put_many(items)
+
+    def put_first(self, item, priority=0):
+        """Put an item before the other items of its priority."""
+        self._queueFor(priority).put_first(item)
+
+    def pull_last(self):
+        """Remove and return the last item of the worst priority."""
+        for q in reversed(self._data):
+            if q:
+                return q.pull_last()
+        raise IndexError(-1)
+
+    def _locate(self, index):
+        # stop at the first queue that holds the index, unless it counts
+        # from the end
+        rindex = index + len(self) if index < 0 else index
+        if rindex >= 0:
+            for q in self._data:
+                length = len(q)
+                if rindex < length:
+                    return q, rindex
+                rindex -= length
+        raise IndexError(index)
+
+    def pull(self, index=0):
+        """Remove and return an item, by default the first one of the best
+        priority."""
+        q, ix = self._locate(index)
+        return q.pull(ix)
+
+    def pull_many(self, n):
+        res = []
+        for q in self._data:
+            if len(res) >= n:
+                break
+            res.extend(q.pull_many(n - len(res)))
         return res
 
+    def peek(self, n):
+        return itertools.islice(self, max(n, 0))
+
+    def _find(self, item):
+        # return (queue, index in the queue) of the first equal item
+        for q in self._data:
+            if item in q:
+                return q, q.index(item)
+        raise ValueError('%r is not in the queue' % (item,))
+
+    def remove(self, item):
+        q, ix = self._find(item)
+        q.pull(ix)
+
+    def index(self, item):
+        q, ix = self._find(item)
+        for other in self._data:
+            if other is q:
+                return ix
+            ix += len(other)
+
+    def __contains__(self, item):
+        return any(item in q for q in self._data)
+
+    def priorities(self):
+        """Return the priorities that have items, best first."""
+        return [p for p, q in zip(self._priorities, self._data) if q]
+
+    def __len__(self):
+        return sum(len(q) for q in self._data)
+
     def __iter__(self):
         for q in self._data:
             yield from q
 
     def __getitem__(self, index):
-        # not efficient, but quick and easy
         if isinstance(index, slice):
-            # We do this the easy way instead of attempting to handle
-            # negative strides ourself
             return list(self)[index]
+        q, ix = self._locate(index)
+        return q[ix]
 
-        if index < 0:
-            len_self = len(self)
-            rindex = index + len_self
-            if rindex < 0:
-                raise IndexError(index)
+    def __bool__(self):
+        return any(self._data)
+
+    def _retire(self):
+        # puts at a known priority only change its queue
+        self._retired = True
+        for q in self._data:
+            q._retire()
+
+    def _p_resolveConflict(self, oldstate, committedstate, newstate):
+        return _resolve(
+            'priority', resolvePriorityConflict, oldstate, committedstate,
+            newstate)
+
+
+@interface.implementer(interfaces.IQueue)
+class ShardedQueue(Persistent):
+    """A queue of independent shards, for many concurrent consumers.
+
+    Every consumer of a CompositeQueue pulls from its first bucket, so most
+    of their commits conflict.  A ShardedQueue spreads its items over
+    several CompositeQueues instead.  Producers put items on the shards in
+    turn, or by the hash of a key, and consumers use `take`, which prefers
+    a shard of their own and only steals from the others when it is empty.
+
+    The queue is not FIFO across shards: the positional API (`pull`,
+    `__getitem__`, `__iter__`) sees the shards one after the other.
+    """
+
+    def __init__(self, shards=4, compositeSize=15, subfactory=BucketQueue):
+        self._shards = tuple(
+            CompositeQueue(compositeSize, subfactory) for ix in range(shards))
+
+    def _nextShard(self):
+        # round-robin per connection, without writing to the database
+        ix = getattr(self, '_v_next', 0)
+        self._v_next = (ix + 1) % len(self._shards)
+        return self._shards[ix]
+
+    def _shardFor(self, key):
+        if key is None:
+            return self._nextShard()
+        # the checksum of the index key is the same in every process,
+        # unlike the hash of a string
+        try:
+            checksum = _indexKey(key)
+        except TypeError:
+            checksum = None
+        if checksum is None:
+            raise TypeError('a shard key is an int, string, bytes or stored '
+                            'persistent object, not %r' % (key,))
+        return self._shards[checksum[0] % len(self._shards)]
+
+    def put(self, item, key=None):
+        """Put an item on a shard: the next one in turn, or the one for
+        `key`, so that items with the same key stay in order.
+
+        The shard of a key is the same in every process."""
+        self._shardFor(key).put(item)
+
+    def put_many(self, items, key=None):
+        if key is not None:
+            self._shardFor(key).put_many(items)
+            return
+        items = tuple(items)
+        count = len(self._shards)
+        start = getattr(self, '_v_next', 0)
+        for ix in range(min(count, len(items))):
+            self._shards[(start + ix) % count].put_many(items[ix::count])
+        self._v_next = (start + len(items)) % count
+
+    def put_first(self, item, key=None):
+        """Put an item before the other items of a shard, chosen as `put`
+        does."""
+        self._shardFor(key).put_first(item)
+
+    def pull_last(self):
+        for shard in reversed(self._shards):
+            if shard:
+                return shard.pull_last()
+        raise IndexError(-1)
+
+    def _affinity(self):
+        # a connection's own shard, so that consumers with a connection
+        # each spread over the shards
+        return hash(self._p_jar)
+
+    def take(self, affinity=None):
+        """Remove and return the first item of a shard.
+
+        The shard is chosen by `affinity`, an integer, which defaults to one
+        derived from the connection.  If that shard is empty, take from the
+        next non-empty one.  Raise IndexError if all are empty.
+        """
+        if affinity is None:
+            affinity = self._affinity()
+        count = len(self._shards)
+        for ix in range(count):
+            shard = self._shards[(affinity + ix) % count]
+            if shard:
+                return shard.pull()
+        raise IndexError(0)
+
+    def _locate(self, index):
+        # stop at the first shard that holds the index, unless it counts
+        # from the end
+        rindex = index + len(self) if index < 0 else index
+        if rindex >= 0:
+            for shard in self._shards:
+                length = len(shard)
+                if rindex < length:
+                    return shard, rindex
+                rindex -= length
+        raise IndexError(index)
+
+    def pull(self, index=0):
+        shard, ix = self._locate(index)
+        return shard.pull(ix)
+
+    def pull_many(self, n):
+        res = []
+        for shard in self._shards:
+            if len(res) >= n:
+                break
+            res.extend(shard.pull_many(n - len(res)))
+        return res
+
+    def _find(self, item):
+        # return (shard, index in the shard) of the first equal item
+        for shard in self._shards:
+            if item in shard:
+                return shard, shard.index(item)
+        raise ValueError('%r is not in the queue' % (item,))
+
+    def remove(self, item):
+        shard, ix = self._find(item)
+        shard.pull(ix)
+
+    def index(self, item):
+        shard, ix = self._find(item)
+        for other in self._shards:
+            if other is shard:
+                return ix
+            ix += len(other)
+
+    def __contains__(self, item):
+        return any(item in shard for shard in self._shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def __iter__(self):
+        for shard in self._shards:
+            yield from shard
+
+    def peek(self, n):
+        return itertools.islice(self, max(n, 0))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        shard, ix = self._locate(index)
+        return shard[ix]
+
+    def __bool__(self):
+        return any(self._shards)
+
+    def _retire(self):
+        for shard in self._shards:
+            shard._retire()
+
+
+def resolveScheduledConflict(oldstate, committedstate, newstate):
+    """Resolve a conflict in the state of a ScheduledQueue.
+
+    A ScheduledQueue keeps its slots in a BTree of their own, and is only
+    written when a slot is added, so that it conflicts with a queue that
+    was retired meanwhile; such writes do not change it.
+
+    Instances that predate the BTree keep the times, queues and lengths of
+    their slots in tuples.  The slots that either transaction dropped are
+    dropped and the slots that either added are added, so two slots for the
+    same time may end up side by side.  The lengths of the slots are merged
+    as counters, and the slots that end up empty are dropped.  The queues
+    of the slots resolve their own states.
+    """
+    if set(committedstate.keys()) != set(newstate.keys()):
+        raise _conflict('changed-keys')  # can't resolve
+    if '_slots' in committedstate:
+        if '_slots' not in oldstate or '_retired' in committedstate:
+            raise _conflict('changed-keys')  # converted, or retired
+        return committedstate
+    for key, val in newstate.items():
+        if (key not in ('_times', '_data', '_lengths') and
+                val != committedstate[key]):
+            raise _conflict('changed-keys')  # can't resolve
+    states = (oldstate, committedstate, newstate)
+    old, committed, new = [
+        {_wrap(q): length
+         for q, length in zip(state['_data'], state['_lengths'])}
+        for state in states]
+    for key, old_len in old.items():
+        # a slot that one transaction dropped as empty must not have gained
+        # items in the other, or the items would be lost.
+        if ((key not in committed and new.get(key, 0) > old_len) or
+                (key not in new and committed.get(key, 0) > old_len)):
+            raise _conflict('dropped-bucket')
+    slots = []
+    for when, q, length in zip(committedstate['_times'],
+                               committedstate['_data'],
+                               committedstate['_lengths']):
+        key = _wrap(q)
+        if key in old:
+            if key not in new:
+                continue  # the new transaction dropped it
+            length += new[key] - old[key]
+        if length:
+            slots.append((when, q, length))
+    for when, q, length in zip(newstate['_times'], newstate['_data'],
+                               newstate['_lengths']):
+        if _wrap(q) not in old and length:
+            slots.append((when, q, length))
+    slots.sort(key=lambda slot: slot[0])  # stable: committed ones first
+    committedstate['_times'] = tuple(slot[0] for slot in slots)
+    committedstate['_data'] = tuple(slot[1] for slot in slots)
+    committedstate['_lengths'] = tuple(slot[2] for slot in slots)
+    return committedstate
+
+
+@interface.implementer(interfaces.IQueue)
+class ScheduledQueue(Persistent):
+    """A queue of items that must not be pulled before a time of their own.
+
+    `put` takes the time, in seconds since the epoch, at which an item
+    becomes due.  Times are rounded up to a multiple of `granularity`, and
+    the items of each such slot are kept in a CompositeQueue of their own.
+    Pulls, len, iteration and indexing only see the items of the slots that
+    are due, ordered by slot and then by when they were put.  Items put
+    without a time are due at once, before all the others.
+
+    The slots are kept in an OOBTree keyed by their time, so finding the
+    due items is a range search that loads none of the future ones, and a
+    put or pull only writes the queue of its slot.  A new slot is also
+    stored in the BTree, and a slot that becomes empty is dropped from it.
+    Concurrent puts at any times merge: connections that add a slot for the
+    same time at once add one each, side by side.
+    """
+
+    # Instances created before `_slots` existed keep the times, queues and
+    # lengths of their slots in the tuples `_times`, `_data` and `_lengths`,
+    # until their next put or pull moves them to `_slots`.
+    _slots = None
+
+    def __init__(self, granularity=1.0, compositeSize=15,
+                 subfactory=BucketQueue):
+        self.granularity = granularity
+        self.compositeSize = compositeSize
+        self.subfactory = subfactory
+        self._slots = OOBTree()
+
+    def _affinity(self):
+        # tells apart the slots that connections add for the same time
+        return hash(self._p_jar)
+
+    def _slotItems(self, due=True):
+        # the (key, queue) pairs of the slots, or of the due ones, in order.
+        # The keys are (time, affinity) pairs.
+        if self._slots is None:
+            # legacy instance
+            count = len(self._times)
+            if due:
+                count = bisect.bisect_right(self._times, time.time())
+            return [((when, ix), q) for ix, (when, q) in
+                    enumerate(zip(self._times[:count], self._data))]
+        if due:
+            return self._slots.items(max=(time.time(), math.inf))
+        return self._slots.items()
+
+    def _tree(self):
+        # the BTree of the slots, that legacy instances move their slots to
+        if self._slots is None:
+            slots = OOBTree(self._slotItems(due=False))
+            del self._times, self._data, self._lengths
+            self._slots = slots
+        return self._slots
+
+    def _slotFor(self, not_before):
+        # the queue of the slot for the due time, added if needed
+        if not_before is None:
+            when = 0
         else:
-            rindex = index
-        for ix, v in enumerate(self):
-            if ix == rindex:
-                return v
+            when = math.ceil(not_before / self.granularity) * self.granularity
+        slots = self._tree()
+        for q in slots.values(min=(when,), max=(when, math.inf)):
+            return q
+        q = slots[(when, self._affinity())] = CompositeQueue(
+            self.compositeSize, self.subfactory)
+        self._p_changed = True  # see resolveScheduledConflict
+        return q
+
+    def _pulled(self, key, q):
+        # drop the slot of `q` if it is empty.  Its queue is retired, so that
+        # a concurrent put in it conflicts rather than being lost.
+        if not q:
+            del self._slots[key]
+            q._retire()
+
+    def put(self, item, not_before=None):
+        """Put an item that must not be pulled before the time `not_before`,
+        or that is due at once if it is None."""
+        self._slotFor(not_before).put(item)
+
+    def put_many(self, items, not_before=None):
+        items = tuple(items)
+        if items:
+            self._slotFor(not_before).put_many(items)
+
+    def put_first(self, item):
+        """Put an item that is due at once, before all the others."""
+        self._slotFor(None).put_first(item)
+
+    def pull_last(self):
+        """Remove and return the last due item."""
+        self._tree()
+        for key, q in reversed(list(self._slotItems())):
+            if q:
+                res = q.pull_last()
+                self._pulled(key, q)
+                return res
+        raise IndexError(-1)
+
+    def _locate(self, index):
+        # return (slot key, queue, index in the slot) of a due item
+        slots = self._slotItems()
+        rindex = index
+        if index < 0:
+            slots = reversed(list(slots))
+            rindex = -index - 1
+        for key, q in slots:
+            length = len(q)
+            if rindex < length:
+                return key, q, rindex if index >= 0 else length - 1 - rindex
+            rindex -= length
         raise IndexError(index)
 
-    def _p_resolveConflict(self, oldstate, committedstate, newstate):
-        return resolveQueueConflict(oldstate, committedstate, newstate)
+    def pull(self, index=0):
+        """Remove and return a due item, by default the first one."""
+        self._tree()
+        key, q, pos = self._locate(index)
+        res = q.pull(pos)
+        self._pulled(key, q)
+        return res
 
+    def pull_many(self, n):
+        self._tree()
+        res = []
+        for key, q in list(self._slotItems()):
+            if len(res) >= n:
+                break
+            res.extend(q.pull_many(n - len(res)))
+            self._pulled(key, q)
+        return res
 
-CompositePersistentQueue = CompositeQueue  # legacy
+    def peek(self, n):
+        return itertools.islice(self, max(n, 0))
+
+    def _find(self, item, slots):
+        # return (slot key, queue, index in the slot) of the first equal item
+        # in `slots`
+        for key, q in slots:
+            if item in q:
+                return key, q, q.index(item)
+        raise ValueError('%r is not in the queue' % (item,))
+
+    def remove(self, item):
+        """Remove the first item that is equal to `item`, whether it is
+        due or not, so that scheduled items can be cancelled."""
+        self._tree()
+        key, q, pos = self._find(item, self._slotItems(due=False))
+        q.pull(pos)
+        self._pulled(key, q)
+
+    def index(self, item):
+        offset = 0
+        for key, q in self._slotItems():
+            if item in q:
+                return offset + q.index(item)
+            offset += len(q)
+        raise ValueError('%r is not in the queue' % (item,))
+
+    def __contains__(self, item):
+        return any(item in q for key, q in self._slotItems())
+
+    def nextDue(self):
+        """Return the time at which the next slot becomes due, or None if
+        there are no items that are not due yet."""
+        if self._slots is None:
+            due = bisect.bisect_right(self._times, time.time())
+            return self._times[due] if due < len(self._times) else None
+        for when, affinity in self._slots.keys(
+                min=(time.time(), math.inf), excludemin=True):
+            return when
+        return None
+
+    def __len__(self):
+        return sum(len(q) for key, q in self._slotItems())
+
+    def __iter__(self):
+        for key, q in self._slotItems():
+            yield from q
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        key, q, pos = self._locate(index)
+        return q[pos]
+
+    def __bool__(self):
+        return any(q for key, q in self._slotItems())
+
+    def _retire(self):
+        # a put in an existing slot only changes the queue of the slot
+        self._retired = True
+        for key, q in self._slotItems(due=False):
+            q._retire()
+
+    def _p_resolveConflict(self, oldstate, committedstate, newstate):
+        return _resolve(
+            'scheduled', resolveScheduledConflict, oldstate, committedstate,
+            newstate)
@@ -0,0 +1,352 @@
+##############################################################################
+#
+# Copyright (c) 2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Queue Benchmarks
+
+Run ``python -m zc.queue.benchmark --help`` for the options.  Each
+measurement is written as one line of JSON, so that results can be kept and
+compared between runs.
+"""
+import argparse
+import io
+import json
+import os
+import pickle
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import transaction
+from persistent import Persistent
+from ZODB import DB
+from ZODB.DemoStorage import DemoStorage
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+
+from zc.queue import _queue
+
+
+FACTORIES = {
+    'Queue': lambda compositeSize: _queue.Queue(),
+    'OffsetQueue': lambda compositeSize: _queue.OffsetQueue(),
+    'BucketQueue': lambda compositeSize: _queue.BucketQueue(),
+    'ArrayQueue': lambda compositeSize: _queue.ArrayQueue(),
+    'CompositeQueue': _queue.CompositeQueue,
+    'ArrayCompositeQueue': lambda compositeSize: _queue.CompositeQueue(
+        compositeSize, _queue.ArrayBucketQueue),
+    'SpreadCompositeQueue': lambda compositeSize: _queue.CompositeQueue(
+        compositeSize, spread=4),
+}
+
+# only these factories use compositeSize
+COMPOSITE = frozenset(
+    ['CompositeQueue', 'ArrayCompositeQueue', 'SpreadCompositeQueue'])
+
+
+def instrument(storage):
+    """Count the bytes stored and the conflict resolutions of a storage.
+
+    Must be called before the storage is passed to a DB.  Return a dict of
+    counters that the storage updates from then on.
+    """
+    stats = dict(stores=0, bytes=0, resolved=0, unresolved=0,
+                 resolve_seconds=0.0)
+    store = storage.store
+    resolve = storage.tryToResolveConflict
+
+    def counting_store(oid, serial, data, version, transaction):
+        stats['stores'] += 1
+        stats['bytes'] += len(data)
+        return store(oid, serial, data, version, transaction)
+
+    def timed_resolve(*args, **kw):
+        start = time.perf_counter()
+        try:
+            res = resolve(*args, **kw)
+        except ConflictError:
+            stats['unresolved'] += 1
+            raise
+        else:
+            stats['resolved'] += 1
+            return res
+        finally:
+            stats['resolve_seconds'] += time.perf_counter() - start
+
+    storage.store = counting_store
+    storage.tryToResolveConflict = timed_resolve
+    return stats
+
+
+class Environment:
+    """A fresh, instrumented database on one of the storage backends."""
+
+    def __init__(self, backend):
+        self.directory = None
+        if backend == 'memory':
+            storage = DemoStorage()
+        elif backend == 'file':
+            self.directory = tempfile.mkdtemp(prefix='zc.queue.benchmark')
+            storage = FileStorage(os.path.join(self.directory, 'Data.fs'))
+        else:
+            raise ValueError(backend)
+        self.stats = instrument(storage)
+        self.db = DB(storage)
+
+    def open(self):
+        tm = transaction.TransactionManager()
+        return tm, self.db.open(transaction_manager=tm)
+
+    def close(self):
+        self.db.close()
+        if self.directory is not None:
+            shutil.rmtree(self.directory)
+
+
+def _timed(name, ops, seconds, **info):
+    info.update(
+        benchmark=name, ops=ops, seconds=seconds,
+        ops_per_second=ops / seconds if seconds else None)
+    return info
+
+
+def throughput(env, factory, size, compositeSize, commitEvery, reps):
+    """Measure the basic operations on a queue of `size` items.
+
+    Puts and pulls are committed every `commitEvery` operations.  Reads are
+    made on a connection whose cache was just emptied.
+    """
+    stats = env.stats
+    tm, conn = env.open()
+    q = conn.root()['queue'] = factory(compositeSize)
+    tm.commit()
+    results = []
+
+    def committed(name, op):
+        bytes_before = stats['bytes']
+        commits = 0
+        start = time.perf_counter()
+        for ix in range(size):
+            op(ix)
+            if not (ix + 1) % commitEvery or ix + 1 == size:
+                tm.commit()
+                commits += 1
+        seconds = time.perf_counter() - start
+        results.append(_timed(
+            name, size, seconds, commits=commits,
+            bytes_per_commit=(stats['bytes'] - bytes_before) / commits))
+
+    def cold(name, ops, op):
+        conn.cacheMinimize()
+        start = time.perf_counter()
+        for ix in range(ops):
+            op(ix)
+        results.append(_timed(name, ops, time.perf_counter() - start))
+
+    committed('put', q.put)
+    cold('len', reps, lambda ix: len(q))
+    cold('iter', 1, lambda ix: sum(1 for item in q))
+    indexes = [random.randrange(size) for ix in range(reps)]
+    cold('index', reps, lambda ix: q[indexes[ix]])
+    committed('pull', lambda ix: q.pull())
+    conn.close()
+    return results
+
+
+def contention(env, factory, size, compositeSize, connections, rounds):
+    """Run concurrent producers and consumers on separate connections.
+
+    Every round, each connection puts an item (even connections) or pulls
+    the first item (odd connections), and then they all commit in turn, so
+    each commit but the first has to be resolved against the others.
+    """
+    stats = env.stats
+    tm, conn = env.open()
+    conn.root()['queue'] = q = factory(compositeSize)
+    q.put_many(range(size))
+    tm.commit()
+    conn.close()
+    workers = [env.open() for ix in range(connections)]
+    before = dict(stats)
+    commits = conflicts = 0
+    item = size
+    start = time.perf_counter()
+    for ignored in range(rounds):
+        for ix, (tm, conn) in enumerate(workers):
+            q = conn.root()['queue']
+            if ix % 2:
+                if q:
+                    q.pull()
+            else:
+                q.put(item)
+                item += 1
+        for tm, conn in workers:
+            try:
+                tm.commit()
+            except ConflictError:
+                tm.abort()
+                conflicts += 1
+            else:
+                commits += 1
+    seconds = time.perf_counter() - start
+    for tm, conn in workers:
+        conn.close()
+    return [_timed(
+        'contention', commits + conflicts, seconds,
+        connections=connections, rounds=rounds, commits=commits,
+        conflicts=conflicts,
+        resolved=stats['resolved'] - before['resolved'],
+        unresolved=stats['unresolved'] - before['unresolved'],
+        resolve_seconds=stats['resolve_seconds'] - before['resolve_seconds'],
+    )]
+
+
+def _dumps(state):
+    # pickle a state as ZODB does, with persistent objects by reference
+    f = io.BytesIO()
+    pickler = pickle.Pickler(f, 3)
+    pickler.persistent_id = lambda obj: (
+        obj._p_oid if isinstance(obj, Persistent) else None)
+    pickler.dump(state)
+    return f.getvalue()
+
+
+def _loads(data):
+    unpickler = pickle.Unpickler(io.BytesIO(data))
+    unpickler.persistent_load = lambda oid: oid
+    return unpickler.load()
+
+
+def states(env, factory, size, compositeSize, reps):
+    """Compare the stored state of a queue of `size` items in the compact
+    form with the instance dict that earlier versions stored.
+
+    Measure the bytes of the state, and the time taken to unpickle it and
+    to resolve a conflict between three copies of it, `reps` times, for the
+    queue and for its first bucket, if it has buckets.
+    """
+    tm, conn = env.open()
+    q = conn.root()['queue'] = factory(compositeSize)
+    q.put_many(range(size))
+    tm.commit()
+    records = [('parent', q)]
+    if isinstance(q, _queue.CompositeQueue) and q._data:
+        records.append(('bucket', q._data[0]))
+    results = []
+    for record, obj in records:
+        legacy = Persistent.__getstate__(obj)
+        if isinstance(legacy, tuple):
+            instance, slots = legacy
+            legacy = dict(instance or (), **slots)
+        legacy = obj._dumpState(legacy)
+        info = dict(record=record)
+        compact = obj.__getstate__()
+        for form, state in (('legacy', legacy), ('compact', compact)):
+            data = _dumps(state)
+            start = time.perf_counter()
+            for ix in range(reps):
+                _loads(data)
+            loaded = time.perf_counter()
+            for ix in range(reps):
+                obj._p_resolveConflict(
+                    _loads(data), _loads(data), _loads(data))
+            info[form + '_bytes'] = len(data)
+            info[form + '_load_seconds'] = loaded - start
+            info[form + '_resolve_seconds'] = time.perf_counter() - loaded
+        results.append(_timed(
+            'states', reps,
+            info['compact_load_seconds'] + info['compact_resolve_seconds'],
+            **info))
+    conn.close()
+    return results
+
+
+def run(classes, backends, sizes, compositeSizes, commitEvery=10, reps=100,
+        connections=4, rounds=50):
+    """Run the benchmarks, yielding a dict for each measurement."""
+    for backend in backends:
+        for name in classes:
+            factory = FACTORIES[name]
+            for size in sizes:
+                for compositeSize in (
+                        compositeSizes if name in COMPOSITE else [None]):
+                    info = dict(
+                        queue=name, backend=backend, size=size,
+                        compositeSize=compositeSize)
+                    for benchmark, args in (
+                            (throughput, (commitEvery, reps)),
+                            (contention, (connections, rounds)),
+                            (states, (reps,))):
+                        env = Environment(backend)
+                        try:
+                            results = benchmark(
+                                env, factory, size, compositeSize, *args)
+                        finally:
+                            env.close()
+                        for result in results:
+                            result.update(info)
+                            yield result
+
+
+def _list(convert):
+    return lambda value: [convert(v) for v in value.split(',')]
+
+
+def main(argv=None, out=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m zc.queue.benchmark',
+        description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--classes', type=_list(str), default=sorted(FACTORIES),
+        help='comma-separated queue classes (default: all of %(default)s)')
+    parser.add_argument(
+        '--backends', type=_list(str), default=['memory', 'file'],
+        help='comma-separated storage backends: memory, file')
+    parser.add_argument(
+        '--sizes', type=_list(int), default=[100, 1000, 10000],
+        help='comma-separated queue sizes')
+    parser.add_argument(
+        '--composite-sizes', type=_list(int), default=[15, 100, 1000],
+        help='comma-separated compositeSize values for CompositeQueue')
+    parser.add_argument(
+        '--commit-every', type=int, default=10,
+        help='operations per commit when putting and pulling')
+    parser.add_argument(
+        '--reps', type=int, default=100,
+        help='repetitions of the len and index measurements')
+    parser.add_argument(
+        '--connections', type=int, default=4,
+        help='concurrent connections in the contention scenario')
+    parser.add_argument(
+        '--rounds', type=int, default=50,
+        help='rounds of the contention scenario')
+    options = parser.parse_args(argv)
+    unknown = set(options.classes) - set(FACTORIES)
+    if unknown:
+        parser.error('unknown classes: %s' % ', '.join(sorted(unknown)))
+    unknown = set(options.backends) - {'memory', 'file'}
+    if unknown:
+        parser.error('unknown backends: %s' % ', '.join(sorted(unknown)))
+    if out is None:
+        out = sys.stdout
+    for result in run(
+            options.classes, options.backends, options.sizes,
+            options.composite_sizes, options.commit_every, options.reps,
+            options.connections, options.rounds):
+        out.write(json.dumps(result, sort_keys=True) + '\n')
+        out.flush()
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
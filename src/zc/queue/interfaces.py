@@ -28,6 +28,48 @@ class IQueue(IPersistent):
         Raise IndexError if index does not exist.
         """
 
+    def put_many(items):
+        """Put the items of an iterable on the end of the queue, in order.
+
+        Items must be persistable (picklable)."""
+
+    def pull_many(n):
+        """Remove and return a list of up to `n` items from the front of
+        the queue.
+
+        Return fewer than `n` items, possibly none, if the queue is shorter.
+        """
+
+    def pull_last():
+        """Remove and return the last item of the queue.
+
+        Raise IndexError if the queue is empty.
+        """
+
+    def put_first(item):
+        """Put an item on the front of the queue.
+
+        Item must be persistable (picklable)."""
+
+    def peek(n):
+        """Return an iterator over the first `n` items of the queue, without
+        removing them."""
+
+    def remove(item):
+        """Remove the first item of the queue that is equal to `item`.
+
+        Raise ValueError if there is none.
+        """
+
+    def index(item):
+        """Return the index of the first item that is equal to `item`.
+
+        Raise ValueError if there is none.
+        """
+
+    def __contains__(item):
+        """Return True if an item of the queue is equal to `item`."""
+
     def __len__():
         """Return len of queue"""
 
@@ -37,6 +79,6 @@ class IQueue(IPersistent):
     def __getitem__(index):
         """return item at index, or slice"""
 
-    def __nonzero__():
+    def __bool__():
         """return True if the queue contains more than zero items, else False.
         """
@@ -0,0 +1,139 @@
+##############################################################################
+#
+# Copyright (c) 2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Queue Export, Import and Conversion
+
+`export` and `load` copy the items of a queue to and from a file, and
+`convert` moves the items of a stored queue into a queue of another type,
+a batch per transaction, while producers keep putting items.
+
+The file is a sequence of pickles: a header, then lists of at most
+`batchSize` items.  Items are pickled by value, so persistent items are
+copied, together with the persistent objects they refer to.  Pass a
+`gzip.open` file to compress it.
+"""
+import pickle
+
+from ZODB.POSException import ConflictError
+
+
+HEADER = ('zc.queue', 1)
+
+
+def batches(queue, batchSize=1000):
+    """Yield the items of a queue as lists of at most `batchSize` items.
+
+    The parts of a stored queue that were read are released from the
+    connection's cache after each batch, so that the memory used stays
+    bounded however large the queue is.
+    """
+    jar = queue._p_jar
+    batch = []
+    for item in queue:
+        batch.append(item)
+        if len(batch) >= batchSize:
+            yield batch
+            batch = []
+            if jar is not None:
+                jar.cacheGC()
+    if batch:
+        yield batch
+
+
+def export(queue, stream, batchSize=1000):
+    """Write the items of a queue to a binary file, in order.
+
+    The queue is only read.  Return the number of items written.
+    """
+    pickle.dump(HEADER, stream, pickle.HIGHEST_PROTOCOL)
+    count = 0
+    for batch in batches(queue, batchSize):
+        pickle.dump(batch, stream, pickle.HIGHEST_PROTOCOL)
+        count += len(batch)
+    return count
+
+
+def load(stream, queue, transaction_manager=None):
+    """Put the items of a file written by `export` on a queue, in order.
+
+    Each batch of the file is put with `put_many`, so a CompositeQueue is
+    built a bucket at a time.  If the queue is stored in a database, each
+    batch is committed in a transaction of its own, using the transaction
+    manager of the queue's connection by default.  Return the number of
+    items put.
+    """
+    if pickle.load(stream) != HEADER:
+        raise ValueError('not a queue export')
+    if transaction_manager is None and queue._p_jar is not None:
+        transaction_manager = queue._p_jar.transaction_manager
+    count = 0
+    while True:
+        try:
+            batch = pickle.load(stream)
+        except EOFError:
+            break
+        queue.put_many(batch)
+        count += len(batch)
+        if transaction_manager is not None:
+            transaction_manager.commit()
+            queue._p_jar.cacheGC()
+    return count
+
+
+def convert(container, name, factory, batchSize=1000,
+            transaction_manager=None):
+    """Replace the queue `container[name]` by a queue made by `factory`.
+
+    Items are moved from the front of the old queue to the new one a batch
+    per transaction, so producers can keep putting items on the old queue
+    meanwhile.  Until the transaction that moves the last items, which also
+    stores the new queue as `container[name]`, the new queue is kept as
+    ``container[name + '-converting']``, and consumers of the old queue
+    only see the items that were not moved yet.  A conversion that was
+    interrupted picks up where it stopped.  Conflicting batches are
+    retried.  The old queue is retired when it is replaced, so that puts
+    on it that were not committed yet conflict, and are retried on the new
+    queue, rather than being lost.
+
+    This is a generator, that yields the number of items moved so far after
+    each batch; the conversion is done when it is exhausted.
+    """
+    if transaction_manager is None:
+        transaction_manager = container._p_jar.transaction_manager
+    tm = transaction_manager
+    pending = name + '-converting'
+    moved = 0
+    while True:
+        tm.abort()  # start from the latest state
+        try:
+            if pending not in container:
+                container[pending] = factory()
+            target = container[pending]
+            source = container[name]
+            items = source.pull_many(batchSize)
+            target.put_many(items)
+            done = not source
+            if done:
+                # a put on the old queue that commits after this would be
+                # lost: make it conflict, so that it is retried on the new
+                # queue.
+                source._retire()
+                container[name] = target
+                del container[pending]
+            tm.commit()
+        except ConflictError:
+            continue
+        moved += len(items)
+        yield moved
+        if done:
+            return
@@ -22,6 +22,14 @@ from ZODB import MappingStorage
 from ZODB import POSException
 
 import zc.queue
+from zc.queue._queue import STATE_VERSION
+from zc.queue._queue import _packState
+from zc.queue._queue import _unpackState
+
+
+def unpack(q, state):
+    # the instance dict of a stored state of `q`
+    return _unpackState(type(q), state)
 
 
 # TODO: this approach is useful, but fragile.  It also puts a dependency in
@@ -116,6 +124,287 @@ def test_deleted_bucket():
     """
 
 
+def test_composite_lengths():
+    """A CompositeQueue keeps the length of each of its buckets, so len,
+    positional access and pulls do not need to load the other buckets.
+
+        >>> import transaction
+        >>> from ZODB import DB
+        >>> db = DB(ConflictResolvingMappingStorage('test'))
+        >>> transactionmanager_1 = transaction.TransactionManager()
+        >>> connection_1 = db.open(transaction_manager=transactionmanager_1)
+        >>> q_1 = connection_1.root()["q"] = zc.queue.CompositeQueue(3)
+        >>> for i in range(10):
+        ...     q_1.put(i)
+        >>> q_1._bucketLengths()
+        (3, 3, 3, 1)
+        >>> transactionmanager_1.commit()
+
+        >>> transactionmanager_2 = transaction.TransactionManager()
+        >>> connection_2 = db.open(transaction_manager=transactionmanager_2)
+        >>> q_2 = connection_2.root()["q"]
+        >>> len(q_2)
+        10
+        >>> [q._p_changed for q in q_2._data]
+        [None, None, None, None]
+        >>> q_2[7]
+        7
+        >>> q_2[-10]
+        0
+        >>> [q._p_changed for q in q_2._data]
+        [False, None, False, None]
+
+    Concurrent puts and pulls merge the lengths as well as the buckets.
+
+        >>> q_1.pull(4)
+        4
+        >>> q_1.put(10)
+        >>> q_2.pull()
+        0
+        >>> q_2.put(11)
+        >>> q_2.put(12)
+        >>> transactionmanager_2.commit()
+        >>> transactionmanager_1.commit()
+        >>> connection_2.sync()
+        >>> list(q_1)
+        [1, 2, 3, 5, 6, 7, 8, 9, 11, 12, 10]
+        >>> q_1._bucketLengths()
+        (2, 2, 3, 4)
+        >>> q_2._bucketLengths()
+        (2, 2, 3, 4)
+        >>> [len(q) for q in q_2._data]
+        [2, 2, 3, 4]
+
+    A bucket emptied by conflict resolution is weeded out by the next pull.
+
+        >>> q_1.pull()
+        1
+        >>> q_2.pull(1)
+        2
+        >>> transactionmanager_1.commit()
+        >>> transactionmanager_2.commit()
+        >>> connection_1.sync()
+        >>> q_1._bucketLengths()
+        (0, 2, 3, 4)
+        >>> q_1.pull()
+        3
+        >>> q_1._bucketLengths()
+        (1, 3, 4)
+        >>> transactionmanager_1.commit()
+
+    Instances written before the lengths were kept count their buckets until
+    their next put or pull stores the lengths.
+
+        >>> del q_1._lengths
+        >>> '_lengths' in q_1.__dict__
+        False
+        >>> len(q_1)
+        8
+        >>> q_1[1]
+        6
+        >>> q_1.put(13)
+        >>> q_1._bucketLengths()
+        (1, 3, 4, 1)
+        >>> transactionmanager_1.abort()
+        >>> db.close()
+
+    """
+
+
+def test_batches():
+    """`put_many` and `pull_many` change each bucket once, splitting new
+    buckets at `compositeSize` up front.
+
+        >>> q = zc.queue.CompositeQueue(3)
+        >>> q.put(0)
+        >>> q.put_many(range(1, 9))
+        >>> [list(b) for b in q._data]
+        [[0, 1, 2], [3, 4, 5], [6, 7, 8]]
+        >>> q._bucketLengths()
+        (3, 3, 3)
+        >>> q.put_many(iter([9]))
+        >>> q._bucketLengths()
+        (3, 3, 3, 1)
+        >>> q.pull_many(4)
+        [0, 1, 2, 3]
+        >>> q._bucketLengths()
+        (2, 3, 1)
+        >>> q.pull_many(-1)
+        []
+        >>> q.pull_many(5)
+        [4, 5, 6, 7, 8]
+        >>> q._bucketLengths()
+        (1,)
+
+    In conflict resolution, a batch is an ordered block of additions or
+    removals, like the same calls to `put` and `pull` would be.
+
+        >>> import transaction
+        >>> from ZODB import DB
+        >>> from ZODB.POSException import ConflictError
+        >>> db = DB(ConflictResolvingMappingStorage('test'))
+        >>> for factory in (zc.queue.Queue, zc.queue.OffsetQueue,
+        ...                 lambda: zc.queue.CompositeQueue(3)):
+        ...     tm_1 = transaction.TransactionManager()
+        ...     tm_2 = transaction.TransactionManager()
+        ...     conn_1 = db.open(transaction_manager=tm_1)
+        ...     conn_2 = db.open(transaction_manager=tm_2)
+        ...     q_1 = conn_1.root()['q'] = factory()
+        ...     q_1.put_many(range(4))
+        ...     tm_1.commit()
+        ...     conn_2.sync()
+        ...     q_2 = conn_2.root()['q']
+        ...     print(q_1.pull_many(2))
+        ...     q_1.put_many(range(10, 14))
+        ...     q_2.put_many(range(20, 23))
+        ...     tm_2.commit()
+        ...     tm_1.commit()
+        ...     conn_2.sync()
+        ...     print(list(q_2), len(q_2))
+        ...     print(q_1.pull_many(2), q_2.pull_many(3))
+        ...     tm_1.commit()
+        ...     try:
+        ...         tm_2.commit()
+        ...     except ConflictError:
+        ...         print('conflict')
+        ...         tm_2.abort()
+        ...     conn_1.close()
+        ...     conn_2.close()
+        [0, 1]
+        [2, 3, 20, 21, 22, 10, 11, 12, 13] 9
+        [2, 3] [2, 3, 20]
+        conflict
+        [0, 1]
+        [2, 3, 20, 21, 22, 10, 11, 12, 13] 9
+        [2, 3] [2, 3, 20]
+        conflict
+        [0, 1]
+        [2, 3, 20, 21, 10, 11, 22, 12, 13] 9
+        [2, 3] [2, 3, 20]
+        conflict
+        >>> db.close()
+
+    """
+
+
+def test_compact():
+    """`compact` merges undersized neighboring buckets and splits oversized
+    ones, such as conflict resolution leaves behind.
+
+        >>> q = zc.queue.CompositeQueue(4)
+        >>> def bucketsOf(*sizes):
+        ...     items = iter(range(100))
+        ...     buckets = []
+        ...     for size in sizes:
+        ...         b = zc.queue._queue.BucketQueue()
+        ...         b.put_many(next(items) for i in range(size))
+        ...         buckets.append(b)
+        ...     q._data = tuple(buckets)
+        ...     q._lengths = sizes
+        >>> bucketsOf(1, 2, 0, 1, 9, 3, 1, 1)
+        >>> q.compact()
+        >>> for b in q._data:
+        ...     print(list(b))
+        [0, 1, 2, 3]
+        [4, 5, 6, 7]
+        [8, 9, 10, 11]
+        [12, 13, 14, 15]
+        [16]
+        [17]
+        >>> q._bucketLengths()
+        (4, 4, 4, 4, 1, 1)
+
+    The last bucket, where puts go, is never merged away.  Compacting a
+    queue that needs no changes does not write its parent.
+
+        >>> data = q._data
+        >>> q.compact()
+        >>> q._data is data
+        True
+
+    The emptied buckets protect against concurrent changes just like the
+    buckets that `pull` drops.
+
+        >>> import transaction
+        >>> from ZODB import DB
+        >>> from ZODB.POSException import ConflictError
+        >>> db = DB(ConflictResolvingMappingStorage('test'))
+        >>> tm_1 = transaction.TransactionManager()
+        >>> tm_2 = transaction.TransactionManager()
+        >>> conn_1 = db.open(transaction_manager=tm_1)
+        >>> q_1 = conn_1.root()['q'] = zc.queue.CompositeQueue(3)
+        >>> q_1.put_many(range(7))
+        >>> q_1.pull_many(2)
+        [0, 1]
+        >>> q_1.pull(1)
+        3
+        >>> q_1._bucketLengths()
+        (1, 2, 1)
+        >>> tm_1.commit()
+        >>> conn_2 = db.open(transaction_manager=tm_2)
+        >>> q_2 = conn_2.root()['q']
+        >>> q_1.compact()
+        >>> q_1._bucketLengths()
+        (3, 1)
+        >>> q_2.pull(1)
+        4
+        >>> tm_2.commit()
+        >>> try:
+        ...     tm_1.commit()
+        ... except ConflictError:
+        ...     print('conflict')
+        conflict
+        >>> tm_1.abort()
+        >>> list(q_1), q_1._bucketLengths()
+        ([2, 5, 6], (1, 1, 1))
+
+    Changes to the other buckets merge as usual.
+
+        >>> q_1.put(7)
+        >>> q_2.compact()
+        >>> q_1._bucketLengths(), q_2._bucketLengths()
+        ((1, 1, 2), (2, 1))
+        >>> tm_2.commit()
+        >>> tm_1.commit()
+        >>> conn_1.sync()
+        >>> list(q_1), q_1._bucketLengths()
+        ([2, 5, 6, 7], (2, 2))
+
+    With `autoCompact`, a put or pull that leaves more than that many times
+    the buckets the items need schedules a compaction.  It runs in a
+    transaction of its own once the current one commits.
+
+        >>> q_1 = conn_1.root()['q'] = zc.queue.CompositeQueue(
+        ...     2, autoCompact=1)
+        >>> q_1.put_many(range(10))
+        >>> tm_1.commit()
+        >>> for ix in (8, 6, 4, 2, 0):
+        ...     _ = q_1.pull(ix)
+        >>> q_1._bucketLengths()
+        (1, 1, 1, 1, 1)
+        >>> tm_1.commit()
+        >>> conn_1.sync()
+        >>> q_1._bucketLengths()
+        (2, 2, 1)
+        >>> list(q_1)
+        [1, 3, 5, 7, 9]
+
+    Nothing is compacted if the transaction is aborted.
+
+        >>> _ = q_1.pull(2)
+        >>> q_1._bucketLengths()
+        (2, 1, 1)
+        >>> tm_1.abort()
+        >>> from zc.queue._queue import _compactAfterCommit
+        >>> _compactAfterCommit(False, db, q_1._p_oid)
+        >>> conn_1.sync()
+        >>> q_1._bucketLengths()
+        (2, 2, 1)
+        >>> db.close()
+
+    """
+
+
 def test_legacy():
     """We used to promote the names PersistentQueue and
     CompositePersistentQueue as the expected names for the classes in this
@@ -166,11 +455,99 @@ class PersistentObject(Persistent):
         return "%s" % self.value
 
 
+def markDone(items):
+    # a handler for the workers of TestWorker
+    for item in items:
+        item.done = True
+
+
+class CountingPersistentReference(StubPersistentReference):
+    comparisons = 0
+
+    def __eq__(self, other):
+        CountingPersistentReference.comparisons += 1
+        return super().__eq__(other)
+
+
+class TestPersistentReferenceProxy(unittest.TestCase):
+
+    def _make_one(self, pr):
+        from zc.queue._queue import PersistentReferenceProxy
+        return PersistentReferenceProxy(pr)
+
+    def test_hash_on_oid(self):
+        prp1 = self._make_one(ConflictResolution.PersistentReference(
+            (b'\0' * 8, None)))
+        prp2 = self._make_one(ConflictResolution.PersistentReference(
+            ['m', ('other', b'\0' * 8, None)]))
+        prp3 = self._make_one(ConflictResolution.PersistentReference(
+            (b'\0' * 7 + b'\1', None)))
+        self.assertEqual(hash(prp1), hash(prp2))
+        self.assertNotEqual(hash(prp1), hash(prp3))
+        # same oid in another database: the hashes collide, but the
+        # references are different.
+        self.assertEqual(len({prp1, prp2, prp3}), 3)
+
+    def test_hash_without_oid(self):
+        pr = ConflictResolution.PersistentReference((b'\0' * 8, None))
+        pr.oid = None
+        self.assertEqual(hash(self._make_one(pr)), 1)
+
+    def test_resolution_is_linear(self):
+        # with a constant hash every set operation would compare each
+        # reference with every other one.
+        def state(oids):
+            return {'_data': tuple(
+                CountingPersistentReference(oid) for oid in oids)}
+        CountingPersistentReference.comparisons = 0
+        q = zc.queue.Queue()
+        res = unpack(q, q._p_resolveConflict(
+            state(range(1000)), state(range(1001)),
+            state(range(500, 1000))))
+        self.assertEqual([pr.oid for pr in res['_data']],
+                         list(range(500, 1001)))
+        self.assertLess(CountingPersistentReference.comparisons, 10000)
+
+
 class TestQueue(unittest.TestCase):
 
     def _make_one(self):
         return zc.queue.Queue()
 
+    def test_compact_state(self):
+        q = self._make_one()
+        q.put_many([1, 2, 3])
+        state = q.__getstate__()
+        self.assertEqual(state[0], STATE_VERSION)
+        # compact states load, and so do the dicts of earlier versions
+        for stored in (state, unpack(q, state)):
+            copy = type(q).__new__(type(q))
+            copy.__setstate__(stored)
+            self.assertEqual(list(copy), [1, 2, 3])
+            self.assertEqual(copy.__getstate__(), state)
+        copy = type(q).__new__(type(q))
+        self.assertRaises(ValueError, copy.__setstate__,
+                          (STATE_VERSION + 1,) + state[1:])
+
+    def test_resolve_conflict_mixed_states(self):
+        # a state stored by an earlier version merges with compact ones
+        q = self._make_one()
+        res = q._p_resolveConflict(
+            {'_data': (1, 2, 3)}, _packState(type(q), {'_data': (2, 3)}),
+            _packState(type(q), {'_data': (1, 2, 3, 4)}))
+        self.assertEqual(res[0], STATE_VERSION)
+        self.assertEqual(tuple(unpack(q, res)['_data']), (2, 3, 4))
+
+    def test_slots(self):
+        # queues and their buckets have no instance dict
+        from zc.queue._queue import BucketQueue
+        for factory in (zc.queue.Queue, BucketQueue, zc.queue.ArrayQueue,
+                        zc.queue.ArrayBucketQueue):
+            q = factory()
+            q.put(1)
+            self.assertFalse(hasattr(q, '__dict__'))
+            self.assertRaises(AttributeError, setattr, q, 'size', 1)
+
     def test_negative_pull_empty(self):
         self.assertRaises(IndexError,
                           self._make_one().pull, -1)
@@ -190,6 +567,88 @@ class TestQueue(unittest.TestCase):
         self.assertEqual(list(q[:1]), [1])
         self.assertEqual(list(q[::-1]), [4, 3, 2, 1])
 
+    def test_slices(self):
+        q = self._make_one()
+        q.put_many(range(40))
+        expected = list(range(40))
+        for start in (None, 0, 3, 17, 39, 45, -1, -5, -50):
+            for stop in (None, 0, 4, 16, 33, 60, -2, -30, -70):
+                for step in (None, 1, 2, 7, -1, -3):
+                    index = slice(start, stop, step)
+                    self.assertEqual(list(q[index]), expected[index], index)
+
+    def test_peek(self):
+        q = self._make_one()
+        q.put_many(range(40))
+        self.assertEqual(list(q.peek(3)), [0, 1, 2])
+        self.assertEqual(list(q.peek(50)), list(range(40)))
+        self.assertEqual(list(q.peek(0)), [])
+        self.assertEqual(list(q.peek(-1)), [])
+        self.assertEqual(len(q), 40)
+
+    def test_remove(self):
+        q = self._make_one()
+        q.put_many(range(40))
+        self.assertEqual(q.pull(), 0)
+        self.assertEqual(q.index(5), 4)
+        self.assertIn(5, q)
+        self.assertNotIn(0, q)
+        self.assertNotIn(50, q)
+        q.remove(5)
+        q.remove(39)
+        q.remove(1)
+        self.assertEqual(list(q), [2, 3, 4] + list(range(6, 39)))
+        self.assertEqual(len(q), 36)
+        self.assertEqual(q.index(38), 35)
+        self.assertRaises(ValueError, q.remove, 5)
+        self.assertRaises(ValueError, q.index, 0)
+
+    def test_pull_many_nonpositive(self):
+        q = self._make_one()
+        q.put_many([1, 2])
+        self.assertEqual(q.pull_many(0), [])
+        self.assertEqual(q.pull_many(-1), [])
+        self.assertEqual(list(q), [1, 2])
+
+    def test_deque(self):
+        q = self._make_one()
+        self.assertRaises(IndexError, q.pull_last)
+        q.put_first(20)
+        q.put_many(range(21, 40))
+        for i in reversed(range(20)):
+            q.put_first(i)
+        self.assertEqual(list(q), list(range(40)))
+        self.assertEqual(len(q), 40)
+        self.assertEqual(q.pull_last(), 39)
+        self.assertEqual(q.pull(), 0)
+        self.assertEqual(q.pull(-1), 38)
+        self.assertEqual(q.pull_many(30), list(range(1, 31)))
+        self.assertEqual([q.pull_last() for i in range(7)],
+                         list(reversed(range(31, 38))))
+        self.assertRaises(IndexError, q.pull_last)
+        self.assertFalse(q.__bool__())
+
+    def test_resolve_conflict_put_first(self):
+        q = self._make_one()
+
+        def resolve(old, committed, new):
+            res = q._p_resolveConflict(
+                {'_data': old}, {'_data': committed}, {'_data': new})
+            return tuple(unpack(q, res)['_data'])
+        # items put at the front merge in order, before the committed ones
+        self.assertEqual(resolve((1, 2, 3), (2, 3, 4), (0, 1, 2, 3)),
+                         (0, 2, 3, 4))
+        self.assertEqual(resolve((1, 2, 3), (5, 1, 2, 3), (0, 1, 2)),
+                         (0, 5, 1, 2))
+        self.assertEqual(resolve((1, 2), (1,), (0, 1, 2, 3)), (0, 1, 3))
+        # without old items left, additions count as put at the end
+        self.assertEqual(resolve((1,), (1, 2), (4, 3)), (2, 4, 3))
+        for committed, new in (((0, 1), (0, 1)),  # both put the same
+                               ((1,), (1,)),  # both pulled the last
+                               ((1, 2), (1, 9, 2))):  # inserted
+            self.assertRaises(POSException.ConflictError,
+                              resolve, (1, 2), committed, new)
+
     def test_resolve_conflict_different_key(self):
         q = self._make_one()
         committedstate = {'k': 1}
@@ -209,11 +668,2358 @@ class TestQueue(unittest.TestCase):
                           oldstate, committedstate, newstate)
 
 
+class TestOffsetQueue(TestQueue):
+
+    def _make_one(self):
+        return zc.queue.OffsetQueue()
+
+    def test_state_threshold(self):
+        # the head is stored by position, other attributes in a dict
+        q = self._make_one()
+        q.put_many([1, 2, 3])
+        q.compactThreshold = 10
+        q.pull()
+        self.assertEqual(
+            q.__getstate__(),
+            (1, (1, 2, 3), 1, None, {'compactThreshold': 10}))
+
+    def test_head_pull_keeps_tuple(self):
+        q = self._make_one()
+        for i in range(10):
+            q.put(i)
+        data = q._data
+        self.assertEqual(q.pull(), 0)
+        self.assertEqual(q.pull(), 1)
+        self.assertIs(q._data, data)
+        self.assertEqual(q._head, 2)
+        self.assertEqual(len(q), 8)
+        self.assertEqual(list(q), list(range(2, 10)))
+        self.assertEqual(q[0], 2)
+        self.assertEqual(q[-1], 9)
+        self.assertEqual(q[1:3], (3, 4))
+        self.assertRaises(IndexError, q.__getitem__, 8)
+        self.assertRaises(IndexError, q.__getitem__, -9)
+
+    def test_compaction(self):
+        q = self._make_one()
+        q.compactThreshold = 3
+        for i in range(5):
+            q.put(i)
+        self.assertEqual(q.pull(), 0)
+        self.assertEqual(q.pull(), 1)
+        self.assertEqual(q._head, 2)
+        self.assertEqual(q.pull(), 2)
+        self.assertEqual(q._data, (3, 4))
+        self.assertEqual(q._head, 0)
+        self.assertEqual(q.pull(), 3)
+        self.assertEqual(q.pull(), 4)
+        self.assertEqual(q._data, ())
+        self.assertEqual(q._head, 0)
+        self.assertFalse(q.__bool__())
+
+    def test_pull_other_index_compacts(self):
+        q = self._make_one()
+        for i in range(5):
+            q.put(i)
+        q.pull()
+        self.assertEqual(q.pull(1), 2)
+        self.assertEqual(q._data, (1, 3, 4))
+        self.assertEqual(q._head, 0)
+        self.assertEqual(q.pull(-1), 4)
+        self.assertRaises(IndexError, q.pull, 2)
+        self.assertRaises(IndexError, q.pull, -3)
+
+    def test_resolve_conflict_head_offsets(self):
+        q = self._make_one()
+        oldstate = {'_data': (0, 1, 2, 3), '_head': 1}
+        # one transaction pulled 1, the other pulled 2 and put 4
+        committedstate = {'_data': (0, 1, 2, 3), '_head': 2}
+        newstate = {'_data': (1, 3, 4), '_head': 0}
+        res = q._p_resolveConflict(oldstate, committedstate, newstate)
+        self.assertEqual(unpack(q, res), {'_data': (3, 4)})
+
+    def test_resolve_conflict_legacy_state(self):
+        # a state written before `_head` was set merges with one that has it
+        q = self._make_one()
+        oldstate = {'_data': (0, 1)}
+        committedstate = {'_data': (0, 1), '_head': 1}
+        newstate = {'_data': (0, 1, 2)}
+        res = q._p_resolveConflict(oldstate, committedstate, newstate)
+        self.assertEqual(unpack(q, res), {'_data': (1, 2)})
+
+    def test_resolve_conflict_same_head_pull(self):
+        q = self._make_one()
+        oldstate = {'_data': (0, 1), '_head': 0}
+        committedstate = {'_data': (0, 1), '_head': 1}
+        newstate = {'_data': (0, 1), '_head': 1}
+        self.assertRaises(POSException.ConflictError,
+                          q._p_resolveConflict,
+                          oldstate, committedstate, newstate)
+
+
+class TestArrayQueue(TestQueue):
+
+    def _make_one(self):
+        return zc.queue.ArrayQueue()
+
+    def _resolve(self, old, committed, new, factory=None):
+        import array
+        q = (factory or self._make_one)()
+        res = q._p_resolveConflict(
+            {'_data': array.array('q', old)},
+            {'_data': array.array('q', committed)},
+            {'_data': array.array('q', new)})
+        return unpack(q, res)['_data'].tolist()
+
+    def test_items(self):
+        q = self._make_one()
+        q.put_many(range(5))
+        q.put_many([])
+        q.put(5)
+        self.assertEqual(q.pull(), 0)
+        self.assertEqual(q.pull(-1), 5)
+        self.assertEqual(q.pull(2), 3)
+        self.assertEqual(q.pull_many(2), [1, 2])
+        self.assertEqual(q.pull_many(0), [])
+        self.assertEqual(list(q), [4])
+        self.assertRaises(IndexError, q.pull, 1)
+        self.assertRaises(TypeError, q.put, 'a')
+
+    def test_state(self):
+        for items, typecode in (([], 'q'), ([-128, 127], 'b'),
+                                ([0, 128], 'h'), ([-32769], 'i'),
+                                ([2 ** 31], 'q'), ([-2 ** 63], 'q')):
+            q = self._make_one()
+            q.put_many(items)
+            state = q.__getstate__()
+            self.assertEqual(unpack(q, state)['_data'].typecode, typecode)
+            self.assertEqual(q._data.typecode, 'q')
+            copy = zc.queue.ArrayQueue.__new__(zc.queue.ArrayQueue)
+            copy.__setstate__(state)
+            self.assertEqual(copy._data.typecode, 'q')
+            self.assertEqual(list(copy), items)
+
+    def test_pickle_size(self):
+        import pickle
+        q = self._make_one()
+        q.put_many(range(10 ** 6, 10 ** 6 + 1000))
+        tuple_q = zc.queue.Queue()
+        tuple_q.put_many(q)
+        self.assertLess(len(pickle.dumps(q.__getstate__(), 3)),
+                        len(pickle.dumps(tuple_q.__getstate__(), 3)))
+
+    def test_resolve_ends(self):
+        # pulls from the front and puts at the end merge
+        self.assertEqual(self._resolve([1, 2, 3], [2, 3, 4], [1, 2, 3, 5]),
+                         [2, 3, 4, 5])
+        self.assertEqual(self._resolve([1, 2, 3], [1, 2, 3, 4], [3]),
+                         [3, 4])
+        self.assertEqual(self._resolve([1, 2], [], [1, 2, 3]), [3])
+        self.assertEqual(self._resolve([], [1], [2]), [1, 2])
+        self.assertRaises(POSException.ConflictError,
+                          self._resolve, [1, 2, 3], [2, 3], [3])
+        self.assertRaises(POSException.ConflictError,
+                          self._resolve, [1], [1, 2], [1, 3, 2])
+
+    def test_resolve_other_changes(self):
+        # anything else is merged as Queues do
+        self.assertEqual(self._resolve([1, 2, 3], [1, 3], [1, 2, 3, 4]),
+                         [1, 3, 4])
+        self.assertEqual(self._resolve([1, 2, 3], [2, 3], [1, 3]), [3])
+        self.assertRaises(POSException.ConflictError,
+                          self._resolve, [1, 2, 3], [1, 3], [1, 3])
+
+    def test_resolve_bucket(self):
+        factory = zc.queue.ArrayBucketQueue
+        self.assertEqual(self._resolve([1, 2], [2], [1, 2, 3], factory),
+                         [2, 3])
+        self.assertRaises(POSException.ConflictError,
+                          self._resolve, [1], [], [1, 2], factory)
+        self.assertRaises(POSException.ConflictError,
+                          self._resolve, [1, 2], [1, 2, 3], [], factory)
+
+
 class TestCompositeQueue(TestQueue):
 
     def _make_one(self):
         return zc.queue.CompositeQueue()
 
+    def test_state_defaults(self):
+        # the arguments left at their defaults are not stored
+        from BTrees.Length import Length
+        state = zc.queue.CompositeQueue().__getstate__()
+        self.assertEqual(state[:3], (1, (), ()))
+        self.assertIsInstance(state[3], Length)
+        self.assertEqual(len(state), 4)
+        q = zc.queue.CompositeQueue(3, zc.queue.ArrayBucketQueue)
+        self.assertEqual(q.__getstate__()[4:],
+                         (3, zc.queue.ArrayBucketQueue))
+        q = zc.queue.CompositeQueue(
+            3, zc.queue.ArrayBucketQueue, spread=2, indexed=True)
+        self.assertEqual(q.__getstate__()[4:7],
+                         (3, zc.queue.ArrayBucketQueue, 2))
+        self.assertIs(q.__getstate__()[-1], q._index)
+        copy = zc.queue.CompositeQueue.__new__(zc.queue.CompositeQueue)
+        copy.__setstate__(zc.queue.CompositeQueue().__getstate__())
+        self.assertEqual(copy.compositeSize, 15)
+        self.assertEqual(copy.spread, None)
+        self.assertEqual(sorted(copy.__dict__), ['_data', '_length',
+                                                 '_lengths'])
+        self.assertEqual(copy._lengths, ())
+        self.assertEqual(copy._length(), 0)
+
+    def test_spread(self):
+        from unittest import mock
+        q = zc.queue.CompositeQueue(2, spread=3)
+        affinity = [0]
+        patcher = mock.patch.object(
+            zc.queue.CompositeQueue, '_affinity', lambda self: affinity[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        q.put(1)
+        self.assertEqual(q._bucketLengths(), (1, 0, 0))
+        affinity[0] = 2
+        q.put_many([2, 3, 4])
+        self.assertEqual(q._bucketLengths(), (1, 0, 2, 1, 0, 0, 0))
+        affinity[0] = 0
+        q.put(5)
+        affinity[0] = 4
+        q.put_many([6])
+        q.put_many([])
+        self.assertEqual(q._bucketLengths(), (1, 0, 2, 1, 1, 1, 0))
+        self.assertEqual(list(q), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(q.pull(), 1)
+        self.assertEqual(q._bucketLengths(), (2, 1, 1, 1, 0))
+        q.compact()
+        self.assertEqual(q._bucketLengths(), (2, 1, 1, 1, 0))
+        self.assertEqual(q.pull_many(10), [2, 3, 4, 5, 6])
+        self.assertEqual(q._bucketLengths(), (0, 0, 0))
+        self.assertFalse(q.__bool__())
+        q.put(7)
+        self.assertEqual(q._bucketLengths(), (0, 1, 0))
+        self.assertEqual(q.pull(), 7)
+        self.assertEqual(q._bucketLengths(), (0, 0, 0))
+
+    def test_spread_legacy(self):
+        from unittest import mock
+        q = zc.queue.CompositeQueue(3, spread=2)
+        with mock.patch.object(zc.queue.CompositeQueue, '_affinity',
+                               lambda self: 1):
+            q.put(1)
+            del q._lengths
+            q.put(2)
+            self.assertEqual(q._bucketLengths(), (0, 2))
+            del q._lengths
+            q.put_many([3, 4])
+            self.assertEqual(q._bucketLengths(), (0, 3, 1, 0, 0))
+
+    def test_spread_producers(self):
+        from unittest import mock
+
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        tm_1 = transaction.TransactionManager()
+        tm_2 = transaction.TransactionManager()
+        conn_1 = db.open(transaction_manager=tm_1)
+        conn_2 = db.open(transaction_manager=tm_2)
+        affinities = {conn_1: 0, conn_2: 1}
+        patcher = mock.patch.object(
+            zc.queue.CompositeQueue, '_affinity',
+            lambda self: affinities.get(self._p_jar, 0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        q_1 = conn_1.root()['q'] = zc.queue.CompositeQueue(4, spread=2)
+        q_1.put(0)
+        tm_1.commit()
+        tm_2.abort()
+        q_2 = conn_2.root()['q']
+        collector = zc.queue.Collector()
+        self.addCleanup(zc.queue.setCollector,
+                        zc.queue.setCollector(collector))
+        for ix in range(1, 6):
+            q_1.put(ix)
+            q_2.put(ix * 10)
+            tm_1.commit()
+            tm_2.commit()
+        conn_1.sync()
+        self.assertEqual(list(q_1), [0, 1, 2, 3, 10, 20, 30, 40,
+                                     4, 5, 50])
+        # the producers never wrote the parent, only their own buckets and
+        # the item counter
+        self.assertEqual(collector.snapshot()['counts'], {})
+        db.close()
+
+    def test_lazy_slices(self):
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        conn = db.open()
+        q = conn.root()['q'] = zc.queue.CompositeQueue(10)
+        q.put_many(range(100))
+        transaction.commit()
+        conn.cacheMinimize()
+
+        def loaded():
+            return [ix for ix, b in enumerate(q._data)
+                    if b._p_changed is not None]
+        self.assertEqual(q[25:37], list(range(25, 37)))
+        self.assertEqual(loaded(), [2, 3])
+        peeked = q.peek(15)
+        self.assertEqual(next(peeked), 0)
+        self.assertEqual(loaded(), [0, 2, 3])
+        self.assertEqual(list(peeked), list(range(1, 15)))
+        self.assertEqual(loaded(), [0, 1, 2, 3])
+        self.assertEqual(q[-2::-30], [98, 68, 38, 8])
+        self.assertEqual(loaded(), [0, 1, 2, 3, 6, 9])
+        transaction.abort()
+        db.close()
+
+    def test_compaction_conflict_is_given_up(self):
+        from zc.queue._queue import _compactAfterCommit
+        closed = []
+
+        class Queue:
+            def compact(self):
+                raise POSException.ConflictError
+
+        class Connection:
+            def get(self, oid):
+                return Queue()
+
+            def close(self):
+                closed.append(True)
+
+        class DB:
+            def open(self, transaction_manager):
+                return Connection()
+
+        _compactAfterCommit(True, DB(), b'\0' * 8)
+        self.assertEqual(closed, [True])
+
+    def test_deque_buckets(self):
+        from unittest import mock
+        q = zc.queue.CompositeQueue(2)
+        q.put_many(range(4))
+        q.put_first(-1)
+        self.assertEqual(q._bucketLengths(), (1, 2, 2))
+        q.put_first(-2)
+        q.put_first(-3)
+        self.assertEqual(q._bucketLengths(), (1, 2, 2, 2))
+        self.assertEqual(q.pull_last(), 3)
+        self.assertEqual(q.pull_last(), 2)
+        self.assertEqual(q._bucketLengths(), (1, 2, 2))
+        self.assertEqual(list(q), [-3, -2, -1, 0, 1])
+        q = zc.queue.CompositeQueue(2, spread=2)
+        with mock.patch.object(zc.queue.CompositeQueue, '_affinity',
+                               lambda self: 0):
+            q.put(1)
+        self.assertEqual(q._bucketLengths(), (1, 0))
+        # the open buckets are skipped, and kept
+        self.assertEqual(q.pull_last(), 1)
+        self.assertEqual(q._bucketLengths(), (0, 0))
+        self.assertRaises(IndexError, q.pull_last)
+
+    def test_concurrent_put_first(self):
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        tm_1 = transaction.TransactionManager()
+        tm_2 = transaction.TransactionManager()
+        conn_1 = db.open(transaction_manager=tm_1)
+        q_1 = conn_1.root()['q'] = zc.queue.CompositeQueue(2)
+        q_1.put_many([1, 2])
+        tm_1.commit()
+        conn_2 = db.open(transaction_manager=tm_2)
+        q_2 = conn_2.root()['q']
+        # new buckets at the front merge like new buckets at the end
+        q_1.put_first(0)
+        q_1.put(3)
+        q_2.put_first(-1)
+        q_2.put_first(-2)
+        q_2.put_first(-3)
+        tm_1.commit()
+        tm_2.commit()
+        conn_1.sync()
+        self.assertEqual(list(q_1), [-3, -2, -1, 0, 1, 2, 3])
+        self.assertEqual(q_1._bucketLengths(), (1, 2, 1, 2, 1))
+        self.assertEqual(len(q_1), 7)
+        # pulls from both ends merge
+        self.assertEqual(q_1.pull(), -3)
+        self.assertEqual(q_2.pull_last(), 3)
+        tm_1.commit()
+        tm_2.commit()
+        conn_1.sync()
+        self.assertEqual(list(q_1), [-2, -1, 0, 1, 2])
+        self.assertEqual(list(q_2), [-2, -1, 0, 1, 2])
+        db.close()
+
+    def test_resolve_conflict_lengths(self):
+        # the counters, stand-ins for their references here, follow their
+        # buckets
+        q = self._make_one()
+        oldstate = {'_data': ('a', 'b'), '_lengths': ('A', 'B'),
+                    '_length': 'L'}
+        committedstate = {'_data': ('a', 'b', 'c'),
+                          '_lengths': ('A', 'B', 'C'), '_length': 'L'}
+        newstate = {'_data': ('b',), '_lengths': ('B',), '_length': 'L'}
+        res = q._p_resolveConflict(oldstate, committedstate, newstate)
+        self.assertEqual(
+            unpack(q, res),
+            {'_data': ('b', 'c'), '_lengths': ('B', 'C'), '_length': 'L'})
+
+    def test_dropped_bucket_conflicts(self):
+        # one transaction empties and drops a bucket that another puts into
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        tm_1 = transaction.TransactionManager()
+        tm_2 = transaction.TransactionManager()
+        q_1 = db.open(transaction_manager=tm_1).root()['q'] = (
+            self._make_one())
+        q_1.compositeSize = 2
+        q_1.put_many([1, 2, 3])
+        q_1.pull()
+        tm_1.commit()
+        q_2 = db.open(transaction_manager=tm_2).root()['q']
+        self.assertEqual(q_1._bucketLengths(), (1, 1))
+        self.assertEqual(q_1.pull(), 2)
+        self.assertEqual(q_1._bucketLengths(), (1,))
+        q_2.put_first(0)
+        self.assertEqual(q_2._bucketLengths(), (2, 1))
+        tm_1.commit()
+        self.assertRaises(POSException.ConflictError, tm_2.commit)
+        tm_2.abort()
+        self.assertEqual(list(q_2), [3])
+        db.close()
+
+    def test_resolve_conflict_legacy_lengths(self):
+        q = self._make_one()
+        oldstate = {'_data': ('a',)}
+        committedstate = {'_data': ('a',), '_lengths': ('A',),
+                          '_length': 'L'}
+        newstate = {'_data': ('a',)}
+        self.assertRaises(POSException.ConflictError,
+                          q._p_resolveConflict,
+                          oldstate, committedstate, newstate)
+        # lengths kept on the parent, before the counters
+        oldstate = {'_data': ('a', 'b'), '_lengths': (2, 1), '_length': 3}
+        committedstate = {
+            '_data': ('a', 'b', 'c'), '_lengths': (2, 1, 1), '_length': 4}
+        newstate = {'_data': ('b',), '_lengths': (3,), '_length': 3}
+        self.assertRaises(POSException.ConflictError,
+                          q._p_resolveConflict,
+                          oldstate, committedstate, newstate)
+        oldstate = {'_data': ('a',)}
+        committedstate = {'_data': ('a',)}
+        newstate = {'_data': ('a', 'b')}
+        res = q._p_resolveConflict(oldstate, committedstate, newstate)
+        self.assertEqual(unpack(q, res), {'_data': ('a', 'b')})
+
+    def test_resolve_conflict_length(self):
+        # both transactions gave a legacy instance its item counter
+        q = self._make_one()
+        oldstate = {'_data': ('a',), '_lengths': ('A',)}
+        committedstate = {'_data': ('a',), '_lengths': ('A',),
+                          '_length': 'L'}
+        newstate = {'_data': ('a',), '_lengths': ('A',), '_length': 'M'}
+        self.assertRaises(POSException.ConflictError,
+                          q._p_resolveConflict,
+                          oldstate, committedstate, newstate)
+
+    def test_put_writes_no_parent(self):
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        conn = db.open()
+        q = conn.root()['q'] = self._make_one()
+        q.put_many(range(100))
+        q.pull()
+        transaction.commit()
+        q.put(100)
+        # the tail bucket, its counter and the item counter, and the index
+        self.assertFalse(q._p_changed)
+        self.assertEqual(len(conn._registered_objects),
+                         3 if q._index is None else 4)
+        transaction.commit()
+        self.assertEqual(len(q), 100)
+        db.close()
+
+    def test_len_loads_no_buckets(self):
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        conn = db.open()
+        q = conn.root()['q'] = self._make_one()
+        q.put_many(range(100))
+        transaction.commit()
+        conn.cacheMinimize()
+        self.assertEqual(len(q), 100)
+        self.assertTrue(q)
+        self.assertEqual(
+            [b for b in q._data if b._p_changed is not None], [])
+        transaction.abort()
+        db.close()
+
+    def test_length_legacy(self):
+        q = self._make_one()
+        q.put_many(range(20))
+        del q._length
+        self.assertEqual(len(q), 20)
+        q.put(20)
+        self.assertEqual(q._length(), 21)
+        del q._length
+        self.assertEqual(q.pull(), 0)
+        self.assertEqual(q._length(), 20)
+        del q._length
+        del q._lengths
+        self.assertEqual(q.pull_many(5), [1, 2, 3, 4, 5])
+        self.assertEqual(q._length(), 15)
+        self.assertEqual(len(q), 15)
+
+
+class TestIndexedCompositeQueue(TestCompositeQueue):
+
+    def _make_one(self):
+        return zc.queue.CompositeQueue(3, indexed=True)
+
+    def _keys(self, q):
+        # the index as a list of (item, bucket index)
+        positions = {id(b): cix for cix, b in enumerate(q._data)}
+        return sorted((key[2], positions[id(b)])
+                      for key, b in q._index.items())
+
+    def test_index_follows_items(self):
+        q = self._make_one()
+        q.put_many(range(7))
+        q.put(7)
+        self.assertEqual(self._keys(q), [
+            (0, 0), (1, 0), (2, 0), (3, 1), (4, 1), (5, 1), (6, 2),
+            (7, 2)])
+        q.pull()
+        q.pull(2)
+        q.pull_many(2)
+        q.remove(6)
+        self.assertEqual(list(q), [4, 5, 7])
+        self.assertEqual(self._keys(q), [(4, 0), (5, 0), (7, 1)])
+        q = zc.queue.CompositeQueue(6, indexed=True)
+        q.put_many(range(12))
+        q.compositeSize = 4
+        q.compact()
+        self.assertEqual(q._bucketLengths(), (4, 2, 4, 2))
+        self.assertEqual(self._keys(q), sorted(
+            (item, cix) for cix, b in enumerate(q._data) for item in b))
+
+    def test_types(self):
+        q = self._make_one()
+        q.put_many([1, 'one', b'one'])
+        self.assertEqual(q.index(b'one'), 2)
+        self.assertIn('one', q)
+        self.assertNotIn(1.5, q)
+        self.assertRaises(TypeError, q.put, 1.5)
+        self.assertRaises(TypeError, q.put_many, [2, (1,)])
+        self.assertNotIn(PersistentObject(1), q)
+        self.assertRaises(ValueError, q.put, PersistentObject(1))
+        self.assertEqual(list(q), [1, 'one', b'one'])
+
+    def test_duplicates(self):
+        q = self._make_one()
+        q.put(1)
+        self.assertRaises(ValueError, q.put, 1)
+        self.assertRaises(ValueError, q.put_many, [2, 1])
+        self.assertRaises(ValueError, q.put_many, [2, 2])
+        self.assertEqual(list(q), [1])
+        self.assertEqual(len(q._index), 1)
+
+    def test_persistent_items(self):
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        tm_1 = transaction.TransactionManager()
+        tm_2 = transaction.TransactionManager()
+        conn_1 = db.open(transaction_manager=tm_1)
+        q_1 = conn_1.root()['q'] = self._make_one()
+        tm_1.commit()
+        items = [PersistentObject(ix) for ix in range(10)]
+        q_1.put_many(items[:8])
+        self.assertIsNotNone(items[0]._p_oid)
+        tm_1.commit()
+        conn_2 = db.open(transaction_manager=tm_2)
+        q_2 = conn_2.root()['q']
+        self.assertEqual(q_2.index(q_2[5]), 5)
+        # an equal object is not the same item
+        self.assertNotIn(PersistentObject(5), q_2)
+        # concurrent puts, pulls and removals merge
+        q_1.put(items[8])
+        q_2.remove(q_2[5])
+        q_2.pull()
+        tm_1.commit()
+        tm_2.commit()
+        conn_1.sync()
+        self.assertEqual([item.value for item in q_1], [1, 2, 3, 4, 6, 7, 8])
+        self.assertEqual(len(q_1._index), 7)
+        self.assertEqual(q_1.index(items[8]), 6)
+        # but puts of the same item conflict
+        conn_1.root()['item'] = items[9]
+        tm_1.commit()
+        conn_2.sync()
+        q_1.put(items[9])
+        q_2.put(conn_2.root()['item'])
+        tm_1.commit()
+        self.assertRaises(POSException.ConflictError, tm_2.commit)
+        tm_2.abort()
+        db.close()
+
+
+class TestDedupQueue(TestCompositeQueue):
+
+    def setUp(self):
+        from unittest import mock
+        self.now = 1000.0
+        patcher = mock.patch('zc.queue._dedup.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _make_one(self, ttl=60, maxSeen=None):
+        return zc.queue.DedupQueue(3, ttl=ttl, maxSeen=maxSeen)
+
+    def test_interface(self):
+        from zope.interface.verify import verifyObject
+
+        from zc.queue.interfaces import IQueue
+        self.assertTrue(verifyObject(IQueue, self._make_one()))
+
+    def test_queued(self):
+        q = self._make_one()
+        q.put(1)
+        q.put(1)
+        q.put_many([2, 1, 3, 2])
+        q.put_first(3)
+        q.put_first(0)
+        self.assertEqual(list(q), [0, 1, 2, 3])
+        self.assertTrue(q.seen(2))
+        self.assertFalse(q.seen(4))
+        self.assertRaises(TypeError, q.put, 1.5)
+
+    def test_ttl(self):
+        q = self._make_one()
+        q.put_many(range(4))
+        self.assertEqual(q.pull(), 0)
+        self.assertEqual(q.pull_many(2), [1, 2])
+        q.remove(3)
+        self.now += 30
+        q.put_many(range(5))
+        self.assertEqual(list(q), [4])
+        self.now += 29
+        self.assertTrue(q.seen(3))
+        self.now += 1
+        self.assertFalse(q.seen(3))
+        q.put(0)
+        self.assertEqual(list(q), [4, 0])
+
+    def test_generations(self):
+        q = self._make_one()
+        q.put_many(range(3))
+        q.pull()
+        self.now += 40
+        q.pull()
+        self.now += 40
+        q.pull()
+        # the first generation was started by the first pull
+        self.assertEqual([start for start, tree, length in q._seen],
+                         [1000, 1080])
+        self.assertEqual([length() for start, tree, length in q._seen],
+                         [2, 1])
+        self.assertTrue(q.seen(1))
+        self.now += 60
+        q.put(3)
+        q.pull()
+        # the generation of 0 and 1 was dropped, as they expired
+        self.assertEqual([start for start, tree, length in q._seen],
+                         [1080, 1140])
+        self.assertEqual([list(tree) for start, tree, length in q._seen],
+                         [[zc.queue._queue._indexKey(2)],
+                          [zc.queue._queue._indexKey(3)]])
+
+    def test_max_seen(self):
+        q = self._make_one(ttl=3600, maxSeen=4)
+        q.put_many(range(10))
+        self.assertEqual(q.pull_many(5), list(range(5)))
+        self.assertEqual(q.pull(), 5)
+        self.assertEqual([length() for start, tree, length in q._seen],
+                         [5, 1])
+        self.assertEqual(q.pull(), 6)
+        self.assertEqual(q.pull(), 7)
+        self.assertEqual([length() for start, tree, length in q._seen],
+                         [2, 1])
+        # items evicted before their time can be put again
+        q.put_many(range(10))
+        self.assertEqual(list(q), [8, 9, 0, 1, 2, 3, 4])
+
+    def test_concurrent_puts(self):
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        tm_1 = transaction.TransactionManager()
+        tm_2 = transaction.TransactionManager()
+        conn_1 = db.open(transaction_manager=tm_1)
+        q_1 = conn_1.root()['q'] = self._make_one()
+        q_1.put_many(range(0, 100, 2))
+        self.assertEqual(q_1.pull(), 0)
+        tm_1.commit()
+        conn_2 = db.open(transaction_manager=tm_2)
+        q_2 = conn_2.root()['q']
+        # different items merge, and so do the seen-sets
+        q_1.put(101)
+        q_1.put(0)
+        self.assertEqual(q_2.pull_last(), 98)
+        q_2.put(103)
+        tm_1.commit()
+        tm_2.commit()
+        conn_1.sync()
+        self.assertEqual(list(q_1)[-3:], [96, 101, 103])
+        self.assertEqual(q_1._seen[0][2](), 2)
+        self.assertTrue(q_1.seen(98))
+        # an equal item conflicts, and is not put again on retry
+        q_1.put(105)
+        q_2.put(105)
+        tm_1.commit()
+        self.assertRaises(POSException.ConflictError, tm_2.commit)
+        tm_2.abort()
+        q_2.put(105)
+        self.assertFalse(q_2._p_changed)
+        self.assertEqual(list(q_2).count(105), 1)
+        db.close()
+
+
+class TestPriorityQueue(unittest.TestCase):
+
+    def _make_one(self):
+        return zc.queue.PriorityQueue(compositeSize=2)
+
+    def test_remove(self):
+        q = self._make_one()
+        q.put_many('ab', 1)
+        q.put_many('cd', 0)
+        self.assertEqual(q.index('a'), 2)
+        self.assertIn('d', q)
+        self.assertNotIn('e', q)
+        q.remove('c')
+        q.remove('b')
+        self.assertEqual(list(q), ['d', 'a'])
+        self.assertRaises(ValueError, q.remove, 'c')
+        self.assertRaises(ValueError, q.index, 'c')
+
+    def test_interface(self):
+        from zope.interface.verify import verifyObject
+
+        from zc.queue.interfaces import IQueue
+        self.assertTrue(verifyObject(IQueue, self._make_one()))
+
+    def test_deque(self):
+        q = self._make_one()
+        self.assertRaises(IndexError, q.pull_last)
+        q.put_many('bc', 1)
+        q.put_first('a', 1)
+        q.put_first('x', 0)
+        q.put('y')
+        self.assertEqual(list(q), ['x', 'y', 'a', 'b', 'c'])
+        self.assertEqual(q.pull_last(), 'c')
+        q.pull_many(4)
+        self.assertRaises(IndexError, q.pull_last)
+
+    def test_priorities(self):
+        q = self._make_one()
+        q.put('low', 10)
+        q.put('normal')
+        q.put('urgent', -5)
+        q.put_many(['normal 2', 'normal 3'])
+        q.put_many(['low 2'], priority=10)
+        self.assertEqual(q._priorities, (-5, 0, 10))
+        self.assertEqual(q.priorities(), [-5, 0, 10])
+        self.assertEqual(
+            list(q),
+            ['urgent', 'normal', 'normal 2', 'normal 3', 'low', 'low 2'])
+        self.assertEqual(len(q), 6)
+        self.assertEqual(q[1], 'normal')
+        self.assertEqual(q[-2], 'low')
+        self.assertEqual(q[::2], ['urgent', 'normal 2', 'low'])
+        self.assertEqual(list(q.peek(2)), ['urgent', 'normal'])
+        self.assertRaises(IndexError, q.__getitem__, 6)
+        self.assertRaises(IndexError, q.__getitem__, -7)
+        self.assertEqual(q.pull(), 'urgent')
+        self.assertEqual(q.priorities(), [0, 10])
+        self.assertEqual(q.pull(-1), 'low 2')
+        self.assertEqual(q.pull_many(2), ['normal', 'normal 2'])
+        self.assertEqual(q.pull_many(5), ['normal 3', 'low'])
+        self.assertFalse(q.__bool__())
+        self.assertRaises(IndexError, q.pull)
+        # the queues of the priorities are kept
+        self.assertEqual(q._priorities, (-5, 0, 10))
+        q.put('again', 0)
+        self.assertTrue(q.__bool__())
+        self.assertEqual(q.pull(), 'again')
+
+    def test_conflicts(self):
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        tm_1 = transaction.TransactionManager()
+        tm_2 = transaction.TransactionManager()
+        conn_1 = db.open(transaction_manager=tm_1)
+        q_1 = conn_1.root()['q'] = self._make_one()
+        q_1.put(1, 1)
+        tm_1.commit()
+        conn_2 = db.open(transaction_manager=tm_2)
+        q_2 = conn_2.root()['q']
+        # new priorities merge
+        q_1.put(0, 0)
+        q_2.put(2, 2)
+        q_2.put(3, 1)
+        tm_1.commit()
+        tm_2.commit()
+        conn_1.sync()
+        self.assertEqual(list(q_1), [0, 1, 3, 2])
+        self.assertEqual(q_1._priorities, (0, 1, 2))
+        # as do puts and pulls at existing ones
+        self.assertEqual(q_1.pull(), 0)
+        q_2.put(4, 1)
+        q_2.put(5, 2)
+        tm_1.commit()
+        tm_2.commit()
+        conn_1.sync()
+        self.assertEqual(list(q_1), [1, 3, 4, 2, 5])
+        # but a new priority added twice conflicts
+        q_1.put(6, 3)
+        q_2.put(7, 3)
+        tm_1.commit()
+        self.assertRaises(POSException.ConflictError, tm_2.commit)
+        tm_2.abort()
+        db.close()
+
+    def test_resolve_conflict_different_keys(self):
+        q = self._make_one()
+        oldstate = {'_priorities': (), '_data': (), 'compositeSize': 2}
+        committedstate = {'_priorities': (), '_data': (), 'compositeSize': 3}
+        newstate = {'_priorities': (), '_data': (), 'compositeSize': 2}
+        self.assertRaises(POSException.ConflictError,
+                          q._p_resolveConflict,
+                          oldstate, committedstate, newstate)
+        del committedstate['compositeSize']
+        self.assertRaises(POSException.ConflictError,
+                          q._p_resolveConflict,
+                          oldstate, committedstate, newstate)
+
+
+class TestScheduledQueue(unittest.TestCase):
+
+    def setUp(self):
+        from unittest import mock
+        self.now = 1000.0
+        patcher = mock.patch('zc.queue._queue.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _make_one(self, granularity=10):
+        return zc.queue.ScheduledQueue(granularity, compositeSize=2)
+
+    def _slots(self, q):
+        # the times and lengths of the slots of `q`
+        return [(when, len(slot)) for (when, affinity), slot
+                in q._slots.items()]
+
+    def test_interface(self):
+        from zope.interface.verify import verifyObject
+
+        from zc.queue.interfaces import IQueue
+        self.assertTrue(verifyObject(IQueue, self._make_one()))
+
+    def test_due(self):
+        q = self._make_one()
+        q.put('b', 1005)
+        q.put_many(['c', 'd'], 1001)
+        q.put('late', 1011)
+        q.put('a')
+        q.put('e', 990)
+        q.put_many([], 2000)
+        self.assertEqual(self._slots(q),
+                         [(0, 1), (990, 1), (1010, 3), (1020, 1)])
+        self.assertEqual(list(q), ['a', 'e'])
+        self.assertEqual(len(q), 2)
+        self.assertEqual(q.nextDue(), 1010)
+        self.now = 1010
+        self.assertEqual(list(q), ['a', 'e', 'b', 'c', 'd'])
+        self.assertEqual(q.nextDue(), 1020)
+        self.assertEqual(q[2], 'b')
+        self.assertEqual(q[-1], 'd')
+        self.assertEqual(q[1:3], ['e', 'b'])
+        self.assertEqual(list(q.peek(3)), ['a', 'e', 'b'])
+        self.assertRaises(IndexError, q.__getitem__, 5)
+        self.assertRaises(IndexError, q.__getitem__, -6)
+        self.assertEqual(q.pull(3), 'c')
+        self.assertEqual(q.pull(), 'a')
+        self.assertEqual(self._slots(q), [(990, 1), (1010, 2), (1020, 1)])
+        self.assertEqual(q.pull_many(2), ['e', 'b'])
+        self.assertEqual(q.pull_many(5), ['d'])
+        self.assertEqual(q.pull_many(5), [])
+        self.assertRaises(IndexError, q.pull)
+        self.assertFalse(q.__bool__())
+        self.assertEqual(self._slots(q), [(1020, 1)])
+        self.now = 1020
+        self.assertTrue(q.__bool__())
+        self.assertIsNone(q.nextDue())
+        self.assertEqual(q.pull(-1), 'late')
+        self.assertEqual(self._slots(q), [])
+
+    def test_deque(self):
+        q = self._make_one()
+        self.assertRaises(IndexError, q.pull_last)
+        q.put('b')
+        q.put('c', 990)
+        q.put('late', 1011)
+        q.put_first('a')
+        self.assertEqual(list(q), ['a', 'b', 'c'])
+        self.assertEqual(q.pull_last(), 'c')
+        self.assertEqual(self._slots(q), [(0, 2), (1020, 1)])
+        self.assertEqual(q.pull_last(), 'b')
+        self.assertEqual(q.pull_last(), 'a')
+        self.assertRaises(IndexError, q.pull_last)
+        self.assertEqual(self._slots(q), [(1020, 1)])
+
+    def test_remove(self):
+        q = self._make_one()
+        q.put_many('ab')
+        q.put_many('cd', 1010)
+        self.assertEqual(q.index('b'), 1)
+        self.assertIn('a', q)
+        self.assertNotIn('c', q)
+        self.assertRaises(ValueError, q.index, 'c')
+        # items that are not due yet can be cancelled
+        q.remove('c')
+        q.remove('a')
+        self.assertEqual(self._slots(q), [(0, 1), (1010, 1)])
+        q.remove('d')
+        self.assertEqual(self._slots(q), [(0, 1)])
+        self.assertRaises(ValueError, q.remove, 'c')
+        self.now = 1010
+        self.assertEqual(list(q), ['b'])
+
+    def test_concurrent(self):
+        from unittest import mock
+
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        tm_1 = transaction.TransactionManager()
+        tm_2 = transaction.TransactionManager()
+        conn_1 = db.open(transaction_manager=tm_1)
+        conn_2 = db.open(transaction_manager=tm_2)
+        affinities = {conn_1: 1, conn_2: 2}
+        patcher = mock.patch.object(
+            zc.queue.ScheduledQueue, '_affinity',
+            lambda self: affinities.get(self._p_jar, 0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        q_1 = conn_1.root()['q'] = self._make_one()
+        q_1.put_many([1, 2], 1000)
+        tm_1.commit()
+        tm_2.abort()
+        q_2 = conn_2.root()['q']
+        # new slots, even for the same time, merge, and so do puts and pulls
+        q_1.put(3, 1050)
+        q_1.put(4, 1100)
+        q_1.pull()
+        q_2.put(5, 1100)
+        q_2.put(6, 1000)
+        tm_1.commit()
+        tm_2.commit()
+        conn_1.sync()
+        self.assertEqual(self._slots(q_1),
+                         [(1000, 2), (1050, 1), (1100, 1), (1100, 1)])
+        self.now = 1100
+        self.assertEqual(list(q_1), [2, 6, 3, 4, 5])
+        # one transaction emptying a slot that the other put in conflicts
+        q_1.pull_many(2)
+        q_2.put(7, 1000)
+        tm_1.commit()
+        self.assertRaises(POSException.ConflictError, tm_2.commit)
+        tm_2.abort()
+        # emptying the same slot does too
+        q_1.pull()
+        q_2.pull()
+        tm_1.commit()
+        self.assertRaises(POSException.ConflictError, tm_2.commit)
+        tm_2.abort()
+        self.assertEqual(list(q_2), [4, 5])
+        # so does adding a slot to a queue that was retired
+        q_1._retire()
+        q_2.put(8, 2000)
+        tm_1.commit()
+        self.assertRaises(POSException.ConflictError, tm_2.commit)
+        tm_2.abort()
+        db.close()
+
+    def test_put_writes_one_slot(self):
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        conn = db.open()
+        q = conn.root()['q'] = self._make_one()
+        for ix in range(100):
+            q.put(ix, 1000 + ix * 10)
+        q.put(100, 1000)
+        transaction.commit()
+        q.put('a', 1500)
+        q.pull()
+        # the bucket of each slot and its two counters
+        self.assertFalse(q._p_changed)
+        self.assertFalse(q._slots._p_changed)
+        self.assertEqual(len(conn._registered_objects), 6)
+        transaction.commit()
+        db.close()
+
+    def test_legacy(self):
+        q = self._make_one()
+        slots = [zc.queue.CompositeQueue(2) for ix in range(3)]
+        for slot, items in zip(slots, ['ab', 'c', 'd']):
+            slot.put_many(items)
+        del q._slots
+        q._times = (0, 1000, 1010)
+        q._data = tuple(slots)
+        q._lengths = (2, 1, 1)
+        self.assertEqual(list(q), ['a', 'b', 'c'])
+        self.assertEqual(q.nextDue(), 1010)
+        self.assertEqual(q[-1], 'c')
+        self.assertIsNone(q._slots)
+        self.assertEqual(q.pull(), 'a')
+        self.assertEqual(self._slots(q), [(0, 1), (1000, 1), (1010, 1)])
+        self.assertNotIn('_times', q.__dict__)
+        q.put('e', 1001)
+        self.now = 1010
+        self.assertEqual(list(q), ['b', 'c', 'd', 'e'])
+
+    def test_resolve(self):
+        q = self._make_one()
+        a, b, c = [StubPersistentReference(oid) for oid in range(3)]
+
+        def state(*slots, **extra):
+            res = dict(granularity=10, _times=(), _data=(), _lengths=())
+            if slots:
+                res.update(zip(('_times', '_data', '_lengths'), zip(*slots)))
+            res.update(extra)
+            return res
+
+        res = q._p_resolveConflict(
+            state((10, a, 2), (20, b, 1)),
+            state((10, a, 1), (20, b, 1), (20, c, 1)),
+            state((10, a, 3)))
+        self.assertEqual(res, state((10, a, 2), (20, c, 1)))
+        # a slot that both transactions emptied is dropped
+        res = q._p_resolveConflict(
+            state((10, a, 2)), state((10, a, 1)), state((10, a, 1)))
+        self.assertEqual(res, state())
+        self.assertRaises(
+            POSException.ConflictError, q._p_resolveConflict,
+            state((10, a, 1)), state(), state((10, a, 2)))
+        self.assertRaises(
+            POSException.ConflictError, q._p_resolveConflict,
+            state(), state(granularity=5), state())
+        self.assertRaises(
+            POSException.ConflictError, q._p_resolveConflict,
+            state(), state(), state(extra=1))
+        # both added slots to a queue with a BTree of slots
+        state = dict(granularity=10, _slots=a)
+        self.assertEqual(
+            q._p_resolveConflict(state, dict(state), dict(state)), state)
+        self.assertRaises(
+            POSException.ConflictError, q._p_resolveConflict,
+            state, dict(state, _retired=True), dict(state, _retired=True))
+        # both moved the slots of a legacy instance to a BTree
+        self.assertRaises(
+            POSException.ConflictError, q._p_resolveConflict,
+            dict(granularity=10, _times=(), _data=(), _lengths=()),
+            dict(state, _slots=b), dict(state, _slots=c))
+
+
+class TestShardedQueue(unittest.TestCase):
+
+    def _make_one(self, shards=3):
+        return zc.queue.ShardedQueue(shards, compositeSize=2)
+
+    def test_remove(self):
+        q = self._make_one()
+        q.put_many(range(7))
+        self.assertEqual(list(q), [0, 3, 6, 1, 4, 2, 5])
+        self.assertEqual(q.index(4), 4)
+        self.assertIn(6, q)
+        self.assertNotIn(7, q)
+        q.remove(6)
+        q.remove(2)
+        self.assertEqual(list(q), [0, 3, 1, 4, 5])
+        self.assertRaises(ValueError, q.remove, 6)
+        self.assertRaises(ValueError, q.index, 6)
+
+    def test_interface(self):
+        from zope.interface.verify import verifyObject
+
+        from zc.queue.interfaces import IQueue
+        self.assertTrue(verifyObject(IQueue, self._make_one()))
+
+    def test_round_robin(self):
+        q = self._make_one()
+        for i in range(5):
+            q.put(i)
+        self.assertEqual([list(s) for s in q._shards], [[0, 3], [1, 4], [2]])
+        q.put_many(range(5, 10))
+        self.assertEqual([list(s) for s in q._shards],
+                         [[0, 3, 6, 9], [1, 4, 7], [2, 5, 8]])
+        q.put_many([])
+        q.put(10)
+        self.assertEqual(list(q._shards[1]), [1, 4, 7, 10])
+
+    def test_keys(self):
+        q = self._make_one()
+        q.put('a', key=4)
+        q.put_many(['b', 'c'], key=4)
+        self.assertEqual(list(q._shards[1]), ['a', 'b', 'c'])
+        self.assertRaises(TypeError, q.put, 'd', key=(1, 2))
+        self.assertRaises(TypeError, q.put, 'd', key=PersistentObject(1))
+
+    def test_stable_keys(self):
+        # the shard of a key does not depend on PYTHONHASHSEED
+        q = self._make_one()
+        for key in (1, 4, 'tenant-1', 'tenant-2', 'tenant-3', b'tenant-1'):
+            q.put(key, key=key)
+        self.assertEqual(
+            [list(s) for s in q._shards],
+            [['tenant-3'], [4, 'tenant-1', b'tenant-1'], [1, 'tenant-2']])
+
+    def test_positional(self):
+        q = self._make_one()
+        q.put_many(range(7))
+        self.assertEqual(list(q), [0, 3, 6, 1, 4, 2, 5])
+        self.assertEqual(len(q), 7)
+        self.assertTrue(q.__bool__())
+        self.assertEqual(q[3], 1)
+        self.assertEqual(q[-1], 5)
+        self.assertEqual(q[1:3], [3, 6])
+        self.assertRaises(IndexError, q.__getitem__, 7)
+        self.assertRaises(IndexError, q.__getitem__, -8)
+        self.assertEqual(q.pull(), 0)
+        self.assertEqual(q.pull(-2), 2)
+        self.assertEqual(q.pull_many(3), [3, 6, 1])
+        self.assertEqual(q.pull_many(5), [4, 5])
+        self.assertRaises(IndexError, q.pull)
+        self.assertFalse(q.__bool__())
+
+    def test_deque(self):
+        q = self._make_one()
+        self.assertRaises(IndexError, q.pull_last)
+        q.put_many(range(4))
+        q.put_first(-1, key=4)
+        self.assertEqual(list(q), [0, 3, -1, 1, 2])
+        self.assertEqual(q.pull_last(), 2)
+        self.assertEqual(q.pull_last(), 1)
+        self.assertEqual(q.pull_last(), -1)
+
+    def test_peek(self):
+        q = self._make_one()
+        q.put_many(range(7))
+        self.assertEqual(list(q.peek(4)), [0, 3, 6, 1])
+        self.assertEqual(list(q.peek(-1)), [])
+
+    def test_take(self):
+        q = self._make_one()
+        q.put_many(range(4))
+        self.assertEqual(q.take(1), 1)
+        self.assertEqual(q.take(1), 2)  # stolen from the next shard
+        self.assertEqual(q.take(5), 0)
+        self.assertEqual(q.take(), 3)
+        self.assertRaises(IndexError, q.take)
+
+    def test_concurrent_take(self):
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        tm_1 = transaction.TransactionManager()
+        tm_2 = transaction.TransactionManager()
+        conn_1 = db.open(transaction_manager=tm_1)
+        q_1 = conn_1.root()['q'] = self._make_one(2)
+        q_1.put_many(range(4))
+        tm_1.commit()
+        conn_2 = db.open(transaction_manager=tm_2)
+        q_2 = conn_2.root()['q']
+        # consumers on different shards do not conflict
+        self.assertEqual(q_1.take(0), 0)
+        self.assertEqual(q_2.take(1), 1)
+        tm_1.commit()
+        tm_2.commit()
+        # and producers merge as they do for CompositeQueues
+        q_1.put(4)
+        q_2.put(5)
+        tm_1.commit()
+        tm_2.commit()
+        conn_1.sync()
+        self.assertEqual(sorted(q_1), [2, 3, 4, 5])
+        # consumers that steal the same item still conflict
+        self.assertEqual(q_1.take(0), 2)
+        self.assertEqual(q_2.take(0), 2)
+        tm_1.commit()
+        self.assertRaises(POSException.ConflictError, tm_2.commit)
+        tm_2.abort()
+        db.close()
+
+
+class TestLeasingQueue(unittest.TestCase):
+
+    def setUp(self):
+        from unittest import mock
+        self.now = 1000.0
+        tokens = iter('token-%d' % ix for ix in range(100))
+        for name, value in (
+                ('time.time', lambda: self.now),
+                ('uuid.uuid4', lambda: mock.Mock(hex=next(tokens)))):
+            patcher = mock.patch('zc.queue._lease.' + name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _make_one(self):
+        return zc.queue.LeasingQueue(2)
+
+    def test_ack(self):
+        q = self._make_one()
+        q.put_many('abc')
+        self.assertEqual(q.lease(30), ('a', 'token-0'))
+        self.assertEqual(list(q), ['b', 'c'])
+        self.assertEqual(list(q.leases()), [('token-0', 1030.0, 'a')])
+        q.ack('token-0')
+        self.assertEqual(list(q.leases()), [])
+        self.assertRaises(KeyError, q.ack, 'token-0')
+        self.assertRaises(KeyError, q.nack, 'token-0')
+        self.assertRaises(KeyError, q.renew, 'token-0', 30)
+
+    def test_nack(self):
+        q = self._make_one()
+        q.put_many('ab')
+        item, token = q.lease(30)
+        q.nack(token)
+        self.assertEqual(list(q), ['b', 'a'])
+        self.assertEqual(list(q.leases()), [])
+
+    def test_expiry(self):
+        q = self._make_one()
+        q.put_many('abc')
+        q.lease(10)
+        q.lease(30)
+        self.assertEqual(q.reclaim(), 0)
+        self.now += 10  # a lease expiring now is still good
+        self.assertEqual(q.reclaim(), 0)
+        self.now += 1
+        q.renew('token-1', 30)
+        self.assertEqual(q.lease(30), ('c', 'token-2'))
+        self.assertEqual(list(q), ['a'])
+        self.assertEqual(list(q.leases()), [
+            ('token-1', 1041.0, 'b'), ('token-2', 1041.0, 'c')])
+        self.assertRaises(KeyError, q.ack, 'token-0')
+        q.ack('token-1')
+        self.now += 100
+        self.assertEqual(q.reclaim(), 1)
+        self.assertEqual(list(q), ['a', 'c'])
+        self.assertEqual(q.reclaim(), 0)
+
+    def test_reclaim_schedule(self):
+        from unittest import mock
+        q = self._make_one()
+        q.expiryGranularity = 10
+        q.put_many(range(10))
+        with mock.patch.object(
+                zc.queue.LeasingQueue, 'reclaim',
+                side_effect=zc.queue.LeasingQueue.reclaim,
+                autospec=True) as reclaim:
+            q.lease(5)
+            q.lease(25)
+            self.now += 8
+            q.lease(5)
+            self.assertEqual(reclaim.call_count, 0)
+            self.assertEqual(
+                [key for key, affinity in q._expiries], [1010, 1020, 1030])
+            # the first slot has passed
+            self.now += 3
+            q.ack('token-1')  # the index keeps its entry until a reclaim
+            q.renew('token-2', 30)
+            self.assertEqual(q.lease(1), (3, 'token-3'))
+            self.assertEqual(reclaim.call_count, 1)
+            self.assertEqual(list(q)[-1], 0)
+            # the renewed lease moved to a later slot, and the slot of the
+            # ended one is not due yet
+            self.assertEqual(
+                [(key, list(tokens)) for (key, affinity), tokens
+                 in q._expiries.items()],
+                [(1020, ['token-3']), (1030, ['token-1']),
+                 (1050, ['token-2'])])
+            self.assertEqual(q.lease(1), (4, 'token-4'))
+            self.assertEqual(reclaim.call_count, 1)
+        self.now += 10
+        self.assertEqual(q.reclaim(), 2)
+        self.assertEqual(
+            [key for key, affinity in q._expiries], [1050])
+
+    def test_reclaim_legacy(self):
+        q = self._make_one()
+        q.put_many('abc')
+        q.lease(10)
+        q.lease(30)
+        del q._expiries
+        self.now += 20
+        self.assertEqual(q.lease(30), ('c', 'token-2'))
+        self.assertEqual(list(q), ['a'])
+        self.assertEqual(
+            [key for key, affinity in q._expiries], [1030, 1050])
+
+    def test_empty(self):
+        q = self._make_one()
+        self.assertRaises(IndexError, q.lease, 30)
+        self.assertEqual(list(q.leases()), [])
+
+    def test_concurrent_leases(self):
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        tm_1 = transaction.TransactionManager()
+        tm_2 = transaction.TransactionManager()
+        conn_1 = db.open(transaction_manager=tm_1)
+        q_1 = conn_1.root()['q'] = self._make_one()
+        q_1.put_many(range(4))
+        tm_1.commit()
+        conn_2 = db.open(transaction_manager=tm_2)
+        q_2 = conn_2.root()['q']
+        # leasing the same item conflicts, as pulling it does
+        self.assertEqual(q_1.lease(30), (0, 'token-0'))
+        self.assertEqual(q_1.lease(30), (1, 'token-1'))
+        q_2.lease(30)
+        tm_1.commit()
+        self.assertRaises(POSException.ConflictError, tm_2.commit)
+        tm_2.abort()
+        # but new leases, acknowledgements, renewals and puts merge
+        self.assertEqual(q_2.lease(30), (2, 'token-3'))
+        tm_2.commit()
+        q_1.ack('token-1')
+        q_2.renew('token-0', 60)
+        q_2.put(4)
+        tm_1.commit()
+        tm_2.commit()
+        conn_1.sync()
+        self.assertEqual(list(q_1.leases()), [
+            ('token-0', 1060.0, 0), ('token-3', 1030.0, 2)])
+        self.assertEqual(list(q_1), [3, 4])
+        db.close()
+
+
+class TestCollector(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = zc.queue.Collector()
+        self.previous = zc.queue.setCollector(self.collector)
+        self.addCleanup(zc.queue.setCollector, self.previous)
+
+    def _resolve(self, q, old, committed, new):
+        try:
+            q._p_resolveConflict(
+                {'_data': tuple(old)}, {'_data': tuple(committed)},
+                {'_data': tuple(new)})
+        except POSException.ConflictError:
+            pass
+
+    def test_set(self):
+        self.assertIsNone(self.previous)
+        self.assertIs(zc.queue.getCollector(), self.collector)
+        self.assertIs(zc.queue.setCollector(None), self.collector)
+        self.assertIsNone(zc.queue.getCollector())
+        self._resolve(zc.queue.Queue(), [1], [1, 2], [1, 3])
+        self.assertEqual(self.collector.snapshot()['counts'], {})
+
+    def test_outcomes(self):
+        exported = []
+        self.collector.exporters.append(
+            lambda *args: exported.append(args))
+        queue = zc.queue.Queue()
+        bucket = zc.queue.PersistentQueue()
+        self._resolve(queue, [1], [1, 2], [1, 3])
+        self._resolve(queue, [1, 2], [2], [2])
+        self._resolve(queue, [1], [1, 2], [1, 2])
+        self._resolve(bucket, [1], [], [1, 2])
+        try:
+            queue._p_resolveConflict({}, {'k': 1}, {'k': 2})
+        except POSException.ConflictError:
+            pass
+        self.assertEqual(self.collector.snapshot()['counts'], {
+            ('queue', 'resolved'): 1,
+            ('queue', 'both-removed'): 1,
+            ('queue', 'both-added'): 1,
+            ('queue', 'changed-keys'): 1,
+            ('bucket', 'bucket-emptied'): 1,
+        })
+        self.assertEqual(
+            [(kind, outcome, size) for kind, outcome, seconds, size
+             in exported],
+            [('queue', 'resolved', 2), ('queue', 'both-removed', 1),
+             ('queue', 'both-added', 2), ('bucket', 'bucket-emptied', 2),
+             ('queue', 'changed-keys', 0)])
+        self.assertTrue(all(seconds >= 0 for k, o, seconds, s in exported))
+        snapshot = self.collector.snapshot()
+        self.assertEqual(snapshot['sizes'], {
+            'queue': [2, 2, 0, 0, 0, 0, 0],
+            'bucket': [0, 1, 0, 0, 0, 0, 0]})
+        self.assertEqual(sum(snapshot['seconds']['queue']), 4)
+        self.collector.reset()
+        self.assertEqual(self.collector.snapshot(),
+                         dict(counts={}, seconds={}, sizes={}))
+
+    def test_database(self):
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        tm_1 = transaction.TransactionManager()
+        tm_2 = transaction.TransactionManager()
+        conn_1 = db.open(transaction_manager=tm_1)
+        root = conn_1.root()
+        root['composite'] = zc.queue.CompositeQueue(2)
+        root['priority'] = zc.queue.PriorityQueue(2)
+        root['composite'].put_many(range(3))
+        tm_1.commit()
+        conn_2 = db.open(transaction_manager=tm_2)
+        root_2 = conn_2.root()
+        root['composite'].put(3)
+        root['priority'].put(0, 1)
+        root_2['composite'].put(4)
+        root_2['priority'].put(0, 1)
+        tm_1.commit()
+        self.assertRaises(POSException.ConflictError, tm_2.commit)
+        tm_2.abort()
+        counts = self.collector.snapshot()['counts']
+        self.assertEqual(counts[('priority', 'both-added')], 1)
+        db.close()
+
+
+class TestConsumer(unittest.TestCase):
+
+    def setUp(self):
+        import transaction
+        from ZODB import DB
+        self.db = DB(ConflictResolvingMappingStorage('test'))
+        self.tm = transaction.TransactionManager()
+        self.conn = self.db.open(transaction_manager=self.tm)
+        self.q = self.conn.root()['q'] = zc.queue.CompositeQueue()
+        self.tm.commit()
+        consumer_tm = transaction.TransactionManager()
+        consumer_conn = self.db.open(transaction_manager=consumer_tm)
+        self.consumer = zc.queue.Consumer(consumer_conn.root()['q'])
+
+    def tearDown(self):
+        self.consumer.close()
+        self.db.close()
+
+    def _put_later(self, *items):
+        import threading
+
+        def put():
+            for item in items:
+                self.tm.abort()  # see the consumer's pulls
+                self.q.put(item)
+                self.tm.commit()
+        thread = threading.Timer(0.05, put)
+        thread.start()
+        return thread
+
+    def test_unstored_queue(self):
+        self.assertRaises(ValueError, zc.queue.Consumer, zc.queue.Queue())
+
+    def test_get(self):
+        import queue
+        import time
+        self.q.put(1)
+        self.tm.commit()
+        self.assertEqual(self.consumer.get(), 1)
+        self.assertRaises(queue.Empty, self.consumer.get, 0)
+        # the consumer wakes up for a commit, long before it would poll
+        thread = self._put_later(2)
+        start = time.monotonic()
+        self.assertEqual(self.consumer.get(timeout=10), 2)
+        self.assertLess(time.monotonic() - start, 5)
+        thread.join()
+        self.conn.sync()
+        self.assertEqual(len(self.q), 0)
+
+    def test_get_polls_without_notifications(self):
+        self.consumer.close()
+        self.consumer.pollInterval = 0.01
+        thread = self._put_later(3)
+        self.assertEqual(self.consumer.get(timeout=10), 3)
+        thread.join()
+
+    def test_get_retries_conflicts(self):
+        import transaction
+        self.q.put_many([1, 2])
+        self.tm.commit()
+        competitor_tm = transaction.TransactionManager()
+        competitor = self.db.open(transaction_manager=competitor_tm)
+        consumer_tm = self.consumer.transaction_manager
+        queue = self.consumer.queue
+        competed = []
+
+        class CompetingQueue:
+            # take the first item in another connection while the consumer
+            # is about to commit the same pull.
+            def pull(self):
+                if not competed:
+                    consumer_tm.get().addBeforeCommitHook(compete)
+                return queue.pull()
+
+        def compete():
+            competed.append(competitor.root()['q'].pull())
+            competitor_tm.commit()
+
+        self.consumer.queue = CompetingQueue()
+        self.assertEqual(self.consumer.get(0), 2)
+        self.assertEqual(competed, [1])
+        competitor.close()
+
+    def test_async_iteration(self):
+        import asyncio
+
+        async def consume(count):
+            res = []
+            async for item in self.consumer:
+                res.append(item)
+                if len(res) == count:
+                    break
+            return res
+
+        self.q.put(1)
+        self.tm.commit()
+        thread = self._put_later(2, 3)
+        self.assertEqual(asyncio.run(consume(3)), [1, 2, 3])
+        thread.join()
+        self.assertEqual(self.consumer._events, set())
+
+    def test_async_iteration_polls(self):
+        import asyncio
+        self.consumer.close()
+        self.consumer.pollInterval = 0.01
+
+        async def consume():
+            async for item in self.consumer:
+                return item
+
+        thread = self._put_later(4)
+        self.assertEqual(asyncio.run(consume()), 4)
+        thread.join()
+
+    def test_notifications(self):
+        from zc.queue import _consumer
+        self.assertIsNone(_consumer._notifier(object()))
+        notifier = _consumer._notifier(self.db)
+        self.assertIs(_consumer._notifier(self.db), notifier)
+        seen = []
+        notifier.subscribe(seen.append)
+        self.db._mvcc_storage.invalidate(b'\0' * 8, {self.q._p_oid})
+        self.db._mvcc_storage.invalidateCache()
+        notifier.unsubscribe(seen.append)
+        self.assertEqual(seen, [{self.q._p_oid}, None])
+
+    def test_local_commits_notify(self):
+        # fails if ZODB stops calling the methods that the notifier wraps
+        from zc.queue import _consumer
+        notifier = _consumer._notifier(self.db)
+        seen = []
+        notifier.subscribe(seen.append)
+        self.q.put(1)
+        self.tm.commit()
+        self.assertEqual(len(seen), 1)
+        self.assertIn(self.q._p_oid, seen[0])
+        notifier.unsubscribe(seen.append)
+
+    def test_notifier_restores_adapter(self):
+        adapter = self.db._mvcc_storage
+        self.assertIn('_invalidate_finish', adapter.__dict__)
+        self.consumer.close()
+        for name in ('invalidate', '_invalidate_finish', 'invalidateCache'):
+            self.assertNotIn(name, adapter.__dict__)
+        # a later consumer wraps them again
+        self.consumer = zc.queue.Consumer(self.consumer.queue)
+        self.assertIn('_invalidate_finish', adapter.__dict__)
+
+    def test_unknown_adapter_polls(self):
+        import types
+
+        from ZODB.mvccadapter import MVCCAdapter
+
+        from zc.queue import _consumer
+
+        def _invalidate_finish(tid, oids):
+            pass
+
+        for name, value in (('_invalidate_finish', _invalidate_finish),
+                            ('invalidate', None)):
+            adapter = MVCCAdapter.__new__(MVCCAdapter)
+            setattr(adapter, name, value)
+            db = types.SimpleNamespace(_mvcc_storage=adapter)
+            self.assertIsNone(_consumer._notifier(db))
+
+
+class TestFanIn(unittest.TestCase):
+
+    def setUp(self):
+        from unittest import mock
+        patcher = mock.patch.object(
+            zc.queue.FanIn, '_affinity', lambda self: 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_round_robin(self):
+        f = zc.queue.FanIn()
+        for name in 'abc':
+            f.register(name)
+        f.put_many('a', [1, 2, 3])
+        f.put('b', 4)
+        f.put_many('c', [5, 6])
+        self.assertEqual(f.counts(), {'a': 3, 'b': 1, 'c': 2})
+        self.assertEqual(len(f), 6)
+        self.assertTrue(f.__bool__())
+        self.assertEqual(
+            f.pull_many(10),
+            [('a', 1), ('b', 4), ('c', 5), ('c', 6), ('a', 2), ('a', 3)])
+        self.assertEqual(f.counts(), {})
+        self.assertFalse(f.__bool__())
+        self.assertRaises(IndexError, f.pull)
+        self.assertEqual(f.names(), ['a', 'b', 'c'])
+
+    def test_weights(self):
+        f = zc.queue.FanIn()
+        f.register('a', weight=2)
+        f.register('b')
+        f.put_many('a', range(6))
+        f.put_many('b', range(10, 13))
+        self.assertEqual(
+            [name for name, item in f.pull_many(6)],
+            ['a', 'b', 'a', 'a', 'b', 'a'])
+
+    def test_register(self):
+        f = zc.queue.FanIn()
+        q = zc.queue.Queue()
+        q.put_many([1, 2])
+        self.assertIs(f.register('a', q), q)
+        self.assertIs(f.queue('a'), q)
+        self.assertEqual(f.counts(), {'a': 2})
+        self.assertRaises(KeyError, f.register, 'a')
+        self.assertIs(f.unregister('a'), q)
+        self.assertEqual(f.counts(), {})
+        self.assertEqual(f.names(), [])
+        self.assertRaises(KeyError, f.unregister, 'a')
+
+    def test_sync(self):
+        f = zc.queue.FanIn()
+        a = f.register('a')
+        b = f.register('b')
+        a.put(1)
+        f.sync('a')
+        self.assertEqual(f.counts(), {'a': 1})
+        f.put_many('b', [2, 3])
+        b.pull()
+        b.pull()
+        # b was emptied behind the FanIn's back: it is skipped
+        self.assertEqual(f.pull(), ('a', 1))
+        self.assertEqual(f.counts(), {'b': 2})
+        self.assertRaises(IndexError, f.pull)
+        self.assertEqual(f.counts(), {})
+
+    def test_pull_loads_one_queue(self):
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        conn = db.open()
+        f = conn.root()['f'] = zc.queue.FanIn()
+        for ix in range(50):
+            f.register(ix)
+        f.put(30, 'x')
+        transaction.commit()
+        conn.cacheMinimize()
+        self.assertEqual(f.pull(), (30, 'x'))
+        self.assertEqual(
+            [name for name in f.names()
+             if f._queues[name]._p_changed is not None], [30])
+        transaction.abort()
+        db.close()
+
+    def test_concurrent_puts_and_pulls(self):
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        tm_1 = transaction.TransactionManager()
+        tm_2 = transaction.TransactionManager()
+        conn_1 = db.open(transaction_manager=tm_1)
+        f_1 = conn_1.root()['f'] = zc.queue.FanIn()
+        for name in 'abc':
+            f_1.register(name)
+        f_1.put_many('a', [1, 2])
+        f_1.put('b', 3)
+        tm_1.commit()
+        conn_2 = db.open(transaction_manager=tm_2)
+        f_2 = conn_2.root()['f']
+        self.assertEqual(f_1.pull(), ('a', 1))
+        f_1.put('c', 4)
+        self.assertEqual(f_2.pull_many(1), [('a', 1)])
+        tm_1.commit()
+        # both pulled from a: its bucket conflicts
+        self.assertRaises(POSException.ConflictError, tm_2.commit)
+        tm_2.abort()
+        self.assertEqual(f_2.counts(), {'a': 1, 'b': 1, 'c': 1})
+        # different queues merge, counts included
+        f_2._position().update(a=0, b=1, c=0)
+        self.assertEqual(f_2.pull(), ('b', 3))
+        f_1.put('a', 5)
+        tm_2.commit()
+        tm_1.commit()
+        conn_2.sync()
+        self.assertEqual(f_1.counts(), {'a': 2, 'c': 1})
+        self.assertEqual(f_2.counts(), {'a': 2, 'c': 1})
+        db.close()
+
+    def test_round_robin_with_concurrent_producer(self):
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        tm_1 = transaction.TransactionManager()
+        tm_2 = transaction.TransactionManager()
+        conn_1 = db.open(transaction_manager=tm_1)
+        f_1 = conn_1.root()['f'] = zc.queue.FanIn()
+        for name in 'abc':
+            f_1.register(name)
+            f_1.put_many(name, range(10))
+        tm_1.commit()
+        conn_2 = db.open(transaction_manager=tm_2)
+        f_2 = conn_2.root()['f']
+        pulled = []
+        for ix in range(12):
+            # the producer's commit invalidates the consumer's FanIn
+            f_2.put('a', 10 + ix)
+            tm_2.commit()
+            conn_1.sync()
+            pulled.append(f_1.pull()[0])
+            tm_1.commit()
+        self.assertEqual(''.join(pulled), 'abc' * 4)
+        db.close()
+
+    def test_resolve_conflict(self):
+        f = zc.queue.FanIn()
+        oldstate = {'_weights': {'a': 1}, '_counts': {'a': 2, 'b': 1}}
+        committedstate = {'_weights': {'a': 1}, '_counts': {'a': 1, 'b': 1}}
+        newstate = {'_weights': {'a': 1}, '_counts': {'a': 2, 'c': 3}}
+        self.assertEqual(
+            f._p_resolveConflict(oldstate, committedstate, newstate),
+            {'_weights': {'a': 1}, '_counts': {'a': 1, 'c': 3}})
+        oldstate = {'_weights': {}, '_counts': {'a': 1}}
+        committedstate = {'_weights': {}, '_counts': {}}
+        newstate = {'_weights': {}, '_counts': {}}
+        self.assertRaises(POSException.ConflictError, f._p_resolveConflict,
+                          oldstate, committedstate, newstate)
+        oldstate = {'_weights': {}, '_counts': {}}
+        committedstate = {'_weights': {'a': 1}, '_counts': {}}
+        newstate = {'_weights': {}, '_counts': {'b': 1}}
+        self.assertRaises(POSException.ConflictError, f._p_resolveConflict,
+                          oldstate, committedstate, newstate)
+
+
+class TestConflictPolicy(unittest.TestCase):
+
+    def _open(self, factory, items=()):
+        # a queue stored with `items`, seen by two connections
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        self.addCleanup(db.close)
+        tm_1 = transaction.TransactionManager()
+        tm_2 = transaction.TransactionManager()
+        conn_1 = db.open(transaction_manager=tm_1)
+        q_1 = conn_1.root()['q'] = factory()
+        q_1.put_many(items)
+        tm_1.commit()
+        conn_2 = db.open(transaction_manager=tm_2)
+        return (tm_1, q_1), (tm_2, conn_2.root()['q'])
+
+    def test_policies(self):
+        self.assertEqual(zc.queue.Queue().__getstate__(), (1, ()))
+        self.assertEqual(zc.queue.Queue(zc.queue.STRICT).__getstate__(),
+                         (1, ()))
+        q = zc.queue.Queue(zc.queue.APPEND_ONLY)
+        self.assertEqual(q.__getstate__(), (1, (), 'append-only'))
+        q = zc.queue.CompositeQueue(conflictPolicy='at-least-once')
+        self.assertEqual(q._policy, 'at-least-once')
+        q.put(1)
+        self.assertEqual(q._data[0]._policy, 'at-least-once')
+        self.assertRaises(ValueError, zc.queue.Queue, 'nope')
+        self.assertRaises(ValueError, zc.queue.registerPolicy,
+                          zc.queue.ConflictPolicy('strict'))
+        self.assertEqual(repr(zc.queue.STRICT), "<ConflictPolicy 'strict'>")
+
+    def test_strict(self):
+        (tm_1, q_1), (tm_2, q_2) = self._open(zc.queue.Queue, [1, 2])
+        q_1.put(3)
+        q_2.put(3)
+        tm_1.commit()
+        self.assertRaises(POSException.ConflictError, tm_2.commit)
+        tm_2.abort()
+        q_1.pull()
+        q_2.pull()
+        tm_1.commit()
+        self.assertRaises(POSException.ConflictError, tm_2.commit)
+        tm_2.abort()
+        self.assertEqual(list(q_2), [2, 3])
+
+    def test_append_only(self):
+        (tm_1, q_1), (tm_2, q_2) = self._open(
+            lambda: zc.queue.Queue(zc.queue.APPEND_ONLY), [1, 2])
+        # equal items put concurrently are both kept
+        q_1.put(3)
+        q_2.put_many([3, 4])
+        tm_1.commit()
+        tm_2.commit()
+        q_1._p_jar.sync()
+        self.assertEqual(list(q_1), [1, 2, 3, 3, 4])
+        # but each item is pulled once
+        q_1.pull()
+        q_2.pull()
+        tm_1.commit()
+        self.assertRaises(POSException.ConflictError, tm_2.commit)
+        tm_2.abort()
+        self.assertEqual(list(q_2), [2, 3, 3, 4])
+
+    def test_equal_items(self):
+        # equal items are counted, not merged into one
+        for factory in (zc.queue.Queue, zc.queue.OffsetQueue,
+                        zc.queue.CompositeQueue):
+            for policy in (zc.queue.APPEND_ONLY, zc.queue.AT_LEAST_ONCE):
+                def make():
+                    if factory is zc.queue.CompositeQueue:
+                        return factory(conflictPolicy=policy)
+                    return factory(policy)
+                # a re-put of an item the queue holds
+                (tm_1, q_1), (tm_2, q_2) = self._open(make, ['a', 'b'])
+                q_1.put('c')
+                q_2.put('a')
+                tm_1.commit()
+                tm_2.commit()
+                q_1._p_jar.sync()
+                self.assertEqual(list(q_1), ['a', 'b', 'c', 'a'])
+                self.assertEqual(len(q_1), 4)
+                self.assertEqual(q_1[3], 'a')
+                # the pull of one of two equal items
+                (tm_1, q_1), (tm_2, q_2) = self._open(make, ['a', 'a', 'b'])
+                q_1.put('c')
+                self.assertEqual(q_2.pull(), 'a')
+                tm_1.commit()
+                tm_2.commit()
+                q_1._p_jar.sync()
+                self.assertEqual(list(q_1), ['a', 'b', 'c'])
+                self.assertEqual(len(q_1), 3)
+
+    def test_equal_items_pulled_by_both(self):
+        from zc.queue._queue import resolveQueueConflict
+        old = {'_data': ('a', 'a', 'b'), '_policy': 'append-only'}
+        pulled = {'_data': ('a', 'b'), '_policy': 'append-only'}
+        # both pulled the first 'a'
+        self.assertRaises(POSException.ConflictError, resolveQueueConflict,
+                          dict(old), dict(pulled), dict(pulled))
+        old['_policy'] = pulled['_policy'] = 'at-least-once'
+        self.assertEqual(
+            resolveQueueConflict(dict(old), dict(pulled), dict(pulled)),
+            pulled)
+        # a put_first, and a pull with a re-put
+        old = {'_data': ('a', 'b'), '_policy': 'append-only'}
+        committed = {'_data': ('z', 'a', 'b'), '_policy': 'append-only'}
+        new = {'_data': ('b', 'a'), '_policy': 'append-only'}
+        self.assertEqual(
+            resolveQueueConflict(old, committed, new)['_data'],
+            ('z', 'b', 'a'))
+
+    def test_at_least_once(self):
+        for factory in (zc.queue.Queue, zc.queue.OffsetQueue,
+                        zc.queue.ArrayQueue):
+            (tm_1, q_1), (tm_2, q_2) = self._open(
+                lambda: factory(zc.queue.AT_LEAST_ONCE), [1, 2, 3])
+            # both get the first item, which is pulled once
+            self.assertEqual(q_1.pull(), 1)
+            self.assertEqual(q_2.pull_many(2), [1, 2])
+            q_1.put(4)
+            q_2.put(4)
+            tm_1.commit()
+            tm_2.commit()
+            q_1._p_jar.sync()
+            self.assertEqual(list(q_1), [3, 4, 4])
+
+    def test_composite(self):
+        # a consumer empties the open bucket that a producer puts in
+        def run(policy):
+            (tm_1, q_1), (tm_2, q_2) = self._open(
+                lambda: zc.queue.CompositeQueue(
+                    2, spread=1, conflictPolicy=policy), [1])
+            self.assertEqual(q_1.pull(), 1)
+            q_2.put(2)
+            tm_1.commit()
+            try:
+                tm_2.commit()
+            except POSException.ConflictError:
+                tm_2.abort()
+                return None
+            q_1._p_jar.sync()
+            return list(q_1), q_1._bucketLengths(), len(q_1)
+        self.assertIsNone(run(zc.queue.STRICT))
+        self.assertEqual(run(zc.queue.APPEND_ONLY), ([2], (1,), 1))
+        self.assertEqual(run(zc.queue.AT_LEAST_ONCE), ([2], (1,), 1))
+        # the buckets keep pulls of the same item from conflicting, so
+        # that the lengths on the parent stay right
+        (tm_1, q_1), (tm_2, q_2) = self._open(
+            lambda: zc.queue.CompositeQueue(
+                conflictPolicy=zc.queue.AT_LEAST_ONCE), [1, 2, 3])
+        q_1.pull()
+        q_2.pull()
+        tm_1.commit()
+        self.assertRaises(POSException.ConflictError, tm_2.commit)
+
+    def test_unknown_policy(self):
+        from zc.queue import _queue
+        policy = zc.queue.registerPolicy(
+            zc.queue.ConflictPolicy('test', duplicatePuts=True))
+        self.addCleanup(_queue._policies.pop, 'test')
+        q = zc.queue.Queue(policy)
+        res = q._p_resolveConflict(
+            (1, (1,), 'test'), (1, (1, 2), 'test'), (1, (1, 2), 'test'))
+        self.assertEqual(res, (1, (1, 2, 2), 'test'))
+        # a server that does not know the policy gives up
+        del _queue._policies['test']
+        self.assertRaises(
+            POSException.ConflictError, q._p_resolveConflict,
+            (1, (1,), 'test'), (1, (1, 2), 'test'), (1, (1, 3), 'test'))
+        _queue._policies['test'] = policy
+
+
+class TestLog(unittest.TestCase):
+
+    def test_groups(self):
+        log = zc.queue.Log(3)
+        log.put(0)
+        log.subscribe('a')
+        log.subscribe('b', log.start())
+        self.assertRaises(KeyError, log.subscribe, 'a')
+        self.assertRaises(ValueError, log.subscribe, 'c', 2)
+        self.assertEqual(log.groups(), ['a', 'b'])
+        log.put_many(range(1, 5))
+        self.assertEqual(log.end(), 5)
+        self.assertEqual(log.pending('a'), 4)
+        self.assertEqual(log.pending('b'), 5)
+        # each group gets every item, at its own pace
+        self.assertEqual(log.read('a', 2), [1, 2])
+        self.assertEqual(log.read('a', 2), [1, 2])
+        log.ack('a', 2)
+        self.assertEqual(log.position('a'), 3)
+        self.assertEqual(log.pull_many('a', 5), [3, 4])
+        self.assertEqual(log.read('a'), [])
+        self.assertRaises(IndexError, log.pull, 'a')
+        self.assertRaises(ValueError, log.ack, 'a', 1)
+        self.assertEqual(log.pull('b'), 0)
+        self.assertEqual(log.pull_many('b', 2), [1, 2])
+        self.assertEqual(list(log), [0, 1, 2, 3, 4])
+        self.assertEqual(len(log), 5)
+        log.unsubscribe('b')
+        self.assertEqual(log.groups(), ['a'])
+        self.assertRaises(KeyError, log.read, 'b')
+
+    def test_collect(self):
+        log = zc.queue.Log(2)
+        log.subscribe('a')
+        log.subscribe('b')
+        log.put_many(range(7))
+        self.assertEqual(log._items._bucketLengths(), (2, 2, 2, 1))
+        log.ack('a', 5)
+        log.ack('b', 3)
+        # only the buckets that every group read past go
+        self.assertEqual(log.collect(), 2)
+        self.assertEqual(log.start(), 2)
+        self.assertEqual(log.end(), 7)
+        self.assertEqual(list(log), [2, 3, 4, 5, 6])
+        self.assertEqual(log.read('b', 2), [3, 4])
+        self.assertEqual(log.collect(), 0)
+        # positions stay put, and a group that starts behind the first
+        # item kept starts at it
+        log._cursors['c'] = 0
+        self.assertEqual(log.position('c'), 2)
+        self.assertEqual(log.read('c'), [2])
+        del log._cursors['c']
+        # without groups all but the last bucket go
+        log.unsubscribe('a')
+        log.unsubscribe('b')
+        self.assertEqual(log.collect(), 4)
+        self.assertEqual(list(log), [6])
+        log.put(7)
+        log.subscribe('a', log.start())
+        self.assertEqual(log.pull_many('a', 5), [6, 7])
+        self.assertEqual(log.pending('a'), 0)
+        self.assertTrue(log.__bool__())
+        self.assertEqual(log.collect(), 0)
+
+    def test_concurrent_groups(self):
+        import transaction
+        from ZODB import DB
+        db = DB(ConflictResolvingMappingStorage('test'))
+        tm_1 = transaction.TransactionManager()
+        tm_2 = transaction.TransactionManager()
+        conn_1 = db.open(transaction_manager=tm_1)
+        log_1 = conn_1.root()['log'] = zc.queue.Log(2)
+        log_1.subscribe('a')
+        log_1.subscribe('b')
+        log_1.put_many(range(5))
+        tm_1.commit()
+        conn_2 = db.open(transaction_manager=tm_2)
+        log_2 = conn_2.root()['log']
+        # acknowledgements of different groups and puts merge
+        self.assertEqual(log_1.pull_many('a', 3), [0, 1, 2])
+        log_1.put(5)
+        self.assertEqual(log_2.pull_many('b', 4), [0, 1, 2, 3])
+        log_2.put(6)
+        tm_1.commit()
+        tm_2.commit()
+        conn_1.sync()
+        self.assertEqual(log_1.position('a'), 3)
+        self.assertEqual(log_1.position('b'), 4)
+        self.assertEqual(list(log_1), [0, 1, 2, 3, 4, 5, 6])
+        # two consumers of the same group conflict
+        self.assertEqual(log_1.pull('a'), 3)
+        self.assertEqual(log_2.pull('a'), 3)
+        tm_1.commit()
+        self.assertRaises(POSException.ConflictError, tm_2.commit)
+        tm_2.abort()
+        # collecting merges with puts
+        self.assertEqual(log_1.collect(), 4)
+        log_2.put(7)
+        tm_1.commit()
+        tm_2.commit()
+        conn_1.sync()
+        self.assertEqual(log_1.start(), 4)
+        self.assertEqual(list(log_1), [4, 5, 6, 7])
+        self.assertEqual(log_1.read('a', 10), [4, 5, 6, 7])
+        db.close()
+
+
+class TestMigrate(unittest.TestCase):
+
+    def setUp(self):
+        import transaction
+        from ZODB import DB
+        self.db = DB(ConflictResolvingMappingStorage('test'))
+        self.addCleanup(self.db.close)
+        self.tm = transaction.TransactionManager()
+        self.conn = self.db.open(transaction_manager=self.tm)
+
+    def test_export_load(self):
+        import io
+        import pickle
+
+        from zc.queue import migrate
+        root = self.conn.root()
+        root['source'] = source = zc.queue.CompositeQueue(4)
+        source.put_many(PersistentObject(ix) for ix in range(10))
+        self.tm.commit()
+        stream = io.BytesIO()
+        self.assertEqual(
+            [len(b) for b in migrate.batches(source, 4)], [4, 4, 2])
+        self.assertEqual(migrate.export(source, stream, 3), 10)
+        self.assertEqual(len(source), 10)
+        stream.seek(0)
+        root['target'] = target = zc.queue.CompositeQueue(3)
+        self.tm.commit()
+        self.assertEqual(migrate.load(stream, target), 10)
+        self.assertEqual(target._bucketLengths(), (3, 3, 3, 1))
+        self.assertFalse(self.conn._registered_objects)  # all committed
+        self.assertEqual([item.value for item in target], list(range(10)))
+        self.assertIsNot(target[0], source[0])
+        # into a queue that is not stored
+        stream.seek(0)
+        q = zc.queue.Queue()
+        self.assertEqual(migrate.load(stream, q), 10)
+        self.assertEqual(len(q), 10)
+        self.assertRaises(ValueError, migrate.load,
+                          io.BytesIO(pickle.dumps(None)), q)
+
+    def test_convert(self):
+        import transaction
+
+        from zc.queue import migrate
+        root = self.conn.root()
+        root['q'] = zc.queue.Queue()
+        root['q'].put_many(range(7))
+        self.tm.commit()
+        tm_2 = transaction.TransactionManager()
+        conn_2 = self.db.open(transaction_manager=tm_2)
+        steps = migrate.convert(
+            root, 'q', lambda: zc.queue.CompositeQueue(2), 3)
+        self.assertEqual(next(steps), 3)
+        self.assertIsInstance(root['q-converting'], zc.queue.CompositeQueue)
+        # a producer keeps putting on the old queue
+        conn_2.root()['q'].put(7)
+        tm_2.commit()
+        self.assertEqual(next(steps), 6)
+        self.assertEqual(list(steps), [8])
+        self.assertEqual(list(root['q']), list(range(8)))
+        self.assertIsInstance(root['q'], zc.queue.CompositeQueue)
+        self.assertNotIn('q-converting', root)
+
+    def test_convert_concurrent_put(self):
+        import transaction
+
+        from zc.queue import migrate
+        for factory in (zc.queue.Queue, zc.queue.OffsetQueue,
+                        lambda: zc.queue.CompositeQueue(2),
+                        lambda: zc.queue.CompositeQueue(2, spread=2),
+                        zc.queue.PriorityQueue, zc.queue.ShardedQueue):
+            root = self.conn.root()
+            root['q'] = factory()
+            root['q'].put_many(range(3))
+            self.tm.commit()
+            tm_2 = transaction.TransactionManager()
+            conn_2 = self.db.open(transaction_manager=tm_2)
+            # the producer puts on the old queue while the last batch moves
+            conn_2.root()['q'].put(99)
+            self.assertEqual(
+                list(migrate.convert(root, 'q', zc.queue.Queue, 5)), [3])
+            self.assertRaises(POSException.ConflictError, tm_2.commit)
+            tm_2.abort()
+            conn_2.root()['q'].put(99)
+            tm_2.commit()
+            self.conn.sync()
+            self.assertEqual(sorted(root['q']), [0, 1, 2, 99])
+            self.assertEqual(root['q'][-1], 99)
+            conn_2.close()
+
+    def test_convert_conflict(self):
+        from unittest import mock
+
+        from zc.queue import migrate
+        root = self.conn.root()
+        root['q'] = zc.queue.Queue()
+        root['q'].put_many(range(3))
+        self.tm.commit()
+        commits = []
+
+        def commit():
+            commits.append(len(root['q']))
+            if len(commits) == 1:
+                raise POSException.ConflictError
+            self.tm.commit()
+
+        tm = mock.Mock(wraps=self.tm, commit=commit)
+        self.assertEqual(
+            list(migrate.convert(root, 'q', zc.queue.OffsetQueue, 2, tm)),
+            [2, 3])
+        self.assertEqual(commits, [1, 1, 3])
+        self.assertEqual(list(root['q']), [0, 1, 2])
+
+    def test_resume_convert(self):
+        from zc.queue import migrate
+        root = self.conn.root()
+        root['q'] = zc.queue.Queue()
+        root['q'].put_many(range(5))
+        self.tm.commit()
+        steps = migrate.convert(root, 'q', zc.queue.OffsetQueue, 2)
+        self.assertEqual(next(steps), 2)
+        del steps
+        self.assertEqual(
+            list(migrate.convert(root, 'q', zc.queue.Queue, 2)), [2, 3])
+        self.assertIsInstance(root['q'], zc.queue.OffsetQueue)
+        self.assertEqual(list(root['q']), list(range(5)))
+
+
+class TestWorker(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+
+        import transaction
+        from ZODB import DB
+        from ZODB.FileStorage import FileStorage
+        self.directory = tempfile.mkdtemp(prefix='zc.queue.worker')
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'Data.fs')
+        db = DB(FileStorage(self.path))
+        tm = transaction.TransactionManager()
+        conn = db.open(transaction_manager=tm)
+        root = conn.root()
+        root['q'] = zc.queue.CompositeQueue(4)
+        root['items'] = [PersistentObject(ix) for ix in range(20)]
+        root['q'].put_many(root['items'])
+        tm.commit()
+        db.close()
+
+    def _open(self):
+        from ZODB import DB
+        from ZODB.FileStorage import FileStorage
+        return DB(FileStorage(self.path))
+
+    def _check(self, done=20):
+        db = self._open()
+        try:
+            root = db.open().root()
+            self.assertEqual(len(root['q']), 20 - done)
+            self.assertEqual(
+                len([item for item in root['items']
+                     if getattr(item, 'done', False)]), done)
+        finally:
+            db.close()
+
+    def test_threads(self):
+        from zc.queue import worker
+        reports = []
+        runner = worker.Runner(
+            self._open, 'q', markDone, workers=3, batchSize=3,
+            untilEmpty=True)
+        stats = runner.run(reports.append, reportInterval=0)
+        self.assertEqual(stats['items'], 20)
+        self.assertGreaterEqual(stats['batches'], 7)
+        self.assertEqual(
+            sorted(stats),
+            ['batches', 'conflicts', 'items', 'items_per_second', 'seconds'])
+        self.assertTrue(reports)
+        self._check()
+
+    def test_processes(self):
+        from zc.queue import worker
+        runner = worker.Runner(
+            self._open, 'q', markDone, processes=True, batchSize=5,
+            untilEmpty=True)
+        stats = runner.run()
+        self.assertEqual((stats['items'], stats['batches']), (20, 4))
+        self._check()
+
+    def test_conflict_backoff(self):
+        import threading
+
+        from zc.queue import worker
+        failures = [POSException.ConflictError()] * 2
+
+        def handler(items):
+            markDone(items)
+            if failures:
+                raise failures.pop()
+        counts = [0, 0, 0]
+        db = self._open()
+        try:
+            worker.drain(db, 'q', handler, threading.Event(), counts, 10,
+                         untilEmpty=True)
+        finally:
+            db.close()
+        self.assertEqual(counts, [20, 2, 2])
+        self._check()
+
+    def test_handler_error(self):
+        from zc.queue import worker
+
+        def handler(items):
+            markDone(items)
+            raise ValueError(items)
+        runner = worker.Runner(self._open, 'q', handler, workers=2)
+        self.assertRaises(ValueError, runner.run)
+        self._check(0)
+
+    def test_stop(self):
+        import threading
+
+        from zc.queue import worker
+        runner = worker.Runner(
+            self._open, 'q', markDone, workers=2, pollInterval=0.01)
+        timer = threading.Timer(0.2, runner.stop)
+        timer.start()
+        self.assertEqual(runner.run()['items'], 20)
+        timer.join()
+        self._check()
+
+    def test_main(self):
+        import io
+        import json
+        import os
+
+        from zc.queue import worker
+        config = os.path.join(self.directory, 'zodb.conf')
+        with open(config, 'w') as f:
+            f.write('<zodb>\n  <filestorage>\n    path %s\n'
+                    '  </filestorage>\n</zodb>\n' % self.path)
+        out = io.StringIO()
+        worker.main([config, 'q', 'zc.queue.tests:markDone', '--workers',
+                     '2', '--batch-size', '4', '--until-empty'], out)
+        stats = json.loads(out.getvalue().splitlines()[-1])
+        self.assertEqual(stats['items'], 20)
+        self._check()
+
+    def test_bad_handler(self):
+        import contextlib
+        import io
+
+        from zc.queue import worker
+        for name in ('zc.queue.nope:handler', 'zc.queue.tests:nope'):
+            with contextlib.redirect_stderr(io.StringIO()):
+                self.assertRaises(
+                    SystemExit, worker.main, ['zodb.conf', 'q', name])
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def _main(self, *argv):
+        import io
+        import json
+
+        from zc.queue import benchmark
+        out = io.StringIO()
+        benchmark.main(list(argv), out)
+        return [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_smoke(self):
+        results = self._main(
+            '--classes', 'Queue,CompositeQueue', '--sizes', '5',
+            '--composite-sizes', '2,3', '--reps', '3', '--connections', '2',
+            '--rounds', '2')
+        self.assertEqual(
+            sorted({(r['backend'], r['queue'], r['compositeSize'])
+                    for r in results}),
+            [('file', 'CompositeQueue', 2), ('file', 'CompositeQueue', 3),
+             ('file', 'Queue', None), ('memory', 'CompositeQueue', 2),
+             ('memory', 'CompositeQueue', 3), ('memory', 'Queue', None)])
+        self.assertEqual(
+            [r['benchmark'] for r in results[:7]],
+            ['put', 'len', 'iter', 'index', 'pull', 'contention', 'states'])
+        put, contention = results[0], results[5]
+        self.assertEqual(put['ops'], 5)
+        self.assertGreater(put['bytes_per_commit'], 0)
+        self.assertEqual(contention['commits'] + contention['conflicts'], 4)
+        self.assertGreaterEqual(contention['resolved'], 1)
+        states = [r for r in results if r['benchmark'] == 'states']
+        self.assertEqual(
+            sorted({(r['queue'], r['record']) for r in states}),
+            [('CompositeQueue', 'bucket'), ('CompositeQueue', 'parent'),
+             ('Queue', 'parent')])
+        for r in states:
+            self.assertLess(r['compact_bytes'], r['legacy_bytes'])
+
+    def test_bad_arguments(self):
+        import contextlib
+        import io
+        for argv in (('--classes', 'Nope'), ('--backends', 'zeo')):
+            with contextlib.redirect_stderr(io.StringIO()):
+                self.assertRaises(SystemExit, self._main, *argv)
+
+    def test_unknown_backend(self):
+        from zc.queue import benchmark
+        self.assertRaises(ValueError, benchmark.Environment, 'zeo')
+
 
 def test_suite():
     flags = doctest.IGNORE_EXCEPTION_DETAIL
@@ -236,12 +3042,37 @@ def test_suite():
             globs={
                 'Queue': zc.queue.Queue,
                 'Item': lambda x: x}),
+        doctest.DocFileSuite(
+            'queue.rst',
+            optionflags=flags,
+            globs={
+                'Queue': zc.queue.OffsetQueue,
+                'Item': PersistentObject}),
+        doctest.DocFileSuite(
+            'queue.rst',
+            optionflags=flags,
+            globs={
+                'Queue': zc.queue.OffsetQueue,
+                'Item': lambda x: x}),
         doctest.DocFileSuite(
             'queue.rst',
             optionflags=flags,
             globs={
                 'Queue': lambda: zc.queue.CompositeQueue(2),
                 'Item': lambda x: x}),
+        doctest.DocFileSuite(
+            'queue.rst',
+            optionflags=flags,
+            globs={
+                'Queue': zc.queue.ArrayQueue,
+                'Item': lambda x: x}),
+        doctest.DocFileSuite(
+            'queue.rst',
+            optionflags=flags,
+            globs={
+                'Queue': lambda: zc.queue.CompositeQueue(
+                    2, zc.queue.ArrayBucketQueue),
+                'Item': lambda x: x}),
         doctest.DocTestSuite(),
         unittest.defaultTestLoader.loadTestsFromName(__name__),
     ))
@@ -0,0 +1,291 @@
+##############################################################################
+#
+# Copyright (c) 2011 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Queue Workers
+
+Drain a queue stored in the root of a database with a pool of threads or
+processes, each with a connection of its own.  Run
+``zc-queue-worker --help``, or ``python -m zc.queue.worker --help``, for the
+options; the database is given as a ZODB configuration file, so that any
+storage, such as a FileStorage or a ZEO client, can be used.  Throughput is
+reported as lines of JSON.
+
+Each batch of items is pulled, handed to the handler and committed in one
+transaction, so the changes the handler makes to the database are committed
+together with the pull.  A batch whose commit conflicts is aborted, which
+puts its items back, and is retried after a random back-off, so a handler
+with effects outside the database should be idempotent.
+"""
+import argparse
+import functools
+import importlib
+import json
+import multiprocessing
+import random
+import signal
+import sys
+import threading
+import time
+
+import transaction
+import ZODB.config
+from ZODB.POSException import ConflictError
+
+
+# the indexes of a worker's counters
+ITEMS, BATCHES, CONFLICTS = range(3)
+
+
+def drain(db, name, handler, stop, counts, batchSize=1, untilEmpty=False,
+          pollInterval=1.0, maxBackoff=1.0):
+    """Process the items of the queue `name` in the root of `db`.
+
+    Pull up to `batchSize` items, call `handler` with the list of them and
+    commit, until `stop` is set, or until the queue is empty if
+    `untilEmpty` is true.  While the queue is empty, check it again every
+    `pollInterval` seconds.  A batch whose commit raises ConflictError is
+    retried after sleeping for a random time of up to 10ms, doubled for
+    each further conflict up to `maxBackoff` seconds.  An exception from
+    the handler aborts the batch and is raised.
+
+    `counts`, a sequence of three integers, is incremented by the number
+    of items processed, batches committed and conflicts, at the indexes
+    ITEMS, BATCHES and CONFLICTS.
+    """
+    tm = transaction.TransactionManager()
+    conn = db.open(transaction_manager=tm)
+    try:
+        backoff = 0.01
+        while not stop.is_set():
+            tm.abort()  # start from the latest state
+            try:
+                items = conn.root()[name].pull_many(batchSize)
+                if items:
+                    handler(items)
+                    tm.commit()
+            except ConflictError:
+                tm.abort()
+                counts[CONFLICTS] += 1
+                time.sleep(random.uniform(0, backoff))
+                backoff = min(backoff * 2, maxBackoff)
+                continue
+            except BaseException:
+                tm.abort()
+                raise
+            if not items:
+                tm.abort()
+                if untilEmpty:
+                    break
+                stop.wait(pollInterval)
+                continue
+            backoff = 0.01
+            counts[ITEMS] += len(items)
+            counts[BATCHES] += 1
+    finally:
+        conn.close()
+
+
+def _process(dbFactory, name, handler, stop, counts, *args):
+    # the body of a worker process: the parent handles interrupts and tells
+    # the workers to stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    db = dbFactory()
+    try:
+        drain(db, name, handler, stop, counts, *args)
+    finally:
+        db.close()
+
+
+class Runner:
+    """Drain a queue with a pool of `workers` threads or processes.
+
+    `dbFactory` is a callable returning a database.  Threads share one
+    database, opened by `run`.  With `processes`, each process opens a
+    database of its own, so the storage must support several processes,
+    as a ZEO client does, and the factory and `handler` must be picklable.
+    The other arguments are passed on to `drain`.
+    """
+
+    def __init__(self, dbFactory, name, handler, workers=1, processes=False,
+                 batchSize=1, untilEmpty=False, pollInterval=1.0,
+                 maxBackoff=1.0):
+        self.dbFactory = dbFactory
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.processes = processes
+        self._args = (batchSize, untilEmpty, pollInterval, maxBackoff)
+        if processes:
+            context = multiprocessing.get_context()
+            self._stop = context.Event()
+            self._counts = [context.Array('q', 3, lock=False)
+                            for ix in range(workers)]
+        else:
+            self._stop = threading.Event()
+            self._counts = [[0, 0, 0] for ix in range(workers)]
+        self._errors = []
+        self._start = None
+
+    def stop(self):
+        """Ask the workers to stop after their current batch."""
+        self._stop.set()
+
+    def stats(self):
+        """Return a dict of the totals of the workers' counters so far,
+        with the seconds elapsed and the items processed per second."""
+        totals = [sum(counts[ix] for counts in self._counts)
+                  for ix in range(3)]
+        seconds = time.monotonic() - self._start if self._start else 0.0
+        return dict(
+            items=totals[ITEMS], batches=totals[BATCHES],
+            conflicts=totals[CONFLICTS], seconds=seconds,
+            items_per_second=totals[ITEMS] / seconds if seconds else None)
+
+    def _thread(self, db, counts):
+        try:
+            drain(db, self.name, self.handler, self._stop, counts,
+                  *self._args)
+        except BaseException as e:
+            self._errors.append(e)
+            self.stop()
+
+    def run(self, report=None, reportInterval=10.0):
+        """Start the workers and wait until they are done.
+
+        Call `report` with the `stats` every `reportInterval` seconds
+        meanwhile.  Return the final stats.  If a worker fails, stop the
+        others, and raise the thread's exception, or RuntimeError for a
+        process.
+        """
+        self._start = time.monotonic()
+        db = None
+        if self.processes:
+            context = multiprocessing.get_context()
+            workers = [
+                context.Process(
+                    target=_process,
+                    args=(self.dbFactory, self.name, self.handler,
+                          self._stop, counts) + self._args)
+                for counts in self._counts]
+        else:
+            db = self.dbFactory()
+            workers = [
+                threading.Thread(target=self._thread, args=(db, counts))
+                for counts in self._counts]
+        try:
+            for worker in workers:
+                worker.start()
+            nextReport = self._start + reportInterval
+            while True:
+                if self.processes and any(
+                        worker.exitcode for worker in workers):
+                    self.stop()
+                alive = [worker for worker in workers if worker.is_alive()]
+                if not alive:
+                    break
+                timeout = None
+                if report is not None:
+                    if time.monotonic() >= nextReport:
+                        report(self.stats())
+                        nextReport += reportInterval
+                    timeout = max(nextReport - time.monotonic(), 0)
+                if self.processes:
+                    # a failed process does not tell us, look again soon
+                    timeout = 0.5 if timeout is None else min(timeout, 0.5)
+                alive[0].join(timeout)
+        finally:
+            self.stop()
+            for worker in workers:
+                if worker.is_alive():
+                    worker.join()
+            if db is not None:
+                db.close()
+        if self._errors:
+            raise self._errors[0]
+        failed = [worker.exitcode for worker in workers
+                  if self.processes and worker.exitcode]
+        if failed:
+            raise RuntimeError('worker processes failed: %r' % (failed,))
+        return self.stats()
+
+
+def _import(name):
+    # return the object named by a module:attribute string
+    module, _, attribute = name.partition(':')
+    obj = importlib.import_module(module)
+    for part in attribute.split('.') if attribute else ():
+        obj = getattr(obj, part)
+    return obj
+
+
+def main(argv=None, out=None):
+    parser = argparse.ArgumentParser(
+        prog='zc-queue-worker', description=__doc__.splitlines()[0])
+    parser.add_argument(
+        'config', help='a ZODB configuration file for the database')
+    parser.add_argument(
+        'queue', help='the name of the queue in the root of the database')
+    parser.add_argument(
+        'handler',
+        help='module:callable that is called with each batch of items')
+    parser.add_argument(
+        '--workers', type=int, default=multiprocessing.cpu_count(),
+        help='the number of workers (default: the number of CPUs)')
+    parser.add_argument(
+        '--processes', action='store_true',
+        help='run the workers in processes instead of threads')
+    parser.add_argument(
+        '--batch-size', type=int, default=1,
+        help='items handled in each transaction')
+    parser.add_argument(
+        '--until-empty', action='store_true',
+        help='stop when the queue is empty instead of waiting for items')
+    parser.add_argument(
+        '--poll-interval', type=float, default=1.0,
+        help='seconds between checks of an empty queue')
+    parser.add_argument(
+        '--max-backoff', type=float, default=1.0,
+        help='the longest sleep, in seconds, before retrying a conflict')
+    parser.add_argument(
+        '--report-interval', type=float, default=10.0,
+        help='seconds between throughput reports')
+    options = parser.parse_args(argv)
+    try:
+        handler = _import(options.handler)
+    except (ImportError, AttributeError) as e:
+        parser.error('cannot import handler: %s' % e)
+    if out is None:
+        out = sys.stdout
+
+    def report(stats):
+        out.write(json.dumps(stats, sort_keys=True) + '\n')
+        out.flush()
+
+    runner = Runner(
+        functools.partial(ZODB.config.databaseFromURL, options.config),
+        options.queue, handler, options.workers, options.processes,
+        options.batch_size, options.until_empty, options.poll_interval,
+        options.max_backoff)
+    handlers = {}
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        handlers[signum] = signal.signal(
+            signum, lambda signum, frame: runner.stop())
+    try:
+        report(runner.run(report, options.report_interval))
+    finally:
+        for signum, previous in handlers.items():
+            signal.signal(signum, previous)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()